@@ -0,0 +1,303 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Process-wide pool of authenticated target clients.
+
+Logging into a target (a vSphere or vCloud session, a XenAPI session, a
+keystone token) is frequently more expensive than the call that follows,
+so clients are kept around and reused by all drivers in the process that
+talk to the same target with the same credentials.
+
+Clients are not thread-safe, so a client is only used by one driver at a
+time: get checks a client out, and it is only handed out again once it
+was checked back in (see checkIn), or once the driver that checked it out
+is gone. Drivers running at the same time against the same target get
+clients of their own.
+"""
+
+import threading
+import time
+import weakref
+
+from conary.lib import digestlib
+
+class ClientPool(object):
+    # Discard clients that have been around for longer than this many seconds
+    DEFAULT_TTL = 1800
+    # Run the driver's health check on a client that has not been used for
+    # this many seconds
+    DEFAULT_CHECK_INTERVAL = 300
+    # Maximum number of clients to keep. The least recently used idle one
+    # gets evicted first
+    DEFAULT_MAX_SIZE = 64
+
+    class Entry(object):
+        __slots__ = [ 'key', 'client', 'created', 'lastUsed', 'release',
+            'forget', 'owner', 'dropped', ]
+        def __init__(self, key, client, release=None, forget=None, now=None):
+            if now is None:
+                now = time.time()
+            self.key = key
+            self.client = client
+            self.created = self.lastUsed = now
+            self.release = release
+            self.forget = forget
+            # None if the client is idle; otherwise whoever checked it out
+            self.owner = None
+            # Dropped from the pool while checked out; released on check in
+            self.dropped = False
+
+    def __init__(self, ttl=None, checkInterval=None, maxSize=None):
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        if checkInterval is None:
+            checkInterval = self.DEFAULT_CHECK_INTERVAL
+        if maxSize is None:
+            maxSize = self.DEFAULT_MAX_SIZE
+        self.ttl = ttl
+        self.checkInterval = checkInterval
+        self.maxSize = maxSize
+        self._lock = threading.RLock()
+        # Maps keys to the list of their clients, idle or checked out
+        self._entries = {}
+        # Clients dropped while checked out
+        self._dropped = []
+
+    @classmethod
+    def makeKey(cls, cloudType, cloudName, credentials, targetConfig=None):
+        """
+        Build a pool key for a target. Credentials are not kept in the key,
+        only a digest of them (and of the target configuration, so that
+        changing the configuration implicitly invalidates the clients)
+        """
+        csum = digestlib.sha1()
+        for data in [ credentials, targetConfig ]:
+            for k, v in sorted((data or {}).items()):
+                csum.update("%s\0%s\0" % (cls._toStr(k), cls._toStr(v)))
+            csum.update("\0")
+        return (cloudType, cloudName, csum.hexdigest())
+
+    @classmethod
+    def _toStr(cls, obj):
+        if isinstance(obj, unicode):
+            return obj.encode('utf-8')
+        return str(obj)
+
+    def get(self, key, factory, healthCheck=None, release=None, forget=None,
+            owner=None):
+        """
+        Check out a client for key, creating it with factory() if no live
+        one is idle. The client is not handed out again until it is checked
+        back in with checkIn, or, if owner is not None, until owner is
+        garbage collected.
+        healthCheck(client) should return False if the client's session is no
+        longer usable, in which case a new client is created (i.e. we log in
+        again).
+        release(client) is invoked when the client is dropped from the pool.
+        forget(client) is invoked instead of release(client) when the pool
+        is emptied in a forked child (see forgetAll).
+        """
+        now = time.time()
+        while 1:
+            entry = self._checkOutIdle(key, owner)
+            if entry is None:
+                break
+            # Health checks talk to the target, do not hold the lock
+            if self._isUsable(entry, healthCheck, now):
+                entry.lastUsed = now
+                return entry.client
+            self._discard(entry)
+        # Do not hold the lock while logging in, it may take a while
+        client = factory()
+        entry = self.Entry(key, client, release=release, forget=forget)
+        self._setOwner(entry, owner)
+        self._add(entry)
+        return client
+
+    def add(self, key, client, release=None, forget=None):
+        """
+        Add an idle client to the pool
+        """
+        self._add(self.Entry(key, client, release=release, forget=forget))
+
+    def checkIn(self, client):
+        """
+        Make a client checked out with get available to others again
+        """
+        with self._lock:
+            entries = [ x for x in list(self._iterEntries()) + self._dropped
+                if x.client is client ]
+        for entry in entries:
+            self._checkIn(entry)
+
+    def _checkOutIdle(self, key, owner):
+        with self._lock:
+            idle = [ x for x in self._entries.get(key, [])
+                if x.owner is None ]
+            if not idle:
+                return None
+            entry = max(idle, key=lambda x: x.lastUsed)
+            self._setOwner(entry, owner)
+            return entry
+
+    def _setOwner(self, entry, owner):
+        if owner is None:
+            entry.owner = True
+            return
+        # The callback only keeps a weak reference to the pool: the pool
+        # holds the entry, which holds the owner's weak reference
+        wself = weakref.ref(self)
+        def ownerGone(ref):
+            pool = wself()
+            if pool is not None:
+                pool._checkIn(entry)
+        entry.owner = weakref.ref(owner, ownerGone)
+
+    def _checkIn(self, entry):
+        # May be invoked by the garbage collector, from any thread: only
+        # the entry itself and the list of dropped clients are changed
+        with self._lock:
+            if entry.owner is None:
+                return
+            entry.owner = None
+            entry.lastUsed = time.time()
+            dropped = entry.dropped
+            if dropped:
+                entry.dropped = False
+                self._dropped.remove(entry)
+        if dropped:
+            self._release(entry)
+
+    def _add(self, entry):
+        evicted = []
+        with self._lock:
+            self._entries.setdefault(entry.key, []).append(entry)
+            idle = sorted((x for x in self._iterEntries() if x.owner is None),
+                key=lambda x: x.lastUsed)
+            while len(self) > self.maxSize and idle:
+                lru = idle.pop(0)
+                self._remove(lru)
+                evicted.append(lru)
+        for entry in evicted:
+            self._release(entry)
+
+    def _iterEntries(self):
+        for entries in self._entries.values():
+            for entry in entries:
+                yield entry
+
+    def _remove(self, entry):
+        entries = self._entries[entry.key]
+        entries.remove(entry)
+        if not entries:
+            del self._entries[entry.key]
+
+    def _isUsable(self, entry, healthCheck, now):
+        if now - entry.created >= self.ttl:
+            return False
+        if healthCheck is None or now - entry.lastUsed < self.checkInterval:
+            return True
+        try:
+            return bool(healthCheck(entry.client))
+        except Exception:
+            return False
+
+    def _discard(self, entry):
+        """
+        Remove from the pool, and release, a client checked out by our
+        caller
+        """
+        with self._lock:
+            if entry in self._entries.get(entry.key, []):
+                self._remove(entry)
+            entry.owner = None
+        self._release(entry)
+
+    def invalidate(self, key):
+        with self._lock:
+            entries = list(self._entries.get(key, []))
+        self._dropCheckedOut(entries)
+
+    def invalidateTarget(self, cloudType, cloudName):
+        """
+        Drop all clients for a target, regardless of credentials
+        """
+        with self._lock:
+            entries = [ x for x in self._iterEntries()
+                if x.key[0] == cloudType and x.key[1] == cloudName ]
+        self._dropCheckedOut(entries)
+
+    def clear(self):
+        """
+        Drop (and log out) all clients
+        """
+        with self._lock:
+            entries = list(self._iterEntries())
+        self._dropCheckedOut(entries)
+
+    def _dropCheckedOut(self, entries):
+        released = []
+        with self._lock:
+            for entry in entries:
+                if entry not in self._entries.get(entry.key, []):
+                    continue
+                self._remove(entry)
+                if entry.owner is None:
+                    released.append(entry)
+                else:
+                    # Still in use, log out once it is checked in
+                    entry.dropped = True
+                    self._dropped.append(entry)
+        for entry in released:
+            self._release(entry)
+
+    def forgetAll(self):
+        """
+        Drop all clients without logging them out. To be used in a forked
+        child, the sessions still belong to the parent process.
+        """
+        with self._lock:
+            entries = list(self._iterEntries()) + self._dropped
+            self._entries.clear()
+            self._dropped = []
+            for entry in entries:
+                # Whoever checked them out in the parent is not to check
+                # them back in
+                entry.owner = None
+                entry.dropped = False
+        for entry in entries:
+            self._release(entry, entry.forget)
+
+    @classmethod
+    def _release(cls, entry, callback=None):
+        if callback is None:
+            callback = entry.release
+        if callback is None:
+            return
+        try:
+            callback(entry.client)
+        except Exception:
+            # We're dropping the client anyway
+            pass
+
+    def __len__(self):
+        return sum(len(x) for x in self._entries.values())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+pool = ClientPool()
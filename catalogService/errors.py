@@ -108,6 +108,10 @@ class CloudExists(CatalogError):
     """Target already exists"""
     status = http_codes.HTTP_CONFLICT
 
+class TargetTimeout(CatalogError):
+    """The target did not answer in time"""
+    status = http_codes.HTTP_GATEWAY_TIME_OUT
+
 class HttpNotFound(CatalogError):
     """File not found"""
     status = 404
@@ -116,9 +120,14 @@ class DownloadError(CatalogError):
     """Error downloading image"""
     status = 404
 
+class ImageChecksumMismatch(DownloadError):
+    """Downloaded image does not match its checksum"""
+    status = http_codes.HTTP_BAD_GATEWAY
+
 class ErrorMessageCallback(error.ErrorCallback):
     def processResponse(self, request, response):
-        if response.status == 200 or response.content:
+        if response.status in (http_codes.HTTP_OK,
+                http_codes.HTTP_NOT_MODIFIED) or response.content:
             return
         return CatalogErrorResponse(status=response.status,
                             message=response.message,
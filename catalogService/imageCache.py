@@ -0,0 +1,255 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+On-disk cache of downloaded images, keyed by the image's sha1.
+
+The same image is frequently deployed to several targets in a row; with the
+cache, only the first deployment has to fetch it from rBuilder.
+
+Entries are written to a temporary file while the image is streamed to the
+target, and are published (with an atomic rename) only if the content
+matches the expected checksum. Several job processes may use the cache
+concurrently: a per-entry lock makes sure only one of them populates an
+entry, and eviction is serialized through a cache-wide lock. Readers do not
+need a lock, an entry removed while it is being read stays accessible
+through the open file descriptor.
+"""
+
+import errno
+import fcntl
+import os
+import re
+import tempfile
+import time
+
+from conary.lib import util
+
+from catalogService.utils.progress import StreamWithDigest
+
+class ImageCache(object):
+    # Size budget for the cache, in bytes
+    DEFAULT_MAX_SIZE = 50 * 1024 * 1024 * 1024
+    # Temporary files older than this (in seconds) are left over from dead
+    # processes
+    STALE_TEMP_AGE = 86400
+
+    _keyRe = re.compile('^[A-Za-z0-9]+$')
+
+    def __init__(self, cacheDir, maxSize=None):
+        if maxSize is None:
+            maxSize = self.DEFAULT_MAX_SIZE
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self._objectsDir = os.path.join(cacheDir, 'objects')
+        self._tmpDir = os.path.join(cacheDir, 'tmp')
+        self._lockPath = os.path.join(cacheDir, 'lock')
+
+    @classmethod
+    def isValidKey(cls, key):
+        return bool(key and cls._keyRe.match(key))
+
+    def _path(self, key):
+        return os.path.join(self._objectsDir, key[:2], key)
+
+    def open(self, key):
+        """
+        Return an open file for the cached entry, or None if the entry is
+        not in the cache
+        """
+        if not self.isValidKey(key):
+            return None
+        path = self._path(key)
+        try:
+            fobj = file(path, "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        # The modification time is used for LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return fobj
+
+    def __contains__(self, key):
+        return self.isValidKey(key) and os.path.exists(self._path(key))
+
+    def store(self, key, stream):
+        """
+        Return a file-like object that reads from stream, and adds the
+        content to the cache under key once stream was read completely.
+        If another process is already populating the same entry, stream is
+        returned unchanged.
+        The sha1 of the content is taken from stream if it is a
+        StreamWithDigest, otherwise it gets wrapped in one.
+        """
+        if not self.isValidKey(key):
+            return stream
+        try:
+            util.mkdirChain(os.path.dirname(self._path(key)))
+            util.mkdirChain(self._tmpDir)
+            lock = self._lock(self._path(key) + '.lock', blocking=False)
+            if lock is None:
+                return stream
+            fd, tmpPath = tempfile.mkstemp(dir=self._tmpDir,
+                prefix=key + '-')
+        except (IOError, OSError):
+            # A cache we can't write to should not fail the download
+            return stream
+        if not (isinstance(stream, StreamWithDigest) and
+                'sha1' in stream.digests):
+            stream = StreamWithDigest(stream)
+        return CachingStream(self, key, stream, os.fdopen(fd, "wb"),
+            tmpPath, lock)
+
+    def _publish(self, key, tmpPath):
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, self._path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in its
+        size budget
+        """
+        lock = self._lock(self._lockPath)
+        try:
+            self._cleanTemp()
+            entries = []
+            totalSize = 0
+            for dirPath, dirNames, fileNames in os.walk(self._objectsDir):
+                for fileName in fileNames:
+                    if fileName.endswith('.lock'):
+                        continue
+                    path = os.path.join(dirPath, fileName)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    totalSize += st.st_size
+                    if fileName != keep:
+                        entries.append((st.st_mtime, st.st_size, path))
+            entries.sort()
+            for mtime, size, path in entries:
+                if totalSize <= self.maxSize:
+                    break
+                util.removeIfExists(path)
+                totalSize -= size
+        finally:
+            lock.close()
+
+    def _cleanTemp(self):
+        if not os.path.isdir(self._tmpDir):
+            return
+        cutoff = time.time() - self.STALE_TEMP_AGE
+        for fileName in os.listdir(self._tmpDir):
+            path = os.path.join(self._tmpDir, fileName)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    @classmethod
+    def _lock(cls, path, blocking=True):
+        util.mkdirChain(os.path.dirname(path))
+        lockf = file(path, "a")
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockf.fileno(), flags)
+        except IOError, e:
+            lockf.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return lockf
+
+class CachingStream(object):
+    """
+    Wrap a StreamWithDigest, saving the data read from it to a temporary
+    file. When the stream is exhausted (or closed) and the data matches the
+    expected sha1, the file is published into the cache.
+    """
+    def __init__(self, cache, key, stream, outf, tmpPath, lock):
+        self.cache = cache
+        self.key = key
+        self.stream = stream
+        self._outf = outf
+        self._tmpPath = tmpPath
+        self._lock = lock
+        self._done = False
+
+    def __getattr__(self, name):
+        # headers, fileno etc. come from the wrapped stream
+        return getattr(self.stream, name)
+
+    _DEFAULT = object()
+    def read(self, size=_DEFAULT):
+        if size is self._DEFAULT:
+            data = self.stream.read()
+        else:
+            data = self.stream.read(size)
+        if self._done:
+            return data
+        if not data:
+            self._finish()
+            return data
+        try:
+            self._outf.write(data)
+        except (IOError, OSError):
+            # Most likely out of space. Stop caching, but keep streaming
+            self._abort()
+        return data
+
+    def close(self):
+        self._finish()
+        return self.stream.close()
+
+    def verify(self):
+        # Drain through this object, so the rest of the content gets cached
+        while self.read(self.stream.BUFFER_SIZE):
+            pass
+        return self.stream.verify()
+
+    def _finish(self):
+        if self._done:
+            return
+        if self.stream.hexdigest('sha1') != self.key.lower():
+            self._abort()
+            return
+        self._done = True
+        try:
+            try:
+                self._outf.close()
+                self.cache._publish(self.key, self._tmpPath)
+            except (IOError, OSError):
+                util.removeIfExists(self._tmpPath)
+        finally:
+            self._lock.close()
+
+    def _abort(self):
+        if self._done:
+            return
+        self._done = True
+        try:
+            self._outf.close()
+            util.removeIfExists(self._tmpPath)
+        finally:
+            self._lock.close()
@@ -16,9 +16,13 @@
 #
 
 
+import json
 import os
+import sqlite3
 import time
 
+from conary.lib import util
+
 class InstanceStore(object):
     __slots__ = [ '_store', '_prefix' ]
     DEFAULT_EXPIRATION = 1800
@@ -197,3 +201,302 @@ class InstanceStore(object):
         if ret is None:
             return None
         return int(float(ret))
+
+
+class SqliteInstanceStore(InstanceStore):
+    """
+    Instance store keeping all the fields of an instance in a single row
+    of a sqlite database, instead of one DiskStorage file per field.
+    Several fields can be updated at once (see update), and the fields of
+    many instances can be read with one query (see getMany). The time of
+    the next software version check is indexed, so due instances can be
+    found without reading every record.
+    The X509 material is kept as files under x509Dir, since callers need
+    paths to it.
+    No driver in this tree reads or writes instance records; the store is
+    only reached through BaseDriver._getInstanceStore by external callers.
+    """
+    __slots__ = [ '_path', '_x509Dir', '_keyGenerator', '_db' ]
+    # Number of instances fetched with one query by getMany
+    BATCH_SIZE = 200
+    TIMEOUT = 30
+
+    def __init__(self, path, prefix, x509Dir=None, keyGenerator=None):
+        InstanceStore.__init__(self, None, prefix)
+        self._path = path
+        if x509Dir is None:
+            x509Dir = path + '-x509'
+        self._x509Dir = x509Dir
+        if keyGenerator is None:
+            keyGenerator = lambda: os.urandom(3).encode('hex')
+        self._keyGenerator = keyGenerator
+        self._db = None
+
+    def _getDb(self):
+        if self._db is not None:
+            return self._db
+        util.mkdirChain(os.path.dirname(self._path))
+        db = sqlite3.connect(self._path, timeout=self.TIMEOUT,
+            isolation_level=None)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS instances (
+                prefix          TEXT NOT NULL,
+                instance_id     TEXT NOT NULL,
+                fields          TEXT NOT NULL,
+                next_check      INTEGER,
+                PRIMARY KEY (prefix, instance_id)
+            )""")
+        # Due time index for software version checks
+        db.execute("""
+            CREATE INDEX IF NOT EXISTS instances_next_check_idx
+                ON instances (next_check)""")
+        self._db = db
+        return db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def newKey(self, realId = None, imageId = None, expiration = None,
+            state = None):
+        if state is None:
+            state = 'Creating'
+        if expiration is None:
+            expiration = self.DEFAULT_EXPIRATION
+        db = self._getDb()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            while 1:
+                instId = self._keyGenerator()
+                cu = db.execute("""
+                    SELECT 1 FROM instances
+                     WHERE prefix = ? AND instance_id = ?""",
+                    (self._prefix, instId))
+                if cu.fetchone() is None:
+                    break
+            fields = dict(imageId=imageId, id=realId, state=state,
+                expiration=int(time.time() + expiration))
+            self._write(db, instId, None, fields)
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return instId
+
+    def enumerate(self):
+        cu = self._getDb().execute("""
+            SELECT instance_id FROM instances
+             WHERE prefix = ?
+             ORDER BY instance_id""", (self._prefix, ))
+        return [ '%s/%s' % (self._prefix, x[0]) for x in cu ]
+
+    def delete(self, key):
+        instanceId = self._getInstanceId(key)
+        self._getDb().execute("""
+            DELETE FROM instances
+             WHERE prefix = ? AND instance_id = ?""",
+            (self._prefix, instanceId))
+        util.rmtree(os.path.join(self._x509Dir, self._prefix, instanceId),
+            ignore_errors=True)
+
+    def getFields(self, instanceId):
+        """
+        Return a dictionary with all the fields of an instance
+        """
+        instanceId = self._getInstanceId(instanceId)
+        return self.getMany([instanceId]).get(instanceId, {})
+
+    def getMany(self, instanceIds):
+        """
+        Return a dictionary mapping instance ids to the dictionary of their
+        fields. Unknown instances are not part of the result.
+        """
+        instanceIds = [ self._getInstanceId(x) for x in instanceIds ]
+        db = self._getDb()
+        ret = {}
+        for i in range(0, len(instanceIds), self.BATCH_SIZE):
+            batch = instanceIds[i:i + self.BATCH_SIZE]
+            cu = db.execute("""
+                SELECT instance_id, fields FROM instances
+                 WHERE prefix = ? AND instance_id IN (%s)""" %
+                    ', '.join('?' * len(batch)),
+                [ self._prefix ] + batch)
+            for instanceId, fields in cu:
+                ret[str(instanceId)] = self._decode(fields)
+        return ret
+
+    def update(self, instanceId, **fields):
+        """
+        Set several fields of an instance at once. A value of None removes
+        the field.
+        """
+        self.updateMany({ instanceId : fields })
+
+    def updateMany(self, updates):
+        """
+        Update several instances in one transaction. updates maps instance
+        ids to a dictionary of fields, as passed to update.
+        """
+        db = self._getDb()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for instanceId, fields in updates.items():
+                instanceId = self._getInstanceId(instanceId)
+                cu = db.execute("""
+                    SELECT fields FROM instances
+                     WHERE prefix = ? AND instance_id = ?""",
+                    (self._prefix, instanceId))
+                row = cu.fetchone()
+                if row is None:
+                    old = None
+                else:
+                    old = self._decode(row[0])
+                self._write(db, instanceId, old, fields)
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def withPrefix(self, prefix):
+        """
+        Return a store for another prefix in the same database
+        """
+        return self.__class__(self._path, prefix, x509Dir=self._x509Dir,
+            keyGenerator=self._keyGenerator)
+
+    @classmethod
+    def getPath(cls, storagePath, cloudType):
+        """
+        Return the path of the database keeping the instances of all the
+        targets of a cloud type
+        """
+        return os.path.join(storagePath, 'instance-store',
+            '%s.sqlite' % cloudType)
+
+    @classmethod
+    def getStores(cls, storagePath):
+        """
+        Return a dictionary mapping cloud types to a store for each of
+        the databases found under storagePath. The stores have an empty
+        prefix, use withPrefix to get to the instances of a target.
+        """
+        ret = {}
+        topDir = os.path.dirname(cls.getPath(storagePath, 'x'))
+        if not os.path.isdir(topDir):
+            return ret
+        for fileName in sorted(os.listdir(topDir)):
+            cloudType, ext = os.path.splitext(fileName)
+            if ext != '.sqlite':
+                continue
+            ret[cloudType] = cls(cls.getPath(storagePath, cloudType), '')
+        return ret
+
+    def getDueSoftwareVersionChecks(self, now=None, limit=None):
+        """
+        Return the (prefix, instanceId) of instances, for all prefixes in
+        this store's database (that is, all the targets of one cloud
+        type), whose softwareVersionNextCheck is not later than now, in
+        the order they became due.
+        """
+        if now is None:
+            now = time.time()
+        sql = """
+            SELECT prefix, instance_id FROM instances
+             WHERE next_check <= ?
+             ORDER BY next_check, prefix, instance_id"""
+        args = [ int(now) ]
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        cu = self._getDb().execute(sql, args)
+        return [ (str(x), str(y)) for (x, y) in cu ]
+
+    def _write(self, db, instanceId, old, fields):
+        new = dict(old or {})
+        for key, value in fields.items():
+            if value is None:
+                new.pop(key, None)
+            else:
+                if not isinstance(value, basestring):
+                    value = str(value)
+                new[key] = value
+        data = json.dumps(new, sort_keys=True)
+        nextCheck = new.get('softwareVersionNextCheck')
+        if nextCheck is not None:
+            nextCheck = int(float(nextCheck))
+        if old is None:
+            db.execute("""
+                INSERT INTO instances (prefix, instance_id, fields, next_check)
+                VALUES (?, ?, ?, ?)""",
+                (self._prefix, instanceId, data, nextCheck))
+        else:
+            db.execute("""
+                UPDATE instances SET fields = ?, next_check = ?
+                 WHERE prefix = ? AND instance_id = ?""",
+                (data, nextCheck, self._prefix, instanceId))
+
+    @classmethod
+    def _decode(cls, data):
+        return dict((str(k), v.encode('utf-8'))
+            for (k, v) in json.loads(data).items())
+
+    def _get(self, instanceId, key, default = None):
+        return self.getFields(instanceId).get(key, default)
+
+    def _set(self, instanceId, key, value):
+        self.update(instanceId, **{key : value})
+
+    def setState(self, instanceId, state):
+        fields = dict(state=state)
+        if state is not None:
+            fields['expiration'] = int(time.time() + self.DEFAULT_EXPIRATION)
+        self.update(instanceId, **fields)
+
+    def storeX509(self, instanceId, certPath, keyPath):
+        """
+        Save the X509 cert components into the store, and remove the old files
+        """
+        instanceId = self._getInstanceId(instanceId)
+        ret = []
+        for src, name in [ (certPath, 'x509cert'), (keyPath, 'x509key') ]:
+            ret.append(self._writeX509File(instanceId, name,
+                file(src).read()))
+        return tuple(ret)
+
+    def _writeX509File(self, instanceId, name, data):
+        dirName = os.path.join(self._x509Dir, self._prefix, instanceId)
+        util.mkdirChain(dirName)
+        path = os.path.join(dirName, name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, "w")
+        f.write(data)
+        f.close()
+        return path
+
+    def getX509Files(self, instanceId):
+        instanceId = self._getInstanceId(instanceId)
+        return tuple(os.path.join(self._x509Dir, self._prefix, instanceId, x)
+            for x in ['x509cert', 'x509key'])
+
+    def migrate(self, store):
+        """
+        Move the instances stored with the per-field DiskStorage layout
+        (see InstanceStore) under our prefix into this store. Returns the
+        list of migrated instance ids.
+        """
+        ret = []
+        for instKey in store.enumerate(self._prefix):
+            instanceId = self._getInstanceId(instKey)
+            fields = {}
+            for fkey in store.enumerate(instKey):
+                name = os.path.basename(fkey)
+                value = store.get(fkey)
+                if name in ('x509cert', 'x509key'):
+                    self._writeX509File(instanceId, name, value)
+                else:
+                    fields[name] = value
+            self.update(instanceId, **fields)
+            store.delete(instKey)
+            ret.append(instanceId)
+        return ret
@@ -0,0 +1,344 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Shared waiter for instance state changes.
+
+Every launch job waits for its instances to reach a running state and to
+acquire a network address. Launch jobs run in separate processes, and
+polling the target from each one of them multiplies the load on the target
+by the number of concurrent launches.
+
+Instead, all jobs waiting on instances from the same target (and with the
+same credentials) share a state directory. Each job registers the instance
+ids it is interested in. One of the jobs holds a lock and is the leader:
+it queries the target for the union of all registered instances, and
+publishes the result in the directory. The other jobs only watch the
+published state. When the leader is done waiting for its own instances it
+releases the lock, and one of the remaining jobs takes over.
+
+How the leader talks to the target is up to the driver (see
+BaseDriver.drvWaitForInstanceUpdates and drvGetWatchedInstances): targets
+that can push change notifications block until something changes, the
+others get polled with a batched request and an adaptive interval.
+
+If the batched request fails (for instance because one of the instances
+is not known to the target yet), the leader queries the instances of
+every job separately, and the error is only reported to the jobs whose
+instances could not be queried.
+"""
+
+import errno
+import fcntl
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from conary.lib import util
+
+class InstanceState(object):
+    """
+    Snapshot of an instance, as published by the leader
+    """
+    __slots__ = [ 'instanceId', 'state', 'publicDnsName', ]
+
+    def __init__(self, instanceId, state=None, publicDnsName=None):
+        self.instanceId = instanceId
+        self.state = state
+        self.publicDnsName = publicDnsName
+
+    @classmethod
+    def fromInstance(cls, instance):
+        return cls(instance.getInstanceId(), instance.getState(),
+            instance.getPublicDnsName())
+
+    def getInstanceId(self):
+        return self.instanceId
+
+    def getState(self):
+        return self.state
+
+    def getPublicDnsName(self):
+        return self.publicDnsName
+
+    def toDict(self):
+        return dict(state=self.state, publicDnsName=self.publicDnsName)
+
+
+class InstanceWaitError(Exception):
+    """
+    The leader failed to query the instances of this job. Carries the
+    message of the original error.
+    """
+
+
+class InstanceWaiter(object):
+    # How often (in seconds) non-leaders check for a new published state.
+    # This only touches the local file system
+    FOLLOWER_INTERVAL = 0.5
+    # Upper bound for the adaptive poll interval
+    MAX_INTERVAL = 60
+
+    _counter = itertools.count()
+
+    def __init__(self, backend, stateDir, log=None):
+        """
+        backend is normally the driver. It needs to implement:
+            drvWaitForInstanceUpdates(instanceIds, timeout)
+                block for at most timeout seconds, or until the target
+                signals a change to one of the instances. Return False if
+                nothing changed, or None if the target cannot notify us of
+                changes (in which case it gets polled).
+            drvGetWatchedInstances(instanceIds)
+                return the current state of the instances
+        """
+        self.backend = backend
+        self.stateDir = stateDir
+        if log is None:
+            log = lambda *args, **kwargs: None
+        self.log = log
+        self._statePath = os.path.join(stateDir, 'state')
+        self._lockPath = os.path.join(stateDir, 'leader.lock')
+        # Errors from the last poll, as raised, for the jobs of the leader
+        # to re-raise
+        self._pollErrors = {}
+
+    def wait(self, instanceIds, predicate, timeout, interval, callback=None):
+        """
+        Wait for at most timeout seconds, until predicate(instances)
+        returns True. instances is a list of InstanceState objects, for
+        the ones among instanceIds the target knows about.
+        callback(instances) is invoked whenever a new state is published
+        that does not satisfy the predicate.
+        interval is the initial poll interval for targets that need to be
+        polled.
+        Returns the last known instances.
+        """
+        instanceIds = set(instanceIds)
+        expired = time.time() + timeout
+        util.mkdirChain(self.stateDir)
+        watchPath = self._register(instanceIds)
+        watchName = os.path.basename(watchPath)
+        lock = None
+        seenVersion = None
+        instances = []
+        backoff = Backoff(interval, max(interval, self.MAX_INTERVAL))
+        try:
+            while 1:
+                if lock is None:
+                    lock = self._tryLock()
+                    if lock is not None:
+                        self.log("Watching instances for all launch jobs")
+                if lock is not None:
+                    self._lead(backoff, expired - time.time())
+                state = self._readState()
+                if state is not None and state['version'] != seenVersion:
+                    seenVersion = state['version']
+                    error = state.get('errors', {}).get(watchName)
+                    if error is not None:
+                        excInfo = self._pollErrors.get(watchName)
+                        if excInfo is not None:
+                            raise excInfo[0], excInfo[1], excInfo[2]
+                        raise InstanceWaitError(error)
+                    if instanceIds.issubset(state['polled']):
+                        instances = self._getInstances(state, instanceIds)
+                        if predicate(instances):
+                            return instances
+                        if callback is not None:
+                            callback(instances)
+                remaining = expired - time.time()
+                if remaining <= 0:
+                    return instances
+                if lock is None:
+                    time.sleep(min(self.FOLLOWER_INTERVAL, remaining))
+        finally:
+            util.removeIfExists(watchPath)
+            if lock is not None:
+                lock.close()
+
+    def _lead(self, backoff, remaining):
+        state = self._readState()
+        watchers = self._getWatchers()
+        instanceIds = self._union(watchers)
+        if not instanceIds:
+            return
+        polled = state is not None and instanceIds.issubset(state['polled'])
+        if polled:
+            # Everyone has seen at least one state; wait for a change
+            # before asking for the instances again
+            timeout = max(0, min(backoff.current, remaining))
+            changed = self.backend.drvWaitForInstanceUpdates(
+                sorted(instanceIds), timeout)
+            if changed is None:
+                self._sleep(instanceIds, timeout)
+            elif not changed:
+                return
+            # Pick up jobs that registered in the meantime
+            watchers = self._getWatchers()
+            instanceIds = self._union(watchers)
+        instances = self._poll(watchers, instanceIds)
+        version = 0
+        if state is not None:
+            version = state['version'] + 1
+        if polled and self._toDict(instances) == self._toDict(
+                self._getInstances(state, instanceIds)):
+            backoff.unchanged()
+        else:
+            backoff.reset()
+        errors = dict((x, str(y[1])) for (x, y) in self._pollErrors.items())
+        self._writeState(version, instanceIds, instances, errors)
+
+    def _poll(self, watchers, instanceIds):
+        """
+        Query the instances of all jobs with one request. If that fails,
+        query the instances of each job separately, and keep the errors
+        for the jobs they belong to (see _pollErrors).
+        """
+        self._pollErrors = {}
+        try:
+            return [ InstanceState.fromInstance(x)
+                for x in self.backend.drvGetWatchedInstances(
+                    sorted(instanceIds)) ]
+        except Exception, e:
+            self.log("Error querying instances for all launch jobs: %s" % e)
+        instances = {}
+        for watchName, jobIds in sorted(watchers.items()):
+            try:
+                for x in self.backend.drvGetWatchedInstances(sorted(jobIds)):
+                    instances[x.getInstanceId()] = \
+                        InstanceState.fromInstance(x)
+            except Exception:
+                self._pollErrors[watchName] = sys.exc_info()
+        return [ instances[x] for x in sorted(instances) ]
+
+    def _sleep(self, instanceIds, timeout):
+        """
+        Sleep for timeout seconds, but return early if a job starts
+        waiting for instances we are not polling yet
+        """
+        expired = time.time() + timeout
+        while 1:
+            remaining = expired - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(self.FOLLOWER_INTERVAL, remaining))
+            if not self._getWatchedIds().issubset(instanceIds):
+                return
+
+    @classmethod
+    def _toDict(cls, instances):
+        return dict((x.instanceId, x.toDict()) for x in instances)
+
+    def _register(self, instanceIds):
+        fd, path = tempfile.mkstemp(dir=self.stateDir,
+            prefix='watch-%d-%d-' % (os.getpid(), self._counter.next()))
+        with os.fdopen(fd, "w") as f:
+            json.dump(sorted(instanceIds), f)
+        return path
+
+    def _getWatchedIds(self):
+        return self._union(self._getWatchers())
+
+    @classmethod
+    def _union(cls, watchers):
+        ret = set()
+        for instanceIds in watchers.values():
+            ret.update(instanceIds)
+        return ret
+
+    def _getWatchers(self):
+        """
+        Return a dictionary mapping the registration of every job waiting
+        on instances to the set of instance ids it waits on
+        """
+        ret = {}
+        for fileName in os.listdir(self.stateDir):
+            if not fileName.startswith('watch-'):
+                continue
+            path = os.path.join(self.stateDir, fileName)
+            pid = int(fileName.split('-')[1])
+            if not self._isAlive(pid):
+                # Left behind by a dead job
+                util.removeIfExists(path)
+                continue
+            try:
+                ret[fileName] = set(json.load(file(path)))
+            except (IOError, ValueError):
+                # Just removed, or still being written
+                continue
+        return ret
+
+    @classmethod
+    def _isAlive(cls, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _tryLock(self):
+        lockf = file(self._lockPath, "a")
+        try:
+            fcntl.flock(lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lockf.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return lockf
+
+    def _readState(self):
+        try:
+            return json.load(file(self._statePath))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        return None
+
+    def _writeState(self, version, instanceIds, instances, errors=None):
+        state = dict(version=version, polled=sorted(instanceIds),
+            instances=self._toDict(instances), errors=errors or {})
+        fd, tmpPath = tempfile.mkstemp(dir=self.stateDir, prefix='.state-')
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.rename(tmpPath, self._statePath)
+
+    @classmethod
+    def _getInstances(cls, state, instanceIds):
+        return [ InstanceState(k, **dict((str(x), y) for (x, y) in v.items()))
+            for (k, v) in sorted(state['instances'].items())
+                if k in instanceIds ]
+
+class Backoff(object):
+    """
+    Poll interval that doubles, up to a maximum, while nothing changes
+    """
+    __slots__ = [ 'initial', 'maximum', 'current', ]
+
+    def __init__(self, initial, maximum):
+        self.initial = self.current = initial
+        self.maximum = maximum
+
+    def unchanged(self):
+        self.current = min(self.current * 2, self.maximum)
+
+    def reset(self):
+        self.current = self.initial
@@ -65,7 +65,69 @@ class ApplianceUpdateJobStore(CatalogJobStore):
     resultClass = unicode
 
 class CatalogSqlJobStore(rpath_job.SqlJobStore):
-    pass
+    # Joins the jobs table with the target a job ran against, so listJobs
+    # can filter on the target's type and name
+    _targetJoin = """
+        JOIN job_target ON (job_target.job_id = jobs.job_id)
+        JOIN Targets ON (Targets.targetId = job_target.targetId)
+        JOIN target_types ON
+            (target_types.target_type_id = Targets.target_type_id)"""
+
+    def __init__(self, db, *args, **kwargs):
+        rpath_job.SqlJobStore.__init__(self, db, *args, **kwargs)
+        self._restDb = db
+
+    def listJobs(self, cloudType=None, cloudName=None, status=None,
+            start=0, limit=None):
+        """
+        Return the jobs of this store's type matching the filters, oldest
+        first. The first start jobs are skipped, and at most limit jobs are
+        returned.
+        Returns a tuple (jobs, more), more is True if there are jobs past
+        the returned page.
+        The queries rely on indexes of the rBuilder jobs schema that this
+        tree does not create; see "Database requirements" in README.md.
+        """
+        joins = []
+        where = [ """jobs.job_type_id =
+            (SELECT job_type_id FROM job_types WHERE name = ?)""" ]
+        args = [ self.jobType ]
+        if status is not None:
+            where.append("""jobs.job_state_id =
+                (SELECT job_state_id FROM job_states WHERE name = ?)""")
+            args.append(status)
+        if cloudType is not None or cloudName is not None:
+            joins.append(self._targetJoin)
+            if cloudType is not None:
+                where.append("target_types.name = ?")
+                args.append(cloudType)
+            if cloudName is not None:
+                where.append("Targets.name = ?")
+                args.append(cloudName)
+        sql = """
+            SELECT jobs.job_id FROM jobs %s
+             WHERE %s
+             ORDER BY jobs.created, jobs.job_id""" % (
+                ' '.join(joins), ' AND '.join(where))
+        if limit is not None:
+            # One extra row tells us if there is a next page
+            sql += " LIMIT %d OFFSET %d" % (limit + 1, start)
+        cu = self._restDb.cursor()
+        cu.execute(sql, *args)
+        jobIds = [ x[0] for x in cu ]
+        if limit is None:
+            # OFFSET without LIMIT is not portable
+            jobIds = jobIds[start:]
+            more = False
+        else:
+            more = len(jobIds) > limit
+            jobIds = jobIds[:limit]
+        ret = []
+        for jobId in jobIds:
+            job = self.get(str(jobId), readOnly=True)
+            if job is not None:
+                ret.append(job)
+        return ret, more
 
 class LaunchJobSqlStore(CatalogSqlJobStore):
     jobType = LaunchJobStore.jobType
@@ -77,14 +139,23 @@ class DeployImageJobSqlStore(LaunchJobSqlStore):
     jobType = DeployImageJobStore.jobType
     jobFactory = LaunchJobSqlStore.jobFactory
 
-class ApplianceVersionUpdateJobSqlStore(CatalogSqlJobStore):
+class ManagedSystemsSqlStore(CatalogSqlJobStore):
+    BackingStore = rpath_job.ManagedSystemsSqlBacking
+    _targetJoin = """
+        JOIN job_managed_system ON (job_managed_system.job_id = jobs.job_id)
+        JOIN inventory_system_target ON
+            (inventory_system_target.managed_system_id =
+                job_managed_system.managed_system_id)
+        JOIN Targets ON (Targets.targetId = inventory_system_target.target_id)
+        JOIN target_types ON
+            (target_types.target_type_id = Targets.target_type_id)"""
+
+class ApplianceVersionUpdateJobSqlStore(ManagedSystemsSqlStore):
     jobType = ApplianceVersionUpdateJobStore.jobType
     jobFactory = VersionUpdateLaunchJob
     resultClass = unicode
-    BackingStore = rpath_job.ManagedSystemsSqlBacking
 
-class ApplianceUpdateJobSqlStore(CatalogSqlJobStore):
+class ApplianceUpdateJobSqlStore(ManagedSystemsSqlStore):
     jobType = ApplianceUpdateJobStore.jobType
     jobFactory = InstanceUpdateJob
     resultClass = unicode
-    BackingStore = rpath_job.ManagedSystemsSqlBacking
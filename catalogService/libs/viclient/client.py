@@ -1319,7 +1319,8 @@ class VimService(object):
             createImportSpecResult.get_element_importSpec())
         return fileItems, httpNfcLease
 
-    def ovfUpload(self, httpNfcLease, archive, prefix, fileItems):
+    def ovfUpload(self, httpNfcLease, archive, prefix, fileItems,
+            verify=None):
         httpNfcLeaseInfo = self.getMoRefProp(httpNfcLease, 'info')
         deviceUrls = httpNfcLeaseInfo.get_element_deviceUrl()
         vmMor = httpNfcLeaseInfo.get_element_entity()
@@ -1351,6 +1352,9 @@ class VimService(object):
                 method, url = pathToUrlMap[path]
                 vmutils._putFile(fobj, url, session=None, method=method)
                 del pathToUrlMap[path]
+            if verify is not None:
+                # Abort the lease if the content is not what we expected
+                verify()
             self.leaseComplete(httpNfcLease)
         except:
             err = SavedException()
@@ -0,0 +1,178 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Cache of target listings (images, instances) shared by all processes.
+
+Drivers only live for one request, so without a cache every request, in
+every web server child and every job runner, queries the target again. The
+cache is a sqlite database: entries are keyed by target, a digest of the
+credentials used to query it, and the kind of listing, and hold the
+pickled listing. Entries expire after TTL seconds, the oldest ones are
+evicted when the cache grows past MAX_SIZE bytes, and all the entries of a
+target can be dropped when the listings are known to have changed (see
+invalidate).
+"""
+
+import cPickle
+import os
+import sqlite3
+import time
+
+from conary.lib import util
+
+class ListingCache(object):
+    # Number of seconds a listing is served from the cache
+    DEFAULT_TTL = 60
+    # Total size (in bytes) of the cached listings. The oldest entries get
+    # evicted first
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+    TIMEOUT = 30
+
+    def __init__(self, path, ttl=None, maxSize=None):
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        if maxSize is None:
+            maxSize = self.DEFAULT_MAX_SIZE
+        self.path = path
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self._db = None
+
+    def _getDb(self):
+        if self._db is not None:
+            return self._db
+        util.mkdirChain(os.path.dirname(self.path))
+        db = sqlite3.connect(self.path, timeout=self.TIMEOUT,
+            isolation_level=None)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS listings (
+                target          TEXT NOT NULL,
+                credentials     TEXT NOT NULL,
+                kind            TEXT NOT NULL,
+                created         REAL NOT NULL,
+                etag            TEXT,
+                size            INTEGER NOT NULL,
+                data            BLOB NOT NULL,
+                PRIMARY KEY (target, credentials, kind)
+            )""")
+        db.execute("""
+            CREATE INDEX IF NOT EXISTS listings_created_idx
+                ON listings (created)""")
+        self._db = db
+        return db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, target, credentials, kind, now=None):
+        """
+        Return a tuple (etag, listing, created) for a fresh entry, or
+        None. Every call returns a new copy of the listing.
+        """
+        row = self._getFresh("etag, data, created", target, credentials,
+            kind, now)
+        if row is None:
+            return None
+        try:
+            listing = cPickle.loads(str(row[1]))
+        except Exception:
+            # Classes may have changed since the entry was written
+            self.invalidate(target, [ kind ])
+            return None
+        return row[0], listing, row[2]
+
+    def getEtag(self, target, credentials, kind, now=None):
+        """
+        Return the entity tag of a fresh entry, without reading the
+        listing. None if the entry is missing, stale or untagged.
+        """
+        row = self._getFresh("etag", target, credentials, kind, now)
+        if row is None:
+            return None
+        return row[0]
+
+    def _getFresh(self, columns, target, credentials, kind, now):
+        if now is None:
+            now = time.time()
+        cu = self._getDb().execute("""
+            SELECT %s FROM listings
+             WHERE target = ? AND credentials = ? AND kind = ?
+               AND created > ?""" % columns,
+            (target, credentials, kind, now - self.ttl))
+        return cu.fetchone()
+
+    def set(self, target, credentials, kind, listing, etag=None, now=None):
+        """
+        Cache listing. Returns False if the listing cannot be pickled or
+        is larger than the cache.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            data = cPickle.dumps(listing, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return False
+        if len(data) > self.maxSize:
+            return False
+        db = self._getDb()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("""
+                INSERT OR REPLACE INTO listings
+                    (target, credentials, kind, created, etag, size, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (target, credentials, kind, now, etag, len(data),
+                    sqlite3.Binary(data)))
+            self._evict(db, now)
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return True
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM listings WHERE created <= ?",
+            (now - self.ttl, ))
+        total = db.execute("SELECT SUM(size) FROM listings").fetchone()[0]
+        if not total or total <= self.maxSize:
+            return
+        cu = db.execute("""
+            SELECT rowid, size FROM listings
+             ORDER BY created""")
+        toDelete = []
+        for rowid, size in cu:
+            if total <= self.maxSize:
+                break
+            toDelete.append((rowid, ))
+            total -= size
+        db.executemany("DELETE FROM listings WHERE rowid = ?", toDelete)
+
+    def invalidate(self, target, kinds=None):
+        """
+        Drop the listings of target, for all credentials. If kinds is
+        specified, only the listings of these kinds are dropped.
+        """
+        db = self._getDb()
+        if kinds is None:
+            db.execute("DELETE FROM listings WHERE target = ?", (target, ))
+            return
+        db.executemany("""
+            DELETE FROM listings
+             WHERE target = ? AND kind = ?""",
+            [ (target, x) for x in kinds ])
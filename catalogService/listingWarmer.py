@@ -0,0 +1,350 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Background refresh of target listings.
+
+Targets (with the credentials used to query them) are registered with the
+warmer every time their listings are requested. Until a target has not
+been used for IDLE_TIMEOUT seconds, the warmer calls refresh for it every
+INTERVAL seconds, so the listing cache stays warm and users do not wait
+for the target. Refreshes are brought forward by a random fraction of the
+interval (JITTER), so targets registered together drift apart, and only a
+bounded number of refreshes run at the same time, overall and per target.
+
+The warmer runs as a thread of a long-lived process. Targets used by other
+processes (for instance, tasks forked off that process) are registered
+with a SharedRegistry instead, which hands them over to the warmer's
+process. Registrations carry what is needed to query the target, cloud
+credentials included, so they are only ever kept in memory.
+"""
+
+import cPickle
+import errno
+import os
+import random
+import select
+import socket
+import threading
+import time
+
+from conary.lib import util
+
+class SharedRegistry(object):
+    """
+    Channel through which processes on the host register targets with the
+    warmer of another process. Registrations are sent as datagrams to a
+    unix socket the warmer's process listens on (see listen), in a
+    directory only the owner can access. Nothing is written to disk:
+    registrations made while no one listens are dropped.
+    """
+    # Longest registration accepted
+    MAX_SIZE = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+
+    def add(self, target, credentialsId, payload, now=None):
+        """
+        Register a target, or mark it as used. Returns False if the
+        registration could not be handed over (the payload cannot be
+        pickled, or no warmer listens).
+        """
+        if now is None:
+            now = time.time()
+        try:
+            data = cPickle.dumps((target, credentialsId, payload, now),
+                cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return False
+        if len(data) > self.MAX_SIZE:
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.sendto(data, self.path)
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+        return True
+
+    def listen(self):
+        """
+        Start accepting registrations in this process
+        """
+        if self._sock is not None:
+            return
+        topDir = os.path.dirname(self.path)
+        util.mkdirChain(topDir)
+        os.chmod(topDir, 0700)
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        self._sock = sock
+
+    def close(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+
+    def receive(self, timeout=0):
+        """
+        Return the (target, credentialsId, payload, lastUsed)
+        registrations received, waiting up to timeout seconds for the
+        first one
+        """
+        ret = []
+        sock = self._sock
+        if sock is None:
+            return ret
+        while 1:
+            try:
+                ready = select.select([ sock ], [], [], timeout)[0]
+            except (select.error, socket.error):
+                # Closed from another thread
+                return ret
+            if not ready:
+                return ret
+            timeout = 0
+            try:
+                data = sock.recv(self.MAX_SIZE)
+                ret.append(cPickle.loads(data))
+            except socket.error:
+                return ret
+            except Exception:
+                # Not a registration
+                continue
+
+class ListingWarmer(object):
+    # Seconds between two refreshes of the same target and credentials
+    INTERVAL = 45
+    # Refreshes are brought forward by up to this fraction of INTERVAL
+    JITTER = 0.1
+    # Maximum number of refreshes running at the same time
+    CONCURRENCY = 4
+    # Maximum number of refreshes running against the same target
+    TARGET_CONCURRENCY = 1
+    # Targets not used for this many seconds are no longer refreshed
+    IDLE_TIMEOUT = 1800
+    # Longest time the background thread sleeps between two checks
+    POLL_INTERVAL = 30
+
+    class Entry(object):
+        __slots__ = [ 'target', 'credentialsId', 'payload', 'lastUsed',
+            'nextRefresh', ]
+        def __init__(self, target, credentialsId, payload, lastUsed,
+                nextRefresh):
+            self.target = target
+            self.credentialsId = credentialsId
+            self.payload = payload
+            self.lastUsed = lastUsed
+            self.nextRefresh = nextRefresh
+
+    def __init__(self, refresh, interval=None, jitter=None, concurrency=None,
+            targetConcurrency=None, idleTimeout=None, log=None,
+            registry=None):
+        """
+        refresh is called with a target and the payload it was registered
+        with, and is expected to store fresh listings in the cache.
+        If registry (a SharedRegistry) is specified, targets registered
+        with it are refreshed too.
+        """
+        self.refresh = refresh
+        self.registry = registry
+        if interval is not None:
+            self.INTERVAL = interval
+        if jitter is not None:
+            self.JITTER = jitter
+        if concurrency is not None:
+            self.CONCURRENCY = concurrency
+        if targetConcurrency is not None:
+            self.TARGET_CONCURRENCY = targetConcurrency
+        if idleTimeout is not None:
+            self.IDLE_TIMEOUT = idleTimeout
+        if log is None:
+            log = lambda *args, **kwargs: None
+        self.log = log
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._threads = None
+        self._stop = threading.Event()
+
+    def add(self, target, credentialsId, payload, now=None):
+        """
+        Register a target, or mark it as used. The caller just fetched
+        the listings, so the first refresh is due after one interval.
+        """
+        if now is None:
+            now = time.time()
+        key = (target, credentialsId)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = self.Entry(target, credentialsId,
+                    payload, now, self._nextRefresh(now))
+                return
+            entry.payload = payload
+            entry.lastUsed = now
+
+    def sync(self, timeout=0):
+        """
+        Add the targets registered with the shared registry, waiting up
+        to timeout seconds for the first registration
+        """
+        if self.registry is None:
+            return
+        for target, credentialsId, payload, lastUsed in \
+                self.registry.receive(timeout=timeout):
+            self.add(target, credentialsId, payload, now=lastUsed)
+
+    def _nextRefresh(self, now):
+        return now + self.INTERVAL * (1 - self.JITTER * random.random())
+
+    def getDue(self, now=None):
+        """
+        Return the entries due for a refresh at time now, most overdue
+        first. Entries that have been idle for too long are dropped.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for key, entry in self._entries.items():
+                if now - entry.lastUsed >= self.IDLE_TIMEOUT:
+                    del self._entries[key]
+            due = [ x for x in self._entries.values()
+                if x.nextRefresh <= now ]
+        due.sort(key=lambda x: x.nextRefresh)
+        return due
+
+    def runOnce(self, now=None):
+        """
+        Refresh all the entries due at time now. Returns the number of
+        refreshes that failed.
+        """
+        if now is None:
+            now = time.time()
+        pending = self.getDue(now=now)
+        if not pending:
+            return 0
+        total = len(pending)
+        cond = threading.Condition()
+        running = {}
+        failures = []
+        workers = [ threading.Thread(target=self._worker,
+                args=(pending, running, cond, now, failures))
+            for i in range(min(self.CONCURRENCY, total)) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.log("Refreshed listings: %d targets, %d failed" %
+            (total, len(failures)))
+        return len(failures)
+
+    def _worker(self, pending, running, cond, now, failures):
+        while 1:
+            with cond:
+                while 1:
+                    if not pending:
+                        return
+                    entry = self._pick(pending, running)
+                    if entry is not None:
+                        break
+                    cond.wait()
+                running[entry.target] = running.get(entry.target, 0) + 1
+            try:
+                self.refresh(entry.target, entry.payload)
+            except Exception, e:
+                self.log("Error refreshing listings for %s: %s" %
+                    (entry.target, e))
+                failures.append(entry)
+            with cond:
+                running[entry.target] -= 1
+                # Failed refreshes are retried one interval later too
+                entry.nextRefresh = self._nextRefresh(now)
+                cond.notifyAll()
+
+    def _pick(self, pending, running):
+        for i, entry in enumerate(pending):
+            if running.get(entry.target, 0) < self.TARGET_CONCURRENCY:
+                del pending[i]
+                return entry
+        return None
+
+    def run(self):
+        """
+        Refresh due entries until stop is called
+        """
+        while not self._stop.isSet():
+            try:
+                self.runOnce()
+            except Exception, e:
+                self.log("Error refreshing listings: %s" % e)
+            with self._lock:
+                nextRefresh = min([ x.nextRefresh
+                    for x in self._entries.values() ] or [ None ])
+            delay = self.POLL_INTERVAL
+            if nextRefresh is not None:
+                delay = max(0, min(delay, nextRefresh - time.time()))
+            self._stop.wait(delay)
+
+    def receive(self):
+        """
+        Add the targets registered with the shared registry until stop is
+        called
+        """
+        while not self._stop.isSet():
+            try:
+                self.sync(timeout=1)
+            except Exception, e:
+                self.log("Error receiving registrations: %s" % e)
+                self._stop.wait(1)
+
+    def start(self):
+        """
+        Start refreshing in a background thread, if not already started.
+        Registrations from other processes are received by another thread.
+        """
+        with self._lock:
+            if self._threads is not None:
+                return
+            self._stop.clear()
+            threads = [ threading.Thread(target=self.run,
+                name="ListingWarmer") ]
+            if self.registry is not None:
+                self.registry.listen()
+                threads.append(threading.Thread(target=self.receive,
+                    name="ListingWarmerRegistry"))
+            for thread in threads:
+                thread.setDaemon(True)
+                thread.start()
+            self._threads = threads
+
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, None
+        self._stop.set()
+        for thread in threads or []:
+            thread.join()
+        if self.registry is not None:
+            self.registry.close()
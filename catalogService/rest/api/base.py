@@ -43,6 +43,17 @@ class BaseCloudController(BaseGenericController):
             return XmlStringResponse(msg, status=403)
         return XmlStringResponse(msg, status = 401)
 
+    @classmethod
+    def _withAge(cls, drv, listing, resp):
+        """
+        Let the client know how stale a listing served from the listing
+        cache is
+        """
+        age = drv.getListingAge(listing)
+        if age is not None:
+            resp.headers['Age'] = str(age)
+        return resp
+
     def getController(self, *args, **kwargs):
         # Reset target configuration
         self.driver._targetConfig = None
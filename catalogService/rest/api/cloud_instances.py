@@ -26,13 +26,19 @@ from catalogService.rest.api.base import BaseCloudController
 from catalogService.rest.api import trove_change
 from catalogService.rest.middleware import auth
 from catalogService.rest.middleware.response import XmlResponse, XmlStringResponse, XmlSerializableObjectResponse
+from catalogService.rest.middleware import response
 
 class ImagesController(BaseCloudController):
     modelName = 'imageId'
 
     def index(self, request, cloudName):
-        imgNodes = self.driver(request, cloudName).getAllImages()
-        return XmlResponse(imgNodes)
+        drv = self.driver(request, cloudName)
+        etag = drv.getCachedListingEtag('images')
+        if etag is not None and response.etagMatches(request, etag):
+            return response.NotModifiedResponse(etag)
+        imgNodes = drv.getAllImages()
+        return self._withAge(drv, 'images',
+            response.conditionalXmlResponse(request, imgNodes))
 
     def get(self, request, cloudName, imageId):
         images = self.driver(request, cloudName).getImages([imageId])
@@ -91,8 +97,13 @@ class InstancesController(BaseCloudController):
 
     modelName = 'instanceId'
     def index(self, request, cloudName):
-        insts = self.driver(request, cloudName).getAllInstances()
-        return XmlResponse(insts)
+        drv = self.driver(request, cloudName)
+        etag = drv.getCachedListingEtag('instances')
+        if etag is not None and response.etagMatches(request, etag):
+            return response.NotModifiedResponse(etag)
+        insts = drv.getAllInstances()
+        return self._withAge(drv, 'instances',
+            response.conditionalXmlResponse(request, insts))
 
     def get(self, request, cloudName, instanceId):
         insts = self.driver(request, cloudName).getInstance(instanceId)
@@ -112,7 +123,11 @@ class InstancesController(BaseCloudController):
         return XmlResponse(job)
 
     def destroy(self, request, cloudName, instanceId):
-        insts = self.driver(request, cloudName).terminateInstance(instanceId)
+        drv = self.driver(request, cloudName)
+        try:
+            insts = drv.terminateInstance(instanceId)
+        finally:
+            drv.invalidateListings(['instances'])
         return XmlResponse(insts)
 
     def update(self, request, cloudName, instanceId):
@@ -151,12 +166,12 @@ class ConfigurationController(BaseCloudController):
 class LaunchDescriptorController(BaseCloudController):
     def index(self, request, cloudName):
         descr = self.driver(request, cloudName).getLaunchDescriptor()
-        return XmlSerializableObjectResponse(descr)
+        return response.conditionalSerializableObjectResponse(request, descr)
 
 class ImageDeploymentDescriptorController(BaseCloudController):
     def index(self, request, cloudName):
         descr = self.driver(request, cloudName).getImageDeploymentDescriptor()
-        return XmlSerializableObjectResponse(descr)
+        return response.conditionalSerializableObjectResponse(request, descr)
 
 class DescriptorController(BaseCloudController):
     urls = dict(launch = LaunchDescriptorController,
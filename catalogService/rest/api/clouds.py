@@ -16,12 +16,14 @@
 #
 
 
+from catalogService import nodeFactory
 from catalogService.rest.models import cloud_types
 
 from catalogService.rest.api import cloud_help
 from catalogService.rest.api import cloud_instances
 from catalogService.rest.api import descriptor_controllers
 from catalogService.rest.api.base import BaseController, BaseCloudController
+from catalogService.rest import drivers
 from catalogService.rest.middleware.response import XmlResponse
 
 class CloudTypeController(BaseCloudController):
@@ -31,29 +33,31 @@ class CloudTypeController(BaseCloudController):
         'help' : cloud_help.CloudHelpController,
     }
 
-SUPPORTED_MODULES = [ 'ec2', 'eucalyptus', 'openstack', 'vcloud', 'vmware', 'xenent' ]
-
 class AllCloudController(BaseController):
 
     def index(self, request):
+        # Answered from the driver registry, listing the cloud types does
+        # not import the drivers
         cloudTypeNodes = cloud_types.CloudTypes()
+        factory = nodeFactory.NodeFactory(
+            cloudTypeFactory = cloud_types.CloudType,
+            baseUrl = request.baseUrl)
         for cloudType, cloudController in sorted(self.urls.items()):
             if not cloudController.driver.isDriverFunctional():
                 continue
-            cloudTypeNodes.append(cloudController.driver(request).getCloudType())
+            factory.cloudType = cloudType
+            cloudTypeNodes.append(factory.newCloudType(
+                id = cloudType, cloudTypeName = cloudType))
         return XmlResponse(cloudTypeNodes)
 
     def loadCloudTypes(self):
+        # Drivers are only imported when first used, so processes serving
+        # a single cloud type do not pay for the client libraries of the
+        # others
         self.urls = {}
-        moduleDir =  __name__.rsplit('.', 2)[0] + '.drivers'
-        for driverName in SUPPORTED_MODULES:
-            # FIXME: I'm not sure why putting driver here instead of drivers
-            # allows it this to work.
-            driverClass = __import__('%s.%s' % (moduleDir, driverName),
-                                      {}, {}, ['driver']).driver
-            # XXX we should make this a class method
-            cloudType = driverClass.cloudType
-            driver = driverClass(self.storageCfg, driverName, db = self.db)
-            controller =  CloudTypeController(self, cloudType,
+        for info in drivers.DRIVERS:
+            driver = drivers.LazyDriver(info, self.storageCfg,
+                info.driverName, db = self.db)
+            controller =  CloudTypeController(self, info.cloudType,
                                               driver, self.storageCfg, self.db)
-            self.urls[cloudType] = controller
+            self.urls[info.cloudType] = controller
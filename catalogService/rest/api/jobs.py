@@ -17,8 +17,10 @@
 
 
 from lxml import etree
+import urllib
 import urlparse
 
+from catalogService import errors
 from catalogService import nodeFactory
 from catalogService.rest.api import base
 from catalogService.rest.middleware.response import (XmlResponse,
@@ -49,6 +51,10 @@ class BaseFilter(object):
             if self.match(obj) is not None:
                 yield obj
 
+    def getCriteria(self):
+        return dict((k, v) for (k, v) in self._filterCriteria
+            if v is not None)
+
 class JobFilter(BaseFilter):
     _filterFields = set(['cloudName', 'cloudType', 'status'])
 
@@ -72,13 +78,49 @@ class JobTypeController(base.BaseController):
         self._setStore(jobType)
         # Build filter object, passing in the query arguments
         filter = JobFilter(request.GET)
-        storedJobs = filter.matchIterator(
-            self.jobStore.enumerate(readOnly=True))
+        start, limit = self._getPaging(request)
+        # Filtering, sorting and paging are done by the database
+        storedJobs, more = self.jobStore.listJobs(start=start, limit=limit,
+            **filter.getCriteria())
         storedJobs = (self.jobModelFromJob(request, j, jobType)
-            for j in sorted(storedJobs, key = lambda x: x.created))
+            for j in storedJobs)
         ret = jobmodels.Jobs()
         ret.addJobs(storedJobs)
-        return XmlSerializableObjectResponse(ret)
+        response = XmlSerializableObjectResponse(ret)
+        if limit is not None:
+            self._addPagingHeaders(request, response, jobType, filter,
+                start, limit, more)
+        return response
+
+    @classmethod
+    def _getPaging(cls, request):
+        try:
+            start = int(request.GET.get('start', 0))
+            limit = request.GET.get('limit')
+            if limit is not None:
+                limit = int(limit)
+        except ValueError:
+            raise errors.ParameterError("start and limit must be integers")
+        if start < 0 or (limit is not None and limit < 0):
+            raise errors.ParameterError("start and limit must not be negative")
+        return start, limit
+
+    def _addPagingHeaders(self, request, response, jobType, filter,
+            start, limit, more):
+        baseUrl = self.url(request, 'jobs', 'types', jobType, 'jobs')
+        def pageUrl(pageStart):
+            params = sorted(filter.getCriteria().items())
+            params.extend([ ('start', pageStart), ('limit', limit) ])
+            return "%s?%s" % (baseUrl, urllib.urlencode(params))
+        links = []
+        if more:
+            links.append('<%s>; rel="next"' % pageUrl(start + limit))
+        if start > 0:
+            links.append('<%s>; rel="prev"' % pageUrl(max(0, start - limit)))
+        if links:
+            response.headers['Link'] = ', '.join(links)
+        response.headers['X-Page-Start'] = str(start)
+        response.headers['X-Page-Limit'] = str(limit)
 
     class XmlPassThrough(object):
         def __init__(self, doc):
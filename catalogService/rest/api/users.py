@@ -24,6 +24,7 @@ from catalogService.rest.models import userData
 from catalogService import storage
 from catalogService.rest.api.base import BaseController
 from catalogService.rest.middleware.response import XmlStringResponse, XmlResponse
+from catalogService.rest.middleware.response import conditionalResponse
 
 class UsersController(BaseController):
     modelName = 'userId'
@@ -33,7 +34,9 @@ class UsersController(BaseController):
         path = os.sep.join([self.storageCfg.storagePath, 'userData',
             self._sanitizeKey(request.auth[0])])
         cfg = storage.StorageConfig(storagePath = path)
-        return storage.DiskStorage(cfg)
+        packPath = os.sep.join([self.storageCfg.storagePath, 'userData-packed',
+            self._sanitizeKey(request.auth[0])])
+        return storage.PackedDiskStorage(cfg, packPath)
 
     @classmethod
     def _sanitizeKey(cls, key):
@@ -79,19 +82,22 @@ class UsersController(BaseController):
                 #raise Exception("XXX 2", prefix, keyPath)
 
         if store.isCollection(key):
-            node = userData.IdsNode()
-            snodes = store.enumerate(keyPrefix = key)
+            # All keys and values come from a single packed read
+            etag, items = store.getCollection(key)
 
             if key == keyPath:
                 # No trailing /
-                snodes = [ userData.IdNode().characters("%s%s" % (prefix, x))
-                         for x in snodes ]
-                node.extend(snodes)
-                return XmlResponse(node)
+                def factory():
+                    node = userData.IdsNode()
+                    node.extend([ userData.IdNode().characters(
+                        "%s%s" % (prefix, x)) for (x, _) in items ])
+                    return XmlResponse(node)
+                return conditionalResponse(request, etag, factory)
             # Grab contents and wrap them in some XML
-            data = [ store.get(x) for x in snodes ]
-            data = xmlHeader + '<list>%s</list>' % ''.join(data)
-            return XmlStringResponse(data)
+            def factory():
+                data = ''.join(x[1] for x in items)
+                return XmlStringResponse(xmlHeader + '<list>%s</list>' % data)
+            return conditionalResponse(request, etag, factory)
         else:
             data = store.get(key)
             if data is None:
@@ -17,8 +17,10 @@
 
 import os
 import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -26,14 +28,17 @@ import urllib2
 import requests
 import weakref
 import gzip
-from StringIO import StringIO
 
 from conary.lib import magic, util, sha1helper
 
+from catalogService import clientPool
 from catalogService import errors
+from catalogService import imageCache
 from catalogService import instanceStore
+from catalogService import instanceWaiter
 from catalogService import nodeFactory as nodeFactoryMod
 from catalogService import jobs
+from catalogService import listingCache
 from catalogService import storage
 from catalogService.rest.models import clouds
 from catalogService.rest.models import cloud_types
@@ -44,9 +49,13 @@ from catalogService.rest.models import instances
 from catalogService.rest.models import jobs as jobmodels
 from catalogService.rest.models import keypairs
 from catalogService.rest.models import securityGroups
+from catalogService.rest.models import xmlNode
+from catalogService.utils import isoimage
 from catalogService.utils import timeutils
 from catalogService.utils import x509
 from catalogService.utils.progress import StreamWithProgress, PercentageCallback
+from catalogService.utils.progress import StreamWithDigest
+from catalogService.utils.progress import CoalescingHistory
 
 from mint.mint_error import TargetExists, TargetMissing
 
@@ -81,6 +90,10 @@ class BaseDriver(object):
 
     instanceStorageClass = storage.DiskStorage
 
+    # Process-wide pool of authenticated clients. Set to None to create a
+    # new client for every driver instance.
+    cloudClientPool = clientPool.pool
+
     HistoryEntry = jobs.HistoryEntry
 
     # Timeout for waiting for an instance to show up as running
@@ -93,6 +106,21 @@ class BaseDriver(object):
     WAIT_NETWORK_SLEEP = 10
 
     ImageDownloadUrlMapFile = "/srv/rbuilder/imageDownloadUrlMap"
+    # Number of concurrent connections used to download an image, if the
+    # server supports range requests
+    DOWNLOAD_CONNECTIONS = 4
+    # Size budget for the local cache of downloaded images. Set to 0 to
+    # disable the cache
+    IMAGE_CACHE_SIZE = imageCache.ImageCache.DEFAULT_MAX_SIZE
+    # Verify the checksums of downloaded images before registering them
+    VERIFY_IMAGE_CHECKSUMS = True
+    # Number of launch certificates to generate ahead of time. Set to 0 to
+    # generate them synchronously, at launch time
+    X509_POOL_DEPTH = x509.X509Pool.DEFAULT_DEPTH
+    # Number of seconds image and instance listings are served from the
+    # listing cache shared by all processes. Set to 0 to always query the
+    # target
+    LISTING_CACHE_TTL = listingCache.ListingCache.DEFAULT_TTL
 
     def __init__(self, cfg, driverName=None, cloudName=None,
                  nodeFactory=None, userId = None, db = None,
@@ -120,6 +148,14 @@ class BaseDriver(object):
         self._bootUuid = None
         self._rootSshKeys = None
         self._targetConfig = None
+        self._progressHistory = {}
+        # Progress may be reported from helper threads (e.g. the grain
+        # writer of the VMDK reader); history entries are written one at
+        # a time
+        self._historyLock = threading.RLock()
+        self._listingCache = None
+        self._listingAges = {}
+        self._listingMintImages = None
 
         if inventoryHandler is None:
             inventoryHandler = self.InventoryHandler(weakref.ref(self))
@@ -161,12 +197,20 @@ class BaseDriver(object):
     def _getInstanceStore(self):
         keyPrefix = '%s/%s' % (self._sanitizeKey(self.cloudName),
                                self._getUserIdForInstanceStore())
+        storeClass = self.instanceStorageClass
+        store = instanceStore.SqliteInstanceStore(
+            instanceStore.SqliteInstanceStore.getPath(self._cfg.storagePath,
+                self.cloudType),
+            keyPrefix,
+            keyGenerator=lambda: storeClass._generateString(6))
+
+        # Bring over instances still kept in the old per-field layout
         path = os.path.join(self._cfg.storagePath, 'instances',
             self.cloudType)
-        cfg = storage.StorageConfig(storagePath = path)
-
-        dstore = self.instanceStorageClass(cfg)
-        return instanceStore.InstanceStore(dstore, keyPrefix)
+        if os.path.isdir(os.path.join(path, keyPrefix)):
+            cfg = storage.StorageConfig(storagePath = path)
+            store.migrate(storeClass(cfg))
+        return store
 
     def _getUserIdForInstanceStore(self):
         return self._sanitizeKey(self.userId)
@@ -277,18 +321,35 @@ class BaseDriver(object):
     def getAllImages(self):
         return self.getImages(None)
 
+    def getCachedListingEtag(self, listing):
+        """
+        Return the entity tag of the 'images' or 'instances' listing if
+        it is known without contacting the target, None otherwise.
+        """
+        # Image listings are completed with rBuilder data for every
+        # request, only instance listings are cached as served
+        if listing != 'instances' or not self.LISTING_CACHE_TTL:
+            return None
+        if not self.credentials:
+            return None
+        return self._getListingCache().getEtag(
+            *self._getListingCacheKey(listing))
+
     def getImages(self, imageIds):
         if self.client is None:
             raise errors.MissingCredentials("Target credentials not set for user")
         return self.drvGetImages(imageIds)
 
-    def drvGetImages(self, imageIdsFilter):
+    def drvGetImages(self, imageIdsFilter, force=False):
         # The image identifiers in the filter may not match exactly the
         # image IDs from the target, so we need to fetch everything
         # here.
-        imageList = self.getImagesFromTarget(None)
+        # rBuilder is only asked once per listing, for both the target
+        # images to list and the data to add to them
+        mintImages = self._getMintImagesByType(self.RBUILDER_BUILD_TYPE)
+        imageList = self.getTargetImages(force=force, mintImages=mintImages)
         imageList = self.addMintDataToImageList(imageList,
-            self.RBUILDER_BUILD_TYPE)
+            self.RBUILDER_BUILD_TYPE, mintImages=mintImages)
         return self.filterImages(imageIdsFilter, imageList)
 
     def filterImages(self, imageIdsFilter, imageList):
@@ -315,19 +376,182 @@ class BaseDriver(object):
         def get(self, imageId):
             return self._ids.get(imageId)
 
-    def getAllInstances(self):
-        return self.getInstances(None)
+    def getTargetImages(self, force=False, mintImages=None):
+        """
+        Return all the images on the target, without rBuilder data. The
+        listing is served from the listing cache unless force is set.
+        mintImages are the rBuilder images of the listing, if the caller
+        already has them (see getListingMintImages).
+        """
+        def fetch():
+            self._listingMintImages = mintImages
+            try:
+                return self.getImagesFromTarget(None)
+            finally:
+                self._listingMintImages = None
+        return self._getCachedListing('images', fetch, force=force)
+
+    def getListingMintImages(self):
+        """
+        Return the rBuilder images of the target's image type, for drivers
+        that need them to build the image listing. They are only fetched
+        if the listing was not handed them already.
+        """
+        if self._listingMintImages is not None:
+            return self._listingMintImages
+        return self._getMintImagesByType(self.RBUILDER_BUILD_TYPE)
 
-    def getInstances(self, instanceIds):
+    def getAllInstances(self, force=False):
+        return self.getInstances(None, force=force)
+
+    def getInstances(self, instanceIds, force=False):
         if self.client is None:
             raise errors.MissingCredentials("Target credentials not set for user")
-        instances = self.drvGetInstances(instanceIds)
+        if instanceIds is None:
+            return self._getCachedListing('instances',
+                lambda: self.drvGetInstances(None, force=force),
+                force=force, withEtag=True)
+        instances = self.drvGetInstances(instanceIds, force=force)
         return instances
 
+    def drvGetInventoryKey(self, credentials):
+        """
+        Return a key identifying the inventory visible with these
+        credentials. Credentials with the same key see the same instances,
+        so only one of them needs to list them.
+        """
+        return clientPool.ClientPool.makeKey(self.cloudType, self.cloudName,
+            credentials)[2]
+
+    def _getListingCache(self):
+        if self._listingCache is None:
+            self._listingCache = listingCache.ListingCache(
+                os.path.join(self._cfg.storagePath, 'listing-cache.sqlite'),
+                ttl=self.LISTING_CACHE_TTL)
+        return self._listingCache
+
+    def _getListingCacheTarget(self):
+        return '%s/%s' % (self.cloudType, self.cloudName)
+
+    def _getListingCacheKey(self, kind):
+        # Node ids are built from the base URL of the request, so it is
+        # part of the key too
+        poolKey = clientPool.ClientPool.makeKey(self.cloudType,
+            self.cloudName, self.credentials, self.getTargetConfiguration())
+        userKey = ''
+        if kind == 'instances':
+            # Instance names and descriptions come from the rBuilder
+            # images visible to the user, so instance listings are not
+            # shared between users of the same credentials
+            userKey = self.userId or ''
+        credentials = sha1helper.sha1ToString(sha1helper.sha1String(
+            "%s\0%s\0%s" % (poolKey[2], self._nodeFactory.baseUrl,
+                userKey)))
+        return self._getListingCacheTarget(), credentials, kind
+
+    def _getCachedListing(self, kind, fetch, force=False, withEtag=False):
+        """
+        Return the listing of the given kind from the listing cache, or
+        call fetch to build it and cache it. With force, the target is
+        always queried. If withEtag is set, the entity tag of the listing
+        is cached along with it (see getCachedListingEtag).
+        """
+        if not self.LISTING_CACHE_TTL:
+            return fetch()
+        cache = self._getListingCache()
+        key = self._getListingCacheKey(kind)
+        if not force:
+            now = time.time()
+            cached = cache.get(*key, now=now)
+            if cached is not None:
+                self._listingAges[kind] = max(0, int(now - cached[2]))
+                return cached[1]
+        listing = fetch()
+        self._listingAges.pop(kind, None)
+        etag = None
+        if withEtag:
+            # The cached nodes keep their content hashes, so that the
+            # entity tag of the listing is known without serializing it
+            # again
+            xmlNode.freezeXmlNodeHashes(listing)
+            etag = xmlNode.xmlNodeEtag(listing, compute=False)
+        cache.set(*key, listing=listing, etag=etag)
+        return listing
+
+    def getListingAge(self, kind):
+        """
+        Return the age, in seconds, of the listing of the given kind last
+        served from the listing cache by this driver, or None if it came
+        straight from the target.
+        """
+        return self._listingAges.get(kind)
+
+    def refreshListings(self, kinds=None):
+        """
+        Query the target and store fresh 'images' and 'instances'
+        listings in the listing cache, ahead of their expiration.
+        """
+        if kinds is None:
+            kinds = [ 'images', 'instances' ]
+        if 'images' in kinds:
+            self.getTargetImages(force=True)
+        if 'instances' in kinds:
+            self.getAllInstances(force=True)
+
+    def invalidateListings(self, kinds=None):
+        """
+        Drop the cached listings of this target, for all users. Called
+        when the images or instances on the target change.
+        """
+        if not self.LISTING_CACHE_TTL:
+            return
+        self._getListingCache().invalidate(self._getListingCacheTarget(),
+            kinds)
+
+    def _invalidateChangedListings(self, kinds):
+        """
+        Drop the cached listings after images or instances were created
+        on the target. Failing to do so only leaves the listings stale
+        until they expire, so the operation does not fail because of it.
+        """
+        try:
+            self.invalidateListings(kinds)
+        except Exception, e:
+            self.log_error("Error invalidating cached listings: %s" % e)
+
     def _msg(self, job, msg):
-        job.addHistoryEntry(msg)
+        self._flushProgress(job)
+        self._addHistoryEntry(job, msg)
+
+    def _addHistoryEntry(self, job, msg):
+        with self._historyLock:
+            job.addHistoryEntry(msg)
         self.log_debug(msg)
 
+    def _progress(self, job, message, percent):
+        self._progressMsg(job, message, "%s: %d%%" % (message, percent),
+            final=(percent >= 100))
+
+    def _progressMsg(self, job, series, msg, final=False):
+        """
+        Add a progress entry to the job's history. Every history entry is
+        a commit, so entries in the same series are coalesced (see
+        CoalescingHistory); whatever is held back gets written before the
+        next regular entry, or when the job finishes.
+        """
+        key = id(job)
+        with self._historyLock:
+            if key not in self._progressHistory:
+                self._progressHistory[key] = (job, CoalescingHistory(
+                    lambda x: self._addHistoryEntry(job, x)))
+            self._progressHistory[key][1].update(series, msg, final=final)
+
+    def _flushProgress(self, job):
+        with self._historyLock:
+            history = self._progressHistory.pop(id(job), None)
+            if history is not None:
+                history[1].flush()
+
     @classmethod
     def _toStr(cls, obj):
         if obj is None:
@@ -433,7 +657,7 @@ class BaseDriver(object):
         return ret
 
     def reset(self):
-        self._cloudClient = None
+        self._checkInCloudClient()
         self._cloudCredentials = None
         self._bootUuid = None
         self._x509Cert = None
@@ -447,11 +671,73 @@ class BaseDriver(object):
             cred = self.drvGetCloudCredentialsForUser()
             if not cred:
                 return None
-            self._cloudClient = self.drvCreateCloudClient(cred)
+            client = self._getPooledCloudClient(cred)
+            self.drvPrepareCloudClient(client)
+            self._cloudClient = client
         return self._cloudClient
 
     client = property(drvGetCloudClient)
 
+    def _getPooledCloudClient(self, cred):
+        pool = self.cloudClientPool
+        if pool is None:
+            return self.drvCreateCloudClient(cred)
+        key = self._getCloudClientPoolKey(cred)
+        # The client is ours until we check it in, or go away
+        return pool.get(key, lambda: self.drvCreateCloudClient(cred),
+            healthCheck=self.drvIsCloudClientValid,
+            release=self.drvReleaseCloudClient,
+            forget=self.drvForgetCloudClient,
+            owner=self)
+
+    def _checkInCloudClient(self):
+        client, self._cloudClient = self._cloudClient, None
+        pool = self.cloudClientPool
+        if pool is not None and client is not None:
+            pool.checkIn(client)
+
+    def _getCloudClientPoolKey(self, cred):
+        return self.cloudClientPool.makeKey(self.cloudType, self.cloudName,
+            cred, self.getTargetConfiguration())
+
+    def invalidateCloudClient(self):
+        """
+        Drop the current client, and make sure it will not be handed out by
+        the client pool again (e.g. because its session was revoked)
+        """
+        pool = self.cloudClientPool
+        if pool is not None and self._cloudCredentials:
+            pool.invalidate(self._getCloudClientPoolKey(self._cloudCredentials))
+        self._checkInCloudClient()
+
+    def drvPrepareCloudClient(self, client):
+        """
+        Called every time a (new or pooled) client gets attached to this
+        driver instance. Drivers that keep per-instance state derived from
+        the client should initialize it here rather than in
+        drvCreateCloudClient.
+        """
+
+    def drvIsCloudClientValid(self, client):
+        """
+        Called by the client pool for clients that were idle for a while.
+        Return False if the session is no longer usable and we should log in
+        again.
+        """
+        return True
+
+    def drvReleaseCloudClient(self, client):
+        """
+        Called when the client pool drops a client (expired, evicted, or the
+        target was removed). Drivers should log out here.
+        """
+
+    def drvForgetCloudClient(self, client):
+        """
+        Called for every pooled client in a newly forked child process. The
+        sessions belong to the parent, so they should not be logged out.
+        """
+
     def drvValidateCredentials(self, creds):
         self.drvCreateCloudClient(creds)
         return True
@@ -669,6 +955,7 @@ class BaseDriver(object):
             imageDownloadUrl=None, imageData=None):
         image.setBaseFileName(imageFileInfo['baseFileName'])
         image.setChecksum(imageFileInfo.get('sha1'))
+        image._sha256 = imageFileInfo.get('sha256')
         image.setSize(imageFileInfo.get('size'))
         image.setArchitecture(imageFileInfo.get('architecture'))
         image.setDownloadUrl(imageDownloadUrl)
@@ -692,7 +979,10 @@ class BaseDriver(object):
             fromStream=descriptorDataXml, descriptor=descr)
 
         params = self.getDeployImageParameters(image, descriptorData)
-        self.deployImageProcess(job, image, auth=None, **params)
+        try:
+            self.deployImageProcess(job, image, auth=None, **params)
+        finally:
+            self._invalidateChangedListings(['images'])
         return image
 
     def launchSystemSynchronously(self, job, image, descriptorDataXml):
@@ -706,7 +996,12 @@ class BaseDriver(object):
             fromStream=descriptorDataXml, descriptor=descr)
 
         params = self.getLaunchInstanceParameters(image, descriptorData)
-        instanceIdList = self.launchInstanceWrapper(job, image, auth=None, **params)
+        try:
+            instanceIdList = self.launchInstanceWrapper(job, image,
+                auth=None, **params)
+        finally:
+            # Launching may deploy the image too
+            self._invalidateChangedListings(['images', 'instances'])
         return instanceIdList
 
 
@@ -728,7 +1023,7 @@ class BaseDriver(object):
         realInstanceId = self.launchInstanceProcess(job, image, auth,
             **launchParams)
         if not realInstanceId:
-            job.addHistoryEntry('Launch failed, no instance was created')
+            self._msg(job, 'Launch failed, no instance was created')
             return
         # Some drivers (like ec2) may have the ability to launch
         # multiple instances with the same call.
@@ -759,20 +1054,23 @@ class BaseDriver(object):
                     job.status = job.STATUS_FAILED
                     return
                 job.addResults(instanceIds)
-                job.addHistoryEntry('Done')
+                self._msg(job, 'Done')
                 job.status = job.STATUS_COMPLETED
             except errors.CatalogError, e:
                 err = errors.CatalogErrorResponse(e.status,
                     message = e.msg, tracebackData = e.tracebackData,
                     productCodeData = e.productCodeData)
-                job.addHistoryEntry(e.msg)
+                self._msg(job, e.msg)
                 job.setFields([('errorResponse', err.response[0]),
                     ('status', job.STATUS_FAILED)])
             except Exception, e:
-                job.addHistoryEntry(str(e))
+                self._msg(job, str(e))
                 job.status = job.STATUS_FAILED
                 raise
         finally:
+            self._flushProgress(job)
+            # Launching may deploy the image too
+            self._invalidateChangedListings(['images', 'instances'])
             job.pid = None
             job.commit()
             self.launchInstanceInBackgroundCleanup(image, **params)
@@ -785,69 +1083,103 @@ class BaseDriver(object):
             try:
                 realImageId = self.deployImageProcess(job, image, auth, **params)
                 if not realImageId:
-                    job.addHistoryEntry('Image deployment failed, no image was uploaded')
+                    self._msg(job, 'Image deployment failed, no image was uploaded')
                     job.status = job.STATUS_FAILED
                     return
                 if not isinstance(realImageId, list):
                     realImageId = [realImageId]
                 job.addResults(realImageId)
-                job.addHistoryEntry('Done')
+                self._msg(job, 'Done')
                 job.status = job.STATUS_COMPLETED
             except errors.CatalogError, e:
                 err = errors.CatalogErrorResponse(e.status,
                     message = e.msg, tracebackData = e.tracebackData,
                     productCodeData = e.productCodeData)
-                job.addHistoryEntry(e.msg)
+                self._msg(job, e.msg)
                 job.setFields([('errorResponse', err.response[0]),
                     ('status', job.STATUS_FAILED)])
             except Exception, e:
-                job.addHistoryEntry(str(e))
+                self._msg(job, str(e))
                 job.status = job.STATUS_FAILED
                 raise
         finally:
+            self._flushProgress(job)
+            self._invalidateChangedListings(['images'])
             job.pid = None
             job.commit()
             self.deployImageInBackgroundCleanup(image, **params)
 
     def waitForRunningState(self, job, instanceIds):
         # Wait until all instances get out of the PENDING state
-        expired = time.time() + self.LAUNCH_TIMEOUT
-        first = True
-        while time.time() < expired:
-            instances = self.drvGetInstances(instanceIds, force=True)
+        def isPending(instances):
             states = set(x.getState().lower() for x in instances)
-            instanceIds = sorted(x.getInstanceId() for x in instances)
-            msg = ', '.join(instanceIds)
-            if not states.intersection(self.PENDING_STATES):
-                self._msg(job, "Instance(s) running: %s" % msg)
-                return
+            return bool(states.intersection(self.PENDING_STATES))
+        def names(instances):
+            return ', '.join(sorted(x.getInstanceId() for x in instances))
+        first = [ True ]
+        def waiting(instances):
             if first:
-                self._msg(job, "Instance(s): %s" % msg)
-                first = False
+                self._msg(job, "Instance(s): %s" % names(instances))
+                del first[:]
             else:
                 self._msg(job, "Waiting for a running state...")
-            time.sleep(self.WAIT_RUNNING_STATE_SLEEP)
+        instances = self._getInstanceWaiter().wait(instanceIds,
+            lambda x: not isPending(x), self.LAUNCH_TIMEOUT,
+            self.WAIT_RUNNING_STATE_SLEEP, callback=waiting)
+        if not isPending(instances):
+            self._msg(job, "Instance(s) running: %s" % names(instances))
+            return
         results = [ (x.getInstanceId(), x.getState()) for x in instances ]
         msg = '; '.join("Instance %s state: %s" % r for r in results)
         self._msg(job, msg)
 
     def waitForNetwork(self, job, instanceIds):
         # Wait until all instances have a network
-        expired = time.time() + self.LAUNCH_NETWORK_TIMEOUT
-        while time.time() < expired:
-            instances = self.drvGetInstances(instanceIds, force=True)
-            imaps = [ (x, x.getPublicDnsName()) for x in instances ]
-            withNetworks = [ x for (x, y) in imaps if y is not None ]
-            withoutNetworks = [ x for (x, y) in imaps if y is None ]
-            for inst in withNetworks:
-                self._msg(job, "Instance %s: %s" % (
-                    inst.getInstanceId(), inst.getPublicDnsName()))
-            if not withoutNetworks:
-                return
-            instanceIds = sorted(x.getInstanceId() for x in withoutNetworks)
-            msg = ', '.join(instanceIds)
+        reported = set()
+        def hasNetworks(instances):
+            withoutNetworks = False
+            for inst in instances:
+                if inst.getPublicDnsName() is None:
+                    withoutNetworks = True
+                elif inst.getInstanceId() not in reported:
+                    reported.add(inst.getInstanceId())
+                    self._msg(job, "Instance %s: %s" % (
+                        inst.getInstanceId(), inst.getPublicDnsName()))
+            return not withoutNetworks
+        def waiting(instances):
+            msg = ', '.join(sorted(x.getInstanceId() for x in instances
+                if x.getPublicDnsName() is None))
             self._msg(job, "Waiting for network information for %s" % msg)
-            time.sleep(self.WAIT_NETWORK_SLEEP)
+        self._getInstanceWaiter().wait(instanceIds, hasNetworks,
+            self.LAUNCH_NETWORK_TIMEOUT, self.WAIT_NETWORK_SLEEP,
+            callback=waiting)
+
+    def _getInstanceWaiter(self):
+        # Jobs talking to the same target with the same credentials share
+        # the waiter's state
+        key = clientPool.ClientPool.makeKey(self.cloudType, self.cloudName,
+            self._cloudCredentials, self.getTargetConfiguration())
+        key = ("%s\0%s\0%s" % key).encode('utf-8')
+        path = os.path.join(self._cfg.storagePath, 'instance-waiters',
+            sha1helper.sha1ToString(sha1helper.sha1String(key)))
+        return instanceWaiter.InstanceWaiter(self, path, log=self.log_debug)
+
+    def drvWaitForInstanceUpdates(self, instanceIds, timeout):
+        """
+        Block for at most timeout seconds, until the target reports a
+        change for one of the instances. Return False if nothing changed,
+        or None if the target has no way of notifying us, in which case
+        the instances get polled.
+        """
+        return None
+
+    def drvGetWatchedInstances(self, instanceIds):
+        """
+        Return the current state of instances that launch jobs are waiting
+        on. This is a single batched request for the instances of all jobs
+        talking to this target.
+        """
+        return self.drvGetInstances(instanceIds, force=True)
 
     def launchInstanceInBackgroundCleanup(self, image, **params):
         self.cleanUpX509()
@@ -988,6 +1320,9 @@ class BaseDriver(object):
             self.db.targetMgr.deleteTarget(self.cloudType, self.cloudName)
         except TargetMissing:
             pass
+        if self.cloudClientPool is not None:
+            self.cloudClientPool.invalidateTarget(self.cloudType,
+                self.cloudName)
 
     def setUserCredentials(self, credentialsData):
         # Authenticate
@@ -1099,8 +1434,12 @@ class BaseDriver(object):
         # deployImageProcess in sublcasses calls _deployImage in the
         # base class, which calls _deployImageFromFile from the subclass
         # again.
-        stream = self.openImage(image, auth=auth)
-        vmRef = self._deployImageFromStream(job, image, stream, *args, **kwargs)
+        stream = self.openImage(image, auth=auth, job=job)
+        try:
+            vmRef = self._deployImageFromStream(job, image, stream,
+                *args, **kwargs)
+        finally:
+            stream.close()
         targetImageId = self.getImageIdFromTargetImageRef(vmRef)
         image.setId(targetImageId)
         image.setImageId(targetImageId)
@@ -1119,6 +1458,7 @@ class BaseDriver(object):
             path = os.path.join(tmpDir, '%s%s' % (imageId, extension))
             with open(path, 'w') as outf:
                 util.copyfileobj(stream, outf)
+            self.verifyImageStream(stream)
             return self._deployImageFromFile(job, image, path, *args, **kwargs)
         finally:
             # clean up our mess
@@ -1138,10 +1478,16 @@ class BaseDriver(object):
         return None, None
 
     def openUrl(self, url, headers):
-        resp = Request(url, headers=headers, log=self.log_info)
+        """
+        Open url for reading. The caller is responsible for closing the
+        returned object.
+        """
+        resp = openRequest(url, headers=headers, log=self.log_info,
+            connections=self.DOWNLOAD_CONNECTIONS)
         if resp.headers['Content-Type'].startswith("text/html"):
             # We should not get HTML content out of rbuilder - most likely
             # a private project to which we don't have access
+            resp.close()
             raise errors.DownloadError("Unable to download file")
         return resp
 
@@ -1149,16 +1495,68 @@ class BaseDriver(object):
         imageId = os.path.basename(image.getId())
         downloadFilePath = os.path.join(tmpDir, '%s%s' % (imageId, extension))
         try:
-            inf = self.openImage(image, auth)
-            inf = self.streamProgressWrapper(job, inf)
-            with open(downloadFilePath, 'wb') as outf:
-                util.copyfileobj(inf, outf)
+            inf = self.openImage(image, auth, job=job)
+            try:
+                inf = self.streamProgressWrapper(job, inf)
+                with open(downloadFilePath, 'wb') as outf:
+                    util.copyfileobj(inf, outf)
+                self.verifyImageStream(inf)
+            finally:
+                inf.close()
         except Exception:
             util.rmtree(tmpDir, ignore_errors=True)
             raise
         return downloadFilePath
 
-    def openImage(self, image, auth=None):
+    def openImage(self, image, auth=None, job=None):
+        cache = self._getImageCache()
+        checksum = image.getChecksum()
+        if cache is None or not cache.isValidKey(checksum):
+            return self._digestImageStream(image,
+                self._openImageUrl(image, auth))
+        fobj = cache.open(checksum)
+        if fobj is not None:
+            if job is not None:
+                self._msg(job, "Using image from local cache")
+            return self._digestImageStream(image, fobj)
+        if job is not None:
+            self._msg(job, "Image not found in local cache")
+        return cache.store(checksum,
+            self._digestImageStream(image, self._openImageUrl(image, auth)))
+
+    def _digestImageStream(self, image, stream):
+        expected = {}
+        if self.VERIFY_IMAGE_CHECKSUMS:
+            expected['sha1'] = image.getChecksum()
+            expected['sha256'] = getattr(image, '_sha256', None)
+        return StreamWithDigest(stream, expected=expected,
+            algorithms=['sha1'])
+
+    def verifyImageStream(self, stream):
+        """
+        Consume the rest of an image stream returned by openImage, and make
+        sure the content matches the image's checksums. Drivers should call
+        this before registering the image with the target, so a corrupted
+        download never becomes a target image.
+        """
+        while isinstance(stream, StreamWithProgress):
+            stream = stream.fobj
+        verify = getattr(stream, 'verify', None)
+        if verify is None:
+            return
+        mismatches = verify()
+        if mismatches:
+            raise errors.ImageChecksumMismatch(
+                "Downloaded image does not match its %s checksum" %
+                    ', '.join(mismatches))
+
+    def _getImageCache(self):
+        if not self.IMAGE_CACHE_SIZE:
+            return None
+        path = os.path.join(self._cfg.storagePath, 'image-cache')
+        return imageCache.ImageCache(path, maxSize=self.IMAGE_CACHE_SIZE)
+
+    def _openImageUrl(self, image, auth=None):
         downloadUrl = image.getDownloadUrl()
         downloadUrl = self._remapDownloadUrl(downloadUrl)
         headers = {}
@@ -1178,13 +1576,13 @@ class BaseDriver(object):
             size = long(fobj.headers['content-length'])
         elif hasattr(fobj, 'fileno'):
             size = os.fstat(fobj.fileno()).st_size
-        elif isinstance(fobj, StringIO):
-            # testsuite
+        elif hasattr(fobj, 'getvalue'):
+            # testsuite (possibly wrapped in a caching stream)
             size = len(fobj.getvalue())
         else:
             raise TypeError("Can't determine size of file object")
         def callback(percent):
-            self._msg(job, "%s: %d%%" % (message, percent))
+            self._progress(job, message, percent)
         callback = PercentageCallback(size, callback)
         return StreamWithProgress(fobj, callback)
 
@@ -1234,6 +1632,9 @@ class BaseDriver(object):
     def postFork(self):
         # Force the client to reopen the connection to the cloud
         self._cloudClient = None
+        # Pooled clients share their connections with the parent process
+        if self.cloudClientPool is not None:
+            self.cloudClientPool.forgetAll()
         # We need to reopen the db, so we don't share a cursor with the parent
         # process
         self.db.db.reopen_fork()
@@ -1246,10 +1647,11 @@ class BaseDriver(object):
         return dict((self.getImageIdFromMintImage(x, targetImageIds), x)
             for x in mintImageList)
 
-    def addMintDataToImageList(self, imageList, imageType):
+    def addMintDataToImageList(self, imageList, imageType, mintImages=None):
         cloudAlias = self.getCloudAlias()
 
-        mintImages = self._getMintImagesByType(imageType)
+        if mintImages is None:
+            mintImages = self._getMintImagesByType(imageType)
         # Convert the list into a map keyed on the sha1 converted into
         # uuid format
         mintImages = self.hashMintImages(mintImages, imageList)
@@ -1390,84 +1792,73 @@ class BaseDriver(object):
     def newX509(self, certDir):
         netloc = urllib2.urlparse.urlparse(self._nodeFactory.baseUrl)[1]
         host, port = urllib.splitnport(netloc)
+        commonNameFactory = lambda: self._newX509CommonName(host)
 
+        util.mkdirChain(certDir)
+        pool = self._getX509Pool(host)
+        if pool is not None:
+            ret = pool.take(certDir)
+            # Replace what we took (or build the pool up, if it was empty)
+            # while the launch proceeds
+            pool.fillInBackground(commonNameFactory)
+            if ret is not None:
+                return ret
+        return x509.X509.new(commonNameFactory(), certDir = certDir)
+
+    @classmethod
+    def _newX509CommonName(cls, host):
         byteCount = 4
         ident = ("%02x" * byteCount) % tuple(ord(x)
             for x in file('/dev/urandom').read(byteCount))
-        commonName = 'Client certificate for %s, id: %s' % (host, ident)
-        util.mkdirChain(certDir)
-        return x509.X509.new(commonName, certDir = certDir)
+        return 'Client certificate for %s, id: %s' % (host, ident)
 
-    def getCredentialsIsoFile(self):
-        certFile = self.getWbemClientCert()
-        certDir = os.path.dirname(certFile)
-        util.mkdirChain(certDir)
-        isoDir = os.path.join(self._cfg.storagePath, 'credentials')
-        util.mkdirChain(isoDir)
-        fd, isoFile = tempfile.mkstemp(dir = isoDir,
-             prefix = 'credentials-', suffix = '.iso')
-        os.close(fd)
-
-        # Create an empty file for our signature
-        empty = os.path.join(certDir, "EMPTY")
-        file(empty, "w")
+    def _getX509Pool(self, host):
+        if not self.X509_POOL_DEPTH:
+            return None
+        # The common name includes the host name, so keep one pool per host
+        path = os.path.join(self._cfg.storagePath, 'x509-pool', str(host))
+        return x509.X509Pool(path, depth=self.X509_POOL_DEPTH,
+            log=self.log_info)
 
+    def getCredentialsIso(self):
+        """
+        Build the credentials ISO in memory. Returns an IsoImage.
+        """
+        certFile = self.getWbemClientCert()
         # Load the cert, we need the hash
         certHash = self.computeX509CertHash(certFile)
 
-        bootUuidFile = tempfile.NamedTemporaryFile()
-        bootUuidFile.write(self.getBootUuid())
-        bootUuidFile.flush()
-
-        rootSshKeyFile = None
-        rootSshKeys = self._rootSshKeys
-        if rootSshKeys:
-            rootSshKeyFile = tempfile.NamedTemporaryFile()
-            rootSshKeyFile.write(rootSshKeys)
-            rootSshKeyFile.flush()
+        iso = isoimage.IsoImage()
+        # Empty file for our signature
+        iso.addFile("SECURITY-CONTEXT-BOOTSTRAP", "")
+        iso.addFile("etc/sfcb/clients/%s.0" % certHash, file(certFile).read())
+        iso.addFile("etc/conary/rpath-tools/boot-uuid", self.getBootUuid())
 
-        directMethodFile = None
-        conaryProxyFile = None
         if self.zoneAddresses:
-            directMethodFile = tempfile.NamedTemporaryFile()
             tmpl = "directMethod %s\n"
-            directMethodFile.write(tmpl % "[]")
-            for za in self.zoneAddresses:
-                directMethodFile.write(tmpl % za)
-            directMethodFile.flush()
-            conaryProxyFile = tempfile.NamedTemporaryFile()
+            directMethod = [ tmpl % "[]" ]
+            directMethod.extend(tmpl % za for za in self.zoneAddresses)
+            iso.addFile("etc/conary/rpath-tools/config.d/directMethod",
+                ''.join(directMethod))
             # zone addresses may have the port embedded, need to strip
             # that out
-            conaryProxyFile.write(
+            iso.addFile("etc/conary/config.d/rpath-tools-conaryProxy",
                 "proxyMap * %s\n" % " ".join(
                     "conarys://" + x.split(':', 1)[0]
                         for x in self.zoneAddresses))
-            conaryProxyFile.flush()
-
-        graftList = [
-            "SECURITY-CONTEXT-BOOTSTRAP=%s" % empty,
-            "etc/sfcb/clients/%s.0=%s" % (certHash, certFile),
-            "etc/conary/rpath-tools/boot-uuid=%s" % bootUuidFile.name,
-        ]
-
-        if directMethodFile:
-            graftList.append("etc/conary/rpath-tools/config.d/directMethod=%s"
-                % directMethodFile.name)
-        if conaryProxyFile:
-            graftList.append("etc/conary/config.d/rpath-tools-conaryProxy=%s"
-                % conaryProxyFile.name)
-        if rootSshKeyFile:
-            graftList.append("etc/ssh/keys.d/root/key.pub=%s" % rootSshKeyFile.name)
-
-        # Make ISO, if it doesn't exist already
-        cmd = [ "/usr/bin/mkisofs", "-r", "-J", "-graft-points",
-            "-o", isoFile,
-        ] + graftList
-
-        devnull = file(os.devnull, "w")
-        p = subprocess.Popen(cmd, shell = False, stdout=devnull,
-            stderr = devnull)
-        p.wait()
+
+        rootSshKeys = self._rootSshKeys
+        if rootSshKeys:
+            iso.addFile("etc/ssh/keys.d/root/key.pub", rootSshKeys)
+        return iso
+
+    def getCredentialsIsoFile(self):
+        isoDir = os.path.join(self._cfg.storagePath, 'credentials')
+        util.mkdirChain(isoDir)
+        fd, isoFile = tempfile.mkstemp(dir = isoDir,
+             prefix = 'credentials-', suffix = '.iso')
+        with os.fdopen(fd, "w") as f:
+            self.getCredentialsIso().write(f)
         return isoFile
 
     @classmethod
@@ -1822,6 +2213,187 @@ class Request(object):
 
 
     def close(self):
-        return self._resp.raw.close()
+        for resp in [ self._resp, self._lastRangeResp ]:
+            if resp is not None:
+                resp.raw.close()
+
+class SegmentedRequest(object):
+    """
+    Download a URL over several connections at once, each of them fetching
+    a different byte range. Completed segments are kept in a bounded,
+    ordered in-memory window, so the object can still be read sequentially
+    like Request.
+    A failed segment is retried on its own, the rest of the download is not
+    affected.
+    Callers should close the object when done with it. Downloads nobody
+    reads from for READ_TIMEOUT seconds are abandoned, so the workers and
+    the segments they hold go away even if the caller fails to.
+    """
+    SEGMENT_SIZE = 8 * 1024 * 1024
+    # Number of segments to fetch ahead, per connection
+    WINDOW_PER_CONNECTION = 2
+    MAX_RETRIES = 5
+    RETRY_SLEEP = 1.1
+    READ_TIMEOUT = 600
+
+    def __init__(self, url, responseHeaders, headers=None, log=None,
+            connections=4):
+        if log is None:
+            log = lambda *args, **kwargs: None
+        self.log = log
+        self.headers = responseHeaders
+        self._url = url
+        self._requestHeaders = headers or {}
+        self.contentLength = int(responseHeaders['Content-Length'])
+        self._segmentCount = ((self.contentLength + self.SEGMENT_SIZE - 1)
+            / self.SEGMENT_SIZE)
+        self._window = max(1, connections * self.WINDOW_PER_CONNECTION)
+        self._cond = threading.Condition()
+        self._segments = {}
+        self._nextSegment = 0
+        self._readSegment = 0
+        self._error = None
+        self._closed = False
+        self._lastRead = time.time()
+        self._buf = ''
+        self._bufOffset = 0
+        self._threads = []
+        for i in range(min(connections, self._segmentCount)):
+            thr = threading.Thread(target=self._worker,
+                name="download-%d" % i)
+            thr.setDaemon(True)
+            self._threads.append(thr)
+            thr.start()
+
+    @classmethod
+    def canSegment(cls, resp):
+        """
+        Return True if the response (a Request) comes from a server that
+        accepts range requests, and the file is large enough to be worth it.
+        """
+        headers = resp.headers
+        if headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return False
+        try:
+            contentLength = int(headers['Content-Length'])
+        except (KeyError, ValueError):
+            return False
+        return contentLength >= 2 * cls.SEGMENT_SIZE
+
+    def _newSession(self):
+        session = requests.Session()
+        session.verify = False
+        session.headers.update(self._requestHeaders)
+        return session
+
+    def _worker(self):
+        session = self._newSession()
+        while 1:
+            with self._cond:
+                while (not self._closed and self._error is None and
+                        self._nextSegment < self._segmentCount and
+                        self._nextSegment >= self._readSegment + self._window):
+                    idle = time.time() - self._lastRead
+                    if idle >= self.READ_TIMEOUT:
+                        self.log("Nothing read from %s for %d seconds, "
+                            "abandoning download" % (self._url, idle))
+                        self._close()
+                        break
+                    self._cond.wait(self.READ_TIMEOUT - idle)
+                if (self._closed or self._error is not None or
+                        self._nextSegment >= self._segmentCount):
+                    return
+                idx = self._nextSegment
+                self._nextSegment += 1
+            try:
+                data = self._fetchSegment(session, idx)
+            except Exception:
+                with self._cond:
+                    self._error = sys.exc_info()
+                    self._cond.notifyAll()
+                return
+            with self._cond:
+                self._segments[idx] = data
+                self._cond.notifyAll()
+
+    def _fetchSegment(self, session, idx):
+        start = idx * self.SEGMENT_SIZE
+        end = min(start + self.SEGMENT_SIZE, self.contentLength) - 1
+        headers = dict(Range="bytes=%d-%d" % (start, end))
+        timeout = self.RETRY_SLEEP
+        for i in range(self.MAX_RETRIES):
+            try:
+                resp = session.get(self._url, headers=headers)
+                if resp.status_code != 206:
+                    raise errors.DownloadError(
+                        "Expected Partial Content, got %d" % resp.status_code)
+                data = resp.content
+                if len(data) != end - start + 1:
+                    raise errors.DownloadError("Short read for range %s" %
+                        headers['Range'])
+                return data
+            except (requests.exceptions.RequestException,
+                    errors.DownloadError), e:
+                if i == self.MAX_RETRIES - 1:
+                    raise
+                self.log("Range request %s failed (%s), retrying" % (
+                    headers['Range'], e))
+                time.sleep(timeout)
+                timeout *= 2
+
+    def _waitForSegment(self, idx):
+        with self._cond:
+            while (idx not in self._segments and self._error is None and
+                    not self._closed):
+                self._cond.wait()
+            if idx not in self._segments:
+                if self._error is None:
+                    raise errors.DownloadError("Download closed")
+                raise self._error[0], self._error[1], self._error[2]
+            data = self._segments.pop(idx)
+            self._readSegment += 1
+            self._lastRead = time.time()
+            # Let the workers fetch more segments
+            self._cond.notifyAll()
+        return data
+
+    def read(self, amt=None, **kwargs):
+        chunks = []
+        while amt is None or amt > 0:
+            if self._bufOffset >= len(self._buf):
+                if self._readSegment >= self._segmentCount:
+                    break
+                self._buf = self._waitForSegment(self._readSegment)
+                self._bufOffset = 0
+            if amt is None:
+                chunk = self._buf[self._bufOffset:]
+            else:
+                chunk = self._buf[self._bufOffset:self._bufOffset + amt]
+                amt -= len(chunk)
+            self._bufOffset += len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        with self._cond:
+            self._close()
+
+    def _close(self):
+        self._closed = True
+        self._segments.clear()
+        self._cond.notifyAll()
+
+def openRequest(url, headers=None, log=None, connections=1):
+    """
+    Open url for reading. If the server supports range requests, the
+    file is downloaded using several connections in parallel.
+    """
+    resp = Request(url, headers=headers, log=log)
+    if connections <= 1 or not SegmentedRequest.canSegment(resp):
+        return resp
+    # Drop the probing connection, the content is fetched in segments
+    resp.close()
+    return SegmentedRequest(url, resp.headers, headers=headers, log=log,
+        connections=connections)
 
 BaseDriver.Archive = Archive
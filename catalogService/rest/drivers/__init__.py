@@ -0,0 +1,151 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Registry of the target drivers.
+
+Importing a driver pulls in its client libraries (boto, the VMware and
+vCloud stacks, the nova and glance clients), so the registry only records
+what is needed to list and route to a driver: its module name, cloud
+type and the client modules it needs to be functional. The driver module
+is imported the first time the driver is actually used (see LazyDriver).
+"""
+
+import imp
+import sys
+import threading
+
+class DriverInfo(object):
+    __slots__ = [ 'driverName', 'cloudType', 'requires', '_available', ]
+    def __init__(self, driverName, cloudType, requires=()):
+        self.driverName = driverName
+        self.cloudType = cloudType
+        self.requires = requires
+        self._available = None
+
+    def isAvailable(self):
+        """
+        Return True if the modules the driver needs can be found, without
+        importing them (or the driver)
+        """
+        if self._available is None:
+            self._available = all(self._findModule(x) for x in self.requires)
+        return self._available
+
+    @classmethod
+    def _findModule(cls, name):
+        if sys.modules.get(name) is not None:
+            return True
+        path = None
+        for part in name.split('.'):
+            try:
+                fobj, pathname, desc = imp.find_module(part, path)
+            except ImportError:
+                return False
+            if fobj is not None:
+                fobj.close()
+            path = [ pathname ]
+        return True
+
+# The driver modules in this package. cloudType has to match the cloudType
+# of the driver class, and requires the modules its isDriverFunctional
+# checks for
+DRIVERS = [
+    DriverInfo('ec2', 'ec2'),
+    DriverInfo('eucalyptus', 'eucalyptus'),
+    DriverInfo('openstack', 'openstack', requires=(
+        'keystoneclient.auth.identity', 'keystoneclient.client',
+        'keystoneclient.session', 'novaclient.v1_1.client',
+        'glanceclient')),
+    DriverInfo('vcloud', 'vcloud'),
+    DriverInfo('vmware', 'vmware'),
+    DriverInfo('xenent', 'xen-enterprise', requires=(
+        'XenAPI', 'XenAPI.provision')),
+]
+
+# Names of the driver modules in this package
+SUPPORTED_MODULES = [ x.driverName for x in DRIVERS ]
+
+def getDriverInfo(driverName):
+    """
+    Return the DriverInfo of a driver module, without importing it
+    """
+    for info in DRIVERS:
+        if info.driverName == driverName:
+            return info
+    raise KeyError(driverName)
+
+def getDriverClass(driverName):
+    """
+    Import the module of a driver and return its driver class
+    """
+    return __import__('%s.%s' % (__name__, driverName), {}, {},
+        ['driver']).driver
+
+class LazyDriver(object):
+    """
+    Stand-in for a driver, created from its DriverInfo. The driver module
+    is imported, and the driver instantiated, on first call or on first
+    access to an attribute other than driverName and cloudType.
+    isDriverFunctional is answered from the DriverInfo until then.
+    """
+    _localAttributes = set([ '_info', '_args', '_kwargs', '_driver',
+        '_lock', ])
+
+    def __init__(self, info, *args, **kwargs):
+        self._info = info
+        self._args = args
+        self._kwargs = kwargs
+        self._driver = None
+        self._lock = threading.Lock()
+
+    driverName = property(lambda self: self._info.driverName)
+    cloudType = property(lambda self: self._info.cloudType)
+
+    def isResolved(self):
+        return self._driver is not None
+
+    def resolve(self):
+        """
+        Return the driver, importing its module if needed
+        """
+        if self._driver is not None:
+            return self._driver
+        with self._lock:
+            if self._driver is None:
+                driverClass = getDriverClass(self._info.driverName)
+                self._driver = driverClass(*self._args, **self._kwargs)
+        return self._driver
+
+    def isDriverFunctional(self):
+        if self._driver is not None:
+            return self._driver.isDriverFunctional()
+        return self._info.isAvailable()
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the stand-in itself
+        if name in self._localAttributes:
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        if name in self._localAttributes:
+            object.__setattr__(self, name, value)
+            return
+        setattr(self.resolve(), name, value)
@@ -18,6 +18,7 @@
 
 import base64
 import gzip
+import json
 import logging
 import os
 import re
@@ -38,11 +39,13 @@ from jobslave.util import logCall
 from jobslave.generators import bootable_image
 
 from catalogService import errors
+from catalogService import storage
 from catalogService.rest import baseDriver
 from catalogService.rest.models import clouds
 from catalogService.rest.models import images
 from catalogService.rest.models import instances
 from catalogService.rest.models import securityGroups
+from catalogService.utils import blockwriter
 from catalogService.utils import vmdk_extract
 from catalogService.utils.progress import PercentageCallback
 
@@ -411,6 +414,44 @@ _credentialsDescriptorXmlData = """<?xml version='1.0' encoding='UTF-8'?>
 </descriptor>
 """
 
+class PublicImageCache(object):
+    """
+    On-disk cache of image descriptions that are not owned by the account,
+    one per region. Entries (including negative ones, for images that no
+    longer exist) expire after TTL seconds.
+    """
+    TTL = 86400
+
+    def __init__(self, storagePath, ttl=None):
+        cfg = storage.StorageConfig(storagePath=storagePath)
+        self._store = storage.DiskStorage(cfg)
+        if ttl is not None:
+            self.TTL = ttl
+
+    def get(self, imageId, now=None):
+        """
+        Returns a tuple (found, imageData). imageData is None if the image
+        is known not to exist.
+        """
+        if now is None:
+            now = time.time()
+        data = self._store.get(imageId)
+        if data is None:
+            return False, None
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return False, None
+        if now - data.get('fetched', 0) >= self.TTL:
+            return False, None
+        return True, data.get('image')
+
+    def set(self, imageId, imageData, now=None):
+        if now is None:
+            now = time.time()
+        self._store.set(imageId, json.dumps(dict(fetched=now,
+            image=imageData)))
+
 class EC2Client(baseDriver.BaseDriver):
     cloudType = 'ec2'
 
@@ -485,6 +526,11 @@ class EC2Client(baseDriver.BaseDriver):
                 raise errors.MissingCredentials()
         return self._getEC2Connection(credentials)
 
+    def drvPrepareCloudClient(self, client):
+        # Pooled clients did not go through _getEC2ConnectionInfo, which
+        # sets the kernel map
+        self._getEC2ConnectionInfo(self.credentials)
+
     def _getEC2Connection(self, credentials):
         publicAccessKeyId = credentials['publicAccessKeyId']
         secretAccessKey = credentials['secretAccessKey']
@@ -831,19 +877,38 @@ conary-proxies=%s
 
     def drvGetInstances(self, instanceIds, force=False):
         resultSet = self._getInstanceReservations(instanceIds)
+        # Resolve the images for all reservations at once, rather than once
+        # per reservation
+        imageIdToImageMap = self._getImageMapForInstances(
+            [ x for reservation in resultSet for x in reservation.instances ])
         insts = instances.BaseInstances()
         for reservation in resultSet:
-            insts.extend(self._getInstancesFromReservation(reservation))
+            insts.extend(self._getInstancesFromReservation(reservation,
+                imageIdToImageMap))
         return insts
 
     def getImagesFromTarget(self, imageIds):
         imageList = images.BaseImages()
         targetConfiguration = self.getTargetConfiguration()
         ownerId = targetConfiguration.get('accountId')
-        if ownerId:
-            ownerIds = [ ownerId ]
+        if imageIds:
+            if ownerId:
+                ownerIds = [ ownerId ]
+            else:
+                ownerIds = None
+            rs = self._describeImages(imageIds, ownerIds)
         else:
-            ownerIds = None
+            # Do not describe every public image in the region; only the
+            # images we own and the ones rBuilder knows about
+            rs = self._describeDefaultImages(ownerId)
+
+        cloudAlias = targetConfiguration.get('cloudAlias')
+        for image in rs:
+            imageList.append(self._newImageNode(self._imageDataFromBoto(image),
+                cloudAlias))
+        return imageList
+
+    def _describeImages(self, imageIds, ownerIds=None):
         imageIds = set(imageIds or [])
         try:
             rs = self.client.get_all_images(image_ids = list(imageIds), owners = ownerIds)
@@ -856,38 +921,119 @@ conary-proxies=%s
             missingImageIds = self._processInvalidAMIID(errorMsg)
             imageIds = imageIds.difference(missingImageIds)
             if not imageIds:
-                return imageList
+                return []
             rs = self.client.get_all_images(image_ids = list(imageIds), owners = ownerIds)
 
         # avoid returning amazon kernel images.
-        rs = [ x for x in rs if x.id.startswith(self.ImagePrefix) ]
+        return [ x for x in rs if x.id.startswith(self.ImagePrefix) ]
+
+    def _describeDefaultImages(self, ownerId):
+        rs = self._describeImages(None, [ ownerId or 'self' ])
+        seen = set(x.id for x in rs)
+        mintImageIds = [ x for x in self._getMintTargetImageIds()
+            if x not in seen ]
+        if mintImageIds:
+            rs.extend(x for x in self._describeImages(mintImageIds)
+                if x.id not in seen)
+        return rs
 
-        cloudAlias = targetConfiguration.get('cloudAlias')
-        for image in rs:
-            productCodes = self._productCodesForImage(image)
-            if image.location:
-                iloc = image.location.replace(".manifest.xml", "")
-                longName = "%s (%s)" % (iloc, image.id)
-            else:
-                longName = None
-            i = self._nodeFactory.newImage(id=image.id, imageId=image.id,
-                                           ownerId=image.ownerId,
-                                           longName=longName,
-                                           state=image.state,
-                                           isPublic=image.is_public,
-                                           productCode=productCodes,
-                                           cloudAlias=cloudAlias,
-                                           cloudName=self.cloudName,
-                                           cloudType=self.cloudType,
-                                           isDeployed = True,
-                                           is_rBuilderImage = False,
-                                           )
-            imageList.append(i)
-        return imageList
+    def _getMintTargetImageIds(self):
+        """
+        Image IDs on this target referenced by rBuilder images
+        """
+        ret = set()
+        for mintImage in self.getListingMintImages():
+            for ffile in mintImage.get('files', []):
+                ret.add(ffile.get('uniqueImageId'))
+                ret.update(x[2] for x in ffile.get('targetImages', [])
+                    if x[0] == self.cloudType and x[1] == self.cloudName)
+        return sorted(x for x in ret
+            if x and x.startswith(self.ImagePrefix))
+
+    def drvGetImages(self, imageIdsFilter, force=False):
+        imageList = baseDriver.BaseDriver.drvGetImages(self, imageIdsFilter,
+            force=force)
+        if not imageIdsFilter:
+            return imageList
+        # Images that are neither ours nor rBuilder's (e.g. public images
+        # instances were launched from) are looked up through the cache
+        found = set()
+        for image in imageList:
+            found.add(image.getImageId())
+            found.add(getattr(image, '_targetImageId', None))
+        missing = [ x for x in imageIdsFilter
+            if x not in found and x.startswith(self.ImagePrefix) ]
+        if not missing:
+            return imageList
+        publicImages = self._getPublicImages(missing)
+        if not publicImages:
+            return imageList
+        return self.filterImages(imageIdsFilter,
+            list(imageList) + publicImages)
+
+    def _getPublicImageCache(self):
+        regionName = self.getTargetConfiguration().get('region')
+        path = os.path.join(self._cfg.storagePath, 'public-images',
+            self.cloudType, self._sanitizeKey(regionName or self.cloudName))
+        return PublicImageCache(path)
+
+    def _getPublicImages(self, imageIds):
+        cache = self._getPublicImageCache()
+        imageDataList = []
+        toFetch = []
+        for imageId in imageIds:
+            found, imageData = cache.get(imageId)
+            if not found:
+                toFetch.append(imageId)
+            elif imageData is not None:
+                imageDataList.append(imageData)
+        if toFetch:
+            fetched = dict((x.id, self._imageDataFromBoto(x))
+                for x in self._describeImages(toFetch))
+            for imageId in toFetch:
+                imageData = fetched.get(imageId)
+                cache.set(imageId, imageData)
+                if imageData is not None:
+                    imageDataList.append(imageData)
+        cloudAlias = self.getTargetConfiguration().get('cloudAlias')
+        return [ self._newImageNode(x, cloudAlias) for x in imageDataList ]
+
+    @classmethod
+    def _imageDataFromBoto(cls, image):
+        return dict(id=image.id, ownerId=image.ownerId,
+            location=image.location, state=image.state,
+            isPublic=image.is_public,
+            productCodes=list(image.product_codes or []))
+
+    def _newImageNode(self, imageData, cloudAlias):
+        imageId = imageData['id']
+        location = imageData['location']
+        if location:
+            iloc = location.replace(".manifest.xml", "")
+            longName = "%s (%s)" % (iloc, imageId)
+        else:
+            longName = None
+        productCodes = self._productCodesFromList(imageData['productCodes'])
+        return self._nodeFactory.newImage(id=imageId, imageId=imageId,
+                                          ownerId=imageData['ownerId'],
+                                          longName=longName,
+                                          state=imageData['state'],
+                                          isPublic=imageData['isPublic'],
+                                          productCode=productCodes,
+                                          cloudAlias=cloudAlias,
+                                          cloudName=self.cloudName,
+                                          cloudType=self.cloudType,
+                                          isDeployed = True,
+                                          is_rBuilderImage = False,
+                                          )
 
     def _productCodesForImage(self, image):
+        return self._productCodesFromList(image.product_codes)
+
+    @classmethod
+    def _productCodesFromList(cls, productCodes):
         return [ (x, EC2_DEVPAY_OFFERING_BASE_URL % x)
-            for x in image.product_codes ]
+            for x in productCodes ]
 
     @classmethod
     def _formatVPC(cls, obj):
@@ -1216,9 +1362,10 @@ conary-proxies=%s
         instanceList.extend(self._getInstances(resultSet))
         return instanceList
 
-    def _getInstancesFromReservation(self, reservation):
+    def _getInstancesFromReservation(self, reservation, imageIdToImageMap=None):
         insts = instances.BaseInstances()
-        insts.extend(self._getInstances(reservation.instances, reservation))
+        insts.extend(self._getInstances(reservation.instances, reservation,
+            imageIdToImageMap=imageIdToImageMap))
         sGroups = []
         for grp in reservation.groups:
             sGroups.append(self.SecurityGroup(id = grp.id,
@@ -1227,12 +1374,19 @@ conary-proxies=%s
             inst.setSecurityGroup(sGroups)
         return insts
 
-    def _getInstances(self, instancesIterable, reservation=None):
-        # Grab images first
+    def _getImageMapForInstances(self, instancesIterable):
         imageIds = set(x.image_id for x in instancesIterable
             if x.image_id is not None)
-        imageIdToImageMap = self._ImageMap(
-            self.drvGetImages(list(imageIds)))
+        if not imageIds:
+            return self._ImageMap([])
+        return self._ImageMap(self.drvGetImages(sorted(imageIds)))
+
+    def _getInstances(self, instancesIterable, reservation=None,
+            imageIdToImageMap=None):
+        # Grab images first
+        if imageIdToImageMap is None:
+            imageIdToImageMap = self._getImageMapForInstances(
+                instancesIterable)
 
         properties = dict(cloudAlias = self.getCloudAlias())
         if reservation:
@@ -1503,6 +1657,7 @@ conary-proxies=%s
 
         imageFilePath = self._getFilesystemImage(job, image, stream)
         try:
+            self.verifyImageStream(stream)
             self._msg(job, "Bundling image")
             bundlePath = tempfile.mkdtemp(prefix='bundle-')
             try:
@@ -1551,6 +1706,7 @@ conary-proxies=%s
             try:
                 self._waitForBlockDevice(job, internalDev)
                 self._writeDiskImage(job, internalDev, stream, fsSize)
+                self.verifyImageStream(stream)
             finally:
                 self._detachVolume(job, vol, internalDev)
             snapshot = self._createSnapshot(job, vol)
@@ -1735,23 +1891,33 @@ conary-proxies=%s
 
     def _writeDiskImage(self, job, internalDev, stream, diskSize):
         def callback(percent):
-            self._msg(job, "%s: %d%%" % ("Uncompressing image", percent))
+            self._progress(job, "Uncompressing image", percent)
         callback = PercentageCallback(diskSize, callback)
-
-        with open(internalDev, 'wb') as f_dev:
-            reader = vmdk_extract.VMDKReader(stream, f_dev)
+        def grainCallback(streamPos, diskPos):
+            # Called for every grain written, with the position in the
+            # compressed stream and the end of the grain in the disk
+            callback(diskPos)
+
+        # The volume was just created, so it reads back as zeroes already
+        with blockwriter.SparseBlockWriter(internalDev,
+                skipZeroes=True) as f_dev:
+            reader = vmdk_extract.VMDKReader(stream, f_dev,
+                callback=grainCallback)
             reader.process()
             finalSize = reader.header.capacity * 512
-        if reader.header.capacity * 512 != diskSize:
+        if finalSize == diskSize:
+            # The last grains may be unallocated
+            callback(finalSize)
+        MiB = 1024 * 1024
+        self._msg(job, "Disk image written: %d MiB written, %d MiB skipped" % (
+            f_dev.bytesWritten / MiB, f_dev.bytesSkipped / MiB))
+        if finalSize != diskSize:
             raise RuntimeError("Expected an image of %s bytes; got %s" % (
                 diskSize, finalSize))
 
     @classmethod
     def isZero(cls, block):
-        for b in block:
-            if b != '\0':
-                return False
-        return True
+        return blockwriter.isZero(block)
 
     @classmethod
     def _extFilesystemSize(cls, fsSize):
@@ -1861,7 +2027,7 @@ conary-proxies=%s
         fileCount = len(bundleItemGen)
         totalSize = sum(x[1] for x in bundleItemGen)
 
-        cb = self.UploadCallback(job, self._msg).callback
+        cb = self.UploadCallback(job, self._progress).callback
         s3conn, location = self._getS3Connection(targetConfiguration)
         policy = None
         bucket = ec2.S3Wrapper.createBucketBackend(s3conn, bucketName,
@@ -1883,9 +2049,9 @@ conary-proxies=%s
         return emiId
 
     class UploadCallback(object):
-        def __init__(self, job, msg):
+        def __init__(self, job, progress):
             self.job = job
-            self.msg = msg
+            self.progress = progress
 
         def callback(self, fileName, fileIdx, fileTotal,
                 currentFileBytes, totalFileBytes, sizeCurrent, sizeTotal):
@@ -1893,9 +2059,8 @@ conary-proxies=%s
             if sizeTotal == 0:
                 sizeTotal = 1024
             pct = sizeCurrent * 100.0 / sizeTotal
-            message = "Uploading bundle: %d%%" % (pct, )
 
-            self.msg(self.job, message)
+            self.progress(self.job, "Uploading bundle", int(pct))
 
 PEM_LINE = 76
 PEM_HEADER = '-{2,5}(BEGIN [A-Z0-9 ]+?\s*)-{2,5}'
@@ -256,6 +256,13 @@ class OpenStackClient(baseDriver.BaseDriver):
                     "Error initializing client: %s" % (e, ))
         return clients
 
+    def drvIsCloudClientValid(self, client):
+        authRef = getattr(client.keystone, 'auth_ref', None)
+        if authRef is None:
+            return True
+        # Log in again if the keystone token is about to expire
+        return not authRef.will_expire_soon()
+
     def drvVerifyCloudConfiguration(self, dataDict):
         serverName = dataDict['name']
         serverPort = dataDict['nova_port']
@@ -428,6 +435,11 @@ class OpenStackClient(baseDriver.BaseDriver):
         # Grab the last part of the URL and return it
         return os.path.basename(ref)
 
+    def drvGetInventoryKey(self, credentials):
+        # Servers are listed per project, and the project is part of the
+        # target configuration: all users of the target see the same ones
+        return self.getTargetConfiguration()['project_name']
+
     def drvGetInstances(self, instanceIds, force=False):
         client = self.client.nova
         cloudAlias = self.getCloudAlias()
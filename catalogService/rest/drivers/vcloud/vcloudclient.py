@@ -170,6 +170,12 @@ class VCloudClient(baseDriver.BaseDriver):
         rcli.login(org)
         return rcli
 
+    def drvIsCloudClientValid(self, client):
+        return 'x-vcloud-authorization' in client.headers
+
+    def drvReleaseCloudClient(self, client):
+        client.logout()
+
     @classmethod
     def _id(cls, href, prefix):
         return "%s-%s" % (prefix, os.path.basename(href))
@@ -601,8 +607,10 @@ class VCloudClient(baseDriver.BaseDriver):
     def _callbackFactory(self, vapp, job, url, fileSize):
         fileName = os.path.basename(url)
         def cb(total, rate):
-            self._msg(job, "%s: transferred %4.1f%% (%d/%d)" % (
-                fileName, total * 100.0 / fileSize, total, fileSize))
+            self._progressMsg(job, fileName,
+                "%s: transferred %4.1f%% (%d/%d)" % (
+                    fileName, total * 100.0 / fileSize, total, fileSize),
+                final=(total >= fileSize))
             now = time.time()
             if self._refreshLastCalled + 10 < now:
                 vcTransferred, vcTot = self._statusCallback(vapp, job, url)
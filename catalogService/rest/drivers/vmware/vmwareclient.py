@@ -543,11 +543,18 @@ class VMwareClient(baseDriver.BaseDriver):
 
     def postFork(self):
         if self._cloudClient is not None:
-            # Pretend that we're not logged in, otherwise the __del__ method
-            # will log out the parent
-            self._cloudClient._loggedIn = False
+            self.drvForgetCloudClient(self._cloudClient)
         return baseDriver.BaseDriver.postFork(self)
 
+    def drvIsCloudClientValid(self, client):
+        # VimService logs in again by itself if the session expired
+        return client._loggedIn
+
+    def drvForgetCloudClient(self, client):
+        # Pretend that we're not logged in, otherwise the __del__ method
+        # will log out the parent
+        client._loggedIn = False
+
     def terminateInstances(self, instanceIds):
         insts = self.getInstances(instanceIds)
         for instanceId in instanceIds:
@@ -834,7 +841,8 @@ class VMwareClient(baseDriver.BaseDriver):
         percenter.callback = self.LeaseProgressUpdate(
                 httpNfcLease, percenter.callback)
 
-        vmMor = self.client.ovfUpload(httpNfcLease, archive, prefix, fileItems)
+        vmMor = self.client.ovfUpload(httpNfcLease, archive, prefix, fileItems,
+            verify=lambda: self.verifyImageStream(stream))
         return vmMor
 
     def getImageIdFromTargetImageRef(self, vmRef):
@@ -967,7 +975,8 @@ class VMwareClient(baseDriver.BaseDriver):
             status, progress, error = values
             if status != "running" or not isinstance(progress, int):
                 return
-            self._msg(job, message % progress)
+            self._progressMsg(job, message, message % progress,
+                final=(progress >= 100))
         return callback
 
     def LeaseProgressUpdate(self, lease, origCallback):
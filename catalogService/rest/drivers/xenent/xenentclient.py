@@ -25,6 +25,7 @@ import time
 import urllib
 import urllib2
 import httplib
+from StringIO import StringIO
 
 from conary.lib import util
 
@@ -275,9 +276,22 @@ class XenEntClient(baseDriver.BaseDriver):
         except XenAPI.Failure, e:
             raise errors.PermissionDenied(message = "User %s: %s" % (
                 e.details[1], e.details[2]))
-        self._uuidToRefMap = {}
         return sess
 
+    def drvPrepareCloudClient(self, client):
+        self._uuidToRefMap = {}
+
+    def drvIsCloudClientValid(self, client):
+        try:
+            client.xenapi.session.get_this_host(client._session)
+        except XenAPI.Failure:
+            # SESSION_INVALID
+            return False
+        return True
+
+    def drvReleaseCloudClient(self, client):
+        client.xenapi.session.logout()
+
     def _cachedGet(self, uuid, function):
         ref = self._uuidToRefMap.get(uuid)
         if ref is not None:
@@ -385,6 +399,28 @@ class XenEntClient(baseDriver.BaseDriver):
         instanceList.sort(key = lambda x: (x.getState(), x.getInstanceId()))
         return self.filterInstances(instanceIds, instanceList)
 
+    _eventToken = ''
+
+    def drvWaitForInstanceUpdates(self, instanceIds, timeout):
+        # Block on XenServer's event stream, rather than fetching all VM
+        # records again. The first call (with an empty token) returns the
+        # current state of everything, which only costs one extra poll
+        try:
+            ret = self.client.xenapi.event_from(['vm', 'vm_guest_metrics'],
+                self._eventToken, float(timeout))
+        except (XenAPI.Failure, socket.error):
+            # Old servers don't implement event.from; poll instead
+            return None
+        self._eventToken = ret['token']
+        instanceIds = set(instanceIds)
+        for event in ret['events']:
+            if event['class'] == 'vm_guest_metrics':
+                return True
+            snapshot = event.get('snapshot') or {}
+            if snapshot.get('uuid') in instanceIds:
+                return True
+        return False
+
     def _pollTask(self, taskRef, loopCount = 100, timeout = 0.5):
         client = self.client
         for i in range(loopCount):
@@ -633,9 +669,7 @@ class XenEntClient(baseDriver.BaseDriver):
     def _attachCredentials(self, vmRef, srUuid):
         client = self.client
         srRef = self._cachedGet(srUuid, client.xenapi.SR.get_by_uuid)
-        filename = self.getCredentialsIsoFile()
-        fileObj = file(filename)
-        os.unlink(filename)
+        fileObj = StringIO(self.getCredentialsIso().getvalue())
         self._attachCredentialsDisk(vmRef, fileObj, srRef)
 
     def _attachCredentialsDisk(self, vmRef, fileObj, srRef = None):
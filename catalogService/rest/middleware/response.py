@@ -15,9 +15,11 @@
 #
 
 
+import hashlib
 import StringIO
 from restlib import response
 
+from catalogService.rest.middleware import http_codes
 from catalogService.rest.models import xmlNode
 
 class XmlStringResponse(response.Response):
@@ -27,9 +29,13 @@ class XmlStringResponse(response.Response):
         self.headers['Cache-Control'] = 'no-store'
 
 class XmlResponse(XmlStringResponse):
+    # Serialization does not depend on registered types, the handler can
+    # be shared. The body is built in memory by a single toXml; it is not
+    # streamed
+    handler = xmlNode.Handler()
+
     def __init__(self, content, *args, **kw):
-        hndlr = xmlNode.Handler()
-        newContent = hndlr.toXml(content)
+        newContent = self.handler.toXml(content)
         XmlStringResponse.__init__(self, newContent, *args, **kw)
 
 class XmlSerializableObjectResponse(XmlStringResponse):
@@ -44,3 +50,67 @@ class HtmlFileResponse(response.Response):
         response.Response.__init__(self, content, *args, **kw)
         self.headers['content-type'] = 'text/html'
         self.headers['Cache-Control'] = 'no-store'
+
+class NotModifiedResponse(response.Response):
+    def __init__(self, etag):
+        response.Response.__init__(self, '',
+            status=http_codes.HTTP_NOT_MODIFIED)
+        self.headers['ETag'] = etag
+
+def etagMatches(request, etag):
+    """
+    Return True if the If-None-Match header of the request lists etag
+    """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [ x.strip() for x in header.split(',') ]
+    return '*' in tags or etag in tags
+
+def conditionalResponse(request, etag, responseFactory):
+    """
+    Return a NotModifiedResponse if the client already has the entity
+    tagged etag, otherwise the response built by responseFactory, tagged
+    with etag. The response may be kept by the client, but has to be
+    revalidated before being used.
+    """
+    if etagMatches(request, etag):
+        return NotModifiedResponse(etag)
+    resp = responseFactory()
+    resp.headers['ETag'] = etag
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def _bodyEtag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+def conditionalXmlResponse(request, content):
+    """
+    Conditional version of XmlResponse. The entity tag comes from the
+    content hashes of the nodes. If they are all frozen already (the nodes
+    come from the listing cache), a matching request is answered without
+    serializing the body. Otherwise they are frozen here, as the content
+    does not change any more once it is sent.
+    """
+    etag = xmlNode.xmlNodeEtag(content, compute=False)
+    if etag is not None:
+        return conditionalResponse(request, etag,
+            lambda: XmlResponse(content))
+    xmlNode.freezeXmlNodeHashes(content)
+    body = XmlResponse.handler.toXml(content)
+    etag = xmlNode.xmlNodeEtag(content, compute=False)
+    if etag is None:
+        etag = _bodyEtag(body)
+    return conditionalResponse(request, etag,
+        lambda: XmlStringResponse(body))
+
+def conditionalSerializableObjectResponse(request, content):
+    """
+    Conditional version of XmlSerializableObjectResponse, tagged with the
+    hash of the serialized object
+    """
+    sio = StringIO.StringIO()
+    content.serialize(sio)
+    body = sio.getvalue()
+    return conditionalResponse(request, _bodyEtag(body),
+        lambda: XmlStringResponse(body))
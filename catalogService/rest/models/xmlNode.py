@@ -23,6 +23,25 @@ import urllib
 import rpath_xmllib as xmllib
 from conary.lib import digestlib
 
+class _Leaf(object):
+    """
+    Value of a simple (text, integer or boolean) sub-element
+    """
+    __slots__ = [ 'value' ]
+
+    def __init__(self, value):
+        self.value = value
+
+def _getter(slot):
+    def getter(self):
+        return self._get(slot)
+    return getter
+
+def _setter(slot):
+    def setter(self, value):
+        return self._set(slot, value)
+    return setter
+
 class BaseNode(xmllib.BaseNode):
     tag = None
     # Hint for a slot's type
@@ -64,36 +83,46 @@ class BaseNode(xmllib.BaseNode):
     def getAbsoluteName(self):
         return self.tag
 
-    def _iterChildren(self):
-        sublementsFound = False
+    @classmethod
+    def _getSerializationPlan(cls):
+        """
+        Return the names of the slots serialized as sub-elements, in
+        order, the names of the slots serialized as attributes, and
+        whether the node carries a content hash. This only depends on the
+        class, so it is only computed once.
+        """
+        plan = cls.__dict__.get('_serializationPlan')
+        if plan is not None:
+            return plan
         # Sometimes it's important to preserve the order in the slots
-        strictOrdering = getattr(self.__class__, 'StrictOrdering', False)
-        if strictOrdering:
-            iterator = iter(self.__slots__)
+        if getattr(cls, 'StrictOrdering', False):
+            children = cls.__slots__
         else:
-            iterator = sorted(set(self.__slots__))
+            children = sorted(set(cls.__slots__))
+        children = tuple(x for x in children
+            if not x.startswith('_') and x not in cls._slotAttributes)
+        plan = (children, tuple(cls._slotAttributes),
+            '_xmlNodeHash' in cls.__slots__)
+        cls._serializationPlan = plan
+        return plan
 
-        for fName in iterator:
-            if fName.startswith('_'):
-                continue
-            if fName in self._slotAttributes:
-                continue
+    def _iterChildren(self):
+        for fName in self._getSerializationPlan()[0]:
             fVal = getattr(self, fName)
-            if hasattr(fVal, "getElementTree"):
-                subelementsFound = True
+            if fVal.__class__ is _Leaf:
+                yield self._materialize(fName, fVal.value)
+            elif hasattr(fVal, "getElementTree"):
                 yield fVal
             if isinstance(fVal, MultiItemList):
                 for fv in fVal:
                     yield fv
-        # We don't allow for mixed content
-        if not sublementsFound:
-            text = self.getText()
-            if text:
-                yield text
+        text = self.getText()
+        if text:
+            yield text
 
     def _iterAttributes(self):
         ret = {}
-        for fName in self._slotAttributes:
+        for fName in self._getSerializationPlan()[1]:
             fVal = getattr(self, fName)
             if fVal is not None:
                 ret[fName] = str(fVal)
@@ -102,23 +131,57 @@ class BaseNode(xmllib.BaseNode):
     def addChild(self, node):
         nodeName = node.getName()
         if nodeName in self.__slots__:
+            self._resetHash()
             if self._setMultiItem(nodeName, node):
                 return
             else:
                 setattr(self, nodeName, node)
 
+    def _resetHash(self):
+        if self._getSerializationPlan()[2]:
+            self._xmlNodeHash = None
+
     def getElementTree(self, *args, **kwargs):
         eltree = xmllib.BaseNode.getElementTree(self, *args, **kwargs)
-        if '_xmlNodeHash' not in self.__slots__ or self._xmlNodeHash is not None:
+        if not self._getSerializationPlan()[2]:
             return eltree
-        # Compute the checksum
-        csum = digestlib.sha1()
-        csum.update(xmllib.etree.tostring(eltree, pretty_print = False,
-                    xml_declaration = False, encoding = 'UTF-8'))
-        self._xmlNodeHash = csum.hexdigest()
-        eltree.attrib['xmlNodeHash'] = self._xmlNodeHash
+        nodeHash = self._xmlNodeHash
+        if nodeHash is None:
+            # Not frozen: the node, or any node under it, may have changed
+            # since the last serialization, so the hash is not kept
+            csum = digestlib.sha1()
+            csum.update(xmllib.etree.tostring(eltree, pretty_print = False,
+                        xml_declaration = False, encoding = 'UTF-8'))
+            nodeHash = csum.hexdigest()
+        eltree.attrib['xmlNodeHash'] = nodeHash
         return eltree
 
+    def freezeXmlNodeHash(self):
+        """
+        Compute the content hash of the node and keep it, for nodes that
+        are not going to change any more, such as the ones stored in the
+        listing cache. Only _set and addChild on the node itself drop a
+        kept hash; changes to its children, or to its slots, do not.
+        """
+        if not self._getSerializationPlan()[2]:
+            return None
+        if self._xmlNodeHash is None:
+            self._xmlNodeHash = self.getXmlNodeHash()
+        return self._xmlNodeHash
+
+    def getXmlNodeHash(self, compute=True):
+        """
+        Return the content hash of the node, or None if the node does not
+        carry one. If compute is False, None is also returned when the
+        hash is not frozen (see freezeXmlNodeHash), instead of building
+        the element tree.
+        """
+        if not self._getSerializationPlan()[2]:
+            return None
+        if self._xmlNodeHash is None and compute:
+            return self.getElementTree().attrib['xmlNodeHash']
+        return self._xmlNodeHash
+
     # Magic function mapper
     def __getattr__(self, name):
         if name[:3] not in ['get', 'set']:
@@ -131,12 +194,17 @@ class BaseNode(xmllib.BaseNode):
             slot = name[3:]
             if slot not in self.__slots__:
                 raise AttributeError(name)
+        # Install the accessor in the class, so it is only resolved once
         if name[:3] == 'get':
-            return lambda: self._get(slot)
-        return lambda x: self._set(slot, x)
+            accessor = _getter(slot)
+        else:
+            accessor = _setter(slot)
+        setattr(self.__class__, name, accessor)
+        return getattr(self, name)
 
     def _set(self, key, value):
         setattr(self, key, None)
+        self._resetHash()
         if value is None:
             return self
         slotType = self._slotTypeMap.get(key)
@@ -158,25 +226,33 @@ class BaseNode(xmllib.BaseNode):
                 # the sub-nodes for this object
                 setattr(self, key, value)
                 return self
-        if slotType == bool or isinstance(slotType, xmllib.BooleanNode):
-            cls = xmllib.BooleanNode
-            value = cls.toString(value)
-        elif slotType == int or isinstance(value, int):
-            cls = xmllib.IntegerNode
-            value = str(value)
-        elif slotType == list:
+        isSimple = (slotType in (bool, int) or
+            isinstance(slotType, xmllib.BooleanNode) or
+            isinstance(value, int))
+        if not isSimple and slotType == list:
             coll = BaseNodeCollection()
             coll.tag = key
             coll.extend(xmllib.GenericNode().setName("item").characters(x)
                 for x in value)
             setattr(self, key, coll)
             return self
-        elif self._setMultiItem(key, value):
+        if not isSimple and self._setMultiItem(key, value):
             return self
+        # Simple values only become nodes when serialized (see _materialize)
+        setattr(self, key, _Leaf(value))
+        return self
+
+    def _materialize(self, key, value):
+        slotType = self._slotTypeMap.get(key)
+        if slotType == bool or isinstance(slotType, xmllib.BooleanNode):
+            cls = xmllib.BooleanNode
+            value = cls.toString(value)
+        elif slotType == int or isinstance(value, int):
+            cls = xmllib.IntegerNode
+            value = str(value)
         else:
             cls = xmllib.GenericNode
-        setattr(self, key, cls().setName(key).characters(value))
-        return self
+        return cls().setName(key).characters(value)
 
     def _setMultiItem(self, key, value):
         slotType = self._slotTypeMap.get(key)
@@ -204,6 +280,12 @@ class BaseNode(xmllib.BaseNode):
         if val is None:
             return None
         slotType = self._slotTypeMap.get(key)
+        if val.__class__ is _Leaf:
+            if (isinstance(val.value, basestring) and
+                    slotType not in (bool, int, list)):
+                # Would be a GenericNode with this text
+                return val.value
+            val = self._materialize(key, val.value)
         if slotType == bool:
             if hasattr(val, 'getText'):
                 val = val.getText()
@@ -279,7 +361,44 @@ class BaseMultiNode(BaseNode):
     def getId(self):
         return "%s: %s" % (self.tag, self.getText())
 
+def _iterMembers(content):
+    if isinstance(content, BaseNodeCollection):
+        return iter(content)
+    return iter([ content ])
+
+def freezeXmlNodeHashes(content):
+    """
+    Freeze the content hashes of a node or of the members of a
+    collection of nodes (see BaseNode.freezeXmlNodeHash)
+    """
+    for member in _iterMembers(content):
+        freezeXmlNodeHash = getattr(member, 'freezeXmlNodeHash', None)
+        if freezeXmlNodeHash is not None:
+            freezeXmlNodeHash()
 
+def xmlNodeEtag(content, compute=True):
+    """
+    Return a strong entity tag for a node or a collection of nodes, built
+    from the content hashes the nodes carry (xmlNodeHash), without
+    serializing the document. Returns None if some node carries no hash,
+    or, if compute is False, if some hash is not frozen.
+    """
+    if isinstance(content, BaseNodeCollection):
+        framing = (content.__class__.__name__, content.getName(),
+            sorted(content._attrs.items()))
+    else:
+        framing = None
+    csum = digestlib.sha1()
+    csum.update(repr(framing))
+    for member in _iterMembers(content):
+        getXmlNodeHash = getattr(member, 'getXmlNodeHash', None)
+        if getXmlNodeHash is None:
+            return None
+        nodeHash = getXmlNodeHash(compute=compute)
+        if nodeHash is None:
+            return None
+        csum.update(nodeHash)
+    return '"%s"' % csum.hexdigest()
 
 class Handler(xmllib.DataBinder):
     "Base xml handler"
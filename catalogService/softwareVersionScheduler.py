@@ -0,0 +1,159 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Scheduler for appliance software version checks.
+
+Every instance record carries the time of its next software version check
+(softwareVersionNextCheck), which SqliteInstanceStore keeps indexed.
+Instances are kept in one database per cloud type, so the scheduler asks
+each of these stores in turn for the instances that are due (one indexed
+query per cloud type), groups them per target (the store prefix, i.e.
+cloud name and user), splits the groups into batches and hands every
+batch to a single refresh call. Only a bounded number of batches run at
+the same time, so thousands of appliances becoming due together do not
+turn into one job, and one round trip to the target, per appliance.
+
+Nothing in catalog-service starts software version checks: the
+software-version-refresh jobs are created by rBuilder, and this tree only
+lists them. The scheduler is meant for an external caller that owns the
+refresh callable and the instance stores.
+"""
+
+import Queue
+import threading
+import time
+
+from catalogService import instanceStore
+
+class SoftwareVersionScheduler(object):
+    # Maximum number of instances refreshed by one call
+    BATCH_SIZE = 50
+    # Maximum number of refresh calls running at the same time
+    CONCURRENCY = 4
+    # Delay (in seconds) until the next check of a refreshed instance
+    CHECK_INTERVAL = 86400
+    # Delay (in seconds) until a failed batch is retried
+    RETRY_INTERVAL = 3600
+
+    def __init__(self, stores, refresh, batchSize=None, concurrency=None,
+            log=None):
+        """
+        stores maps cloud types to their instance store (see
+        SqliteInstanceStore.getStores). refresh is called with a cloud
+        type, a target prefix and a list of instance ids, and returns a
+        dictionary mapping instance ids to their software version.
+        Instances missing from the result keep their current version.
+        """
+        self.stores = stores
+        self.refresh = refresh
+        if batchSize is not None:
+            self.BATCH_SIZE = batchSize
+        if concurrency is not None:
+            self.CONCURRENCY = concurrency
+        if log is None:
+            log = lambda *args, **kwargs: None
+        self.log = log
+
+    @classmethod
+    def fromStoragePath(cls, storagePath, refresh, **kwargs):
+        """
+        Return a scheduler for the instances of all the cloud types kept
+        under storagePath
+        """
+        return cls(instanceStore.SqliteInstanceStore.getStores(storagePath),
+            refresh, **kwargs)
+
+    def getBatches(self, now=None, limit=None):
+        """
+        Return the list of (cloudType, prefix, instanceIds) batches due at
+        time now. Cloud types are sorted; within a cloud type, targets
+        come in the order their first instance became due. limit applies
+        to each cloud type.
+        """
+        ret = []
+        for cloudType in sorted(self.stores):
+            groups = {}
+            order = []
+            for prefix, instanceId in self.stores[
+                    cloudType].getDueSoftwareVersionChecks(now=now,
+                    limit=limit):
+                if prefix not in groups:
+                    groups[prefix] = []
+                    order.append(prefix)
+                groups[prefix].append(instanceId)
+            for prefix in order:
+                instanceIds = groups[prefix]
+                for i in range(0, len(instanceIds), self.BATCH_SIZE):
+                    ret.append((cloudType, prefix,
+                        instanceIds[i:i + self.BATCH_SIZE]))
+        return ret
+
+    def run(self, now=None, limit=None):
+        """
+        Refresh all the instances due at time now. Returns the number of
+        batches that failed.
+        """
+        if now is None:
+            now = time.time()
+        batches = self.getBatches(now=now, limit=limit)
+        if not batches:
+            return 0
+        queue = Queue.Queue()
+        for batch in batches:
+            queue.put(batch)
+        failures = []
+        workers = [ threading.Thread(target=self._worker,
+                args=(queue, now, failures))
+            for i in range(min(self.CONCURRENCY, len(batches))) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.log("Checked software versions: %d batches, %d failed" %
+            (len(batches), len(failures)))
+        return len(failures)
+
+    def _worker(self, queue, now, failures):
+        while 1:
+            try:
+                cloudType, prefix, instanceIds = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self._refreshBatch(cloudType, prefix, instanceIds, now)
+            except Exception, e:
+                self.log("Error checking software versions for %s/%s: %s" %
+                    (cloudType, prefix, e))
+                failures.append((cloudType, prefix, instanceIds))
+                self._reschedule(cloudType, prefix, instanceIds, now,
+                    self.RETRY_INTERVAL)
+
+    def _refreshBatch(self, cloudType, prefix, instanceIds, now):
+        versions = self.refresh(cloudType, prefix, instanceIds)
+        updates = dict((x, dict(
+                softwareVersionLastChecked=int(now),
+                softwareVersionNextCheck=int(now + self.CHECK_INTERVAL)))
+            for x in instanceIds)
+        for instanceId, version in versions.items():
+            if instanceId in updates:
+                updates[instanceId]['softwareVersion'] = version
+        self.stores[cloudType].withPrefix(prefix).updateMany(updates)
+
+    def _reschedule(self, cloudType, prefix, instanceIds, now, delay):
+        self.stores[cloudType].withPrefix(prefix).updateMany(dict(
+            (x, dict(softwareVersionNextCheck=int(now + delay)))
+            for x in instanceIds))
@@ -16,6 +16,13 @@
 #
 
 
+import cPickle
+import errno
+import hashlib
+import os
+import tempfile
+
+from conary.lib import util
 from rpath_storage import api1
 from catalogService import config
 
@@ -31,3 +38,92 @@ class StorageConfig(config.BaseConfig, api1.StorageConfig):
     def __init__(self, *args, **kwargs):
         config.BaseConfig.__init__(self)
         api1.StorageConfig.__init__(self, *args, **kwargs)
+
+class PackedDiskStorage(DiskStorage):
+    """
+    Disk storage that can read all the values of a collection at once.
+
+    Values are still stored one file per key, so writing a single key is
+    as atomic as it is with DiskStorage. Every write also records a new
+    generation token for the whole store. The first bulk read of a
+    collection packs all its keys and values in a single file, tagged
+    with the generation it was read at; further bulk reads only need the
+    token and the pack, until the next write invalidates it.
+    """
+
+    def __init__(self, cfg, packPath):
+        DiskStorage.__init__(self, cfg)
+        self.packPath = packPath
+
+    def set(self, key, val):
+        ret = DiskStorage.set(self, key, val)
+        self._newGeneration()
+        return ret
+
+    def delete(self, key):
+        ret = DiskStorage.delete(self, key)
+        self._newGeneration()
+        return ret
+
+    def store(self, *args, **kwargs):
+        ret = DiskStorage.store(self, *args, **kwargs)
+        self._newGeneration()
+        return ret
+
+    def newKey(self, *args, **kwargs):
+        ret = DiskStorage.newKey(self, *args, **kwargs)
+        self._newGeneration()
+        return ret
+
+    def getCollection(self, keyPrefix):
+        """
+        Return a tuple (etag, items) for the collection keyPrefix, where
+        items is the list of (key, value) in the order enumerate returns
+        them, and etag a strong entity tag for the items.
+        """
+        generation = self._readFile(self._getGenerationPath())
+        if generation is None:
+            generation = self._newGeneration()
+        packPath = self._getPackPath(keyPrefix)
+        data = self._readFile(packPath)
+        if data is not None:
+            pack = cPickle.loads(data)
+            if pack['generation'] == generation:
+                return pack['etag'], pack['items']
+        items = [ (x, self.get(x)) for x in self.enumerate(keyPrefix) ]
+        data = cPickle.dumps(items, cPickle.HIGHEST_PROTOCOL)
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self._writeFile(packPath, cPickle.dumps(dict(generation=generation,
+            etag=etag, items=items), cPickle.HIGHEST_PROTOCOL))
+        return etag, items
+
+    def _getGenerationPath(self):
+        return os.path.join(self.packPath, 'generation')
+
+    def _getPackPath(self, keyPrefix):
+        return os.path.join(self.packPath, 'packed',
+            hashlib.sha1(keyPrefix).hexdigest())
+
+    def _newGeneration(self):
+        generation = os.urandom(16).encode('hex')
+        self._writeFile(self._getGenerationPath(), generation)
+        return generation
+
+    @classmethod
+    def _readFile(cls, path):
+        try:
+            return file(path).read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    @classmethod
+    def _writeFile(cls, path, data):
+        dirName = os.path.dirname(path)
+        util.mkdirChain(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.tmp-')
+        f = os.fdopen(fd, "w")
+        f.write(data)
+        f.close()
+        os.rename(tmpPath, path)
@@ -0,0 +1,174 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import errno
+import mmap
+import os
+
+_zeroes = {}
+
+def isZero(block):
+    """
+    Return True if block consists of null bytes only
+    """
+    size = len(block)
+    zeroes = _zeroes.get(size)
+    if zeroes is None:
+        zeroes = '\0' * size
+        if size <= SparseBlockWriter.BUFFER_SIZE:
+            _zeroes[size] = zeroes
+    return block == zeroes
+
+class SparseBlockWriter(object):
+    """
+    Write-only file object for a disk image destination, typically a block
+    device.
+
+    Writes are coalesced into a large, page-aligned buffer and issued at
+    explicit offsets, with O_DIRECT if the device supports it. If the
+    destination is known to be zero-filled (a freshly created volume, or a
+    file that was just truncated), blocks of null bytes are skipped
+    instead of being written.
+    """
+    BUFFER_SIZE = 4 * 1024 * 1024
+    # Granularity of zero detection. Also the alignment O_DIRECT needs
+    BLOCK_SIZE = 4096
+
+    def __init__(self, path, skipZeroes=False, direct=True,
+            bufferSize=None):
+        if bufferSize is None:
+            bufferSize = self.BUFFER_SIZE
+        self.path = path
+        self.skipZeroes = skipZeroes
+        self.bytesWritten = 0
+        self.bytesSkipped = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+        self._directFd = None
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self._directFd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+            except OSError, e:
+                # Not supported by the file system (e.g. tmpfs)
+                if e.errno != errno.EINVAL:
+                    raise
+        # Anonymous maps are page-aligned, as required by O_DIRECT
+        self._buf = mmap.mmap(-1, bufferSize)
+        self._bufSize = bufferSize
+        self._bufStart = 0
+        self._bufLen = 0
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence != os.SEEK_SET:
+            raise IOError(errno.EINVAL, "Unsupported seek")
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self._pos
+        self.flush()
+        try:
+            os.ftruncate(self._fd, size)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror)
+
+    def write(self, data):
+        offset = self._pos
+        self._pos += len(data)
+        if not self.skipZeroes:
+            self._append(offset, data)
+            return
+        if isZero(data):
+            self._skip(len(data))
+            return
+        # Look for zero blocks, keeping them aligned to the device
+        idx = 0
+        dataLen = len(data)
+        while idx < dataLen:
+            end = min(dataLen,
+                idx + self.BLOCK_SIZE - (offset + idx) % self.BLOCK_SIZE)
+            block = data[idx:end]
+            if isZero(block):
+                self._skip(len(block))
+            else:
+                self._append(offset + idx, block)
+            idx = end
+
+    def _skip(self, size):
+        self.bytesSkipped += size
+
+    def _append(self, offset, data):
+        if self._bufLen and (offset != self._bufStart + self._bufLen or
+                self._bufLen + len(data) > self._bufSize):
+            self.flush()
+        if len(data) > self._bufSize:
+            self._writeAt(self._fd, offset, data)
+            return
+        if not self._bufLen:
+            self._bufStart = offset
+        self._buf[self._bufLen:self._bufLen + len(data)] = data
+        self._bufLen += len(data)
+
+    def flush(self):
+        if not self._bufLen:
+            return
+        start, length = self._bufStart, self._bufLen
+        self._bufLen = 0
+        if (self._directFd is not None and start % self.BLOCK_SIZE == 0
+                and length % self.BLOCK_SIZE == 0):
+            # Hand the aligned buffer to the kernel without copying it
+            try:
+                self._writeAt(self._directFd, start,
+                    buffer(self._buf, 0, length))
+                return
+            except OSError, e:
+                # The device wants a larger alignment; stop using O_DIRECT
+                if e.errno != errno.EINVAL:
+                    raise
+                os.close(self._directFd)
+                self._directFd = None
+        self._writeAt(self._fd, start, self._buf[:length])
+
+    def _writeAt(self, fd, offset, data):
+        os.lseek(fd, offset, os.SEEK_SET)
+        written = 0
+        while written < len(data):
+            written += os.write(fd, buffer(data, written))
+        self.bytesWritten += written
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            self.flush()
+            os.fsync(self._fd)
+        finally:
+            for fd in [ self._directFd, self._fd ]:
+                if fd is not None:
+                    os.close(fd)
+            self._fd = self._directFd = None
+            self._buf.close()
@@ -0,0 +1,432 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Minimal ISO9660 image writer, with Rock Ridge and Joliet extensions.
+
+This produces the same file tree as "mkisofs -r -J -graft-points" for the
+small images we attach to instances (the credentials ISO), without having
+to stage the files in a temporary directory and fork mkisofs for each
+launch. Only what that use case needs is supported: regular files whose
+contents are kept in memory, and the directories leading to them.
+
+As with mkisofs -r, files are owned by root and readable by everyone,
+directories are readable and searchable by everyone. Linux guests see the
+Rock Ridge names, Windows guests the Joliet names.
+"""
+
+import stat
+import string
+import struct
+import time
+from StringIO import StringIO
+
+SECTOR_SIZE = 2048
+
+def _both16(value):
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+def _both32(value):
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+def _pad(data, size=SECTOR_SIZE):
+    return data + '\0' * (-len(data) % size)
+
+class _File(object):
+    __slots__ = [ 'name', 'data', 'extent', 'names', ]
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.extent = 0
+        # Identifiers in the primary and Joliet trees
+        self.names = [ None, None ]
+
+class _Directory(object):
+    __slots__ = [ 'name', 'parent', 'dirs', 'files', 'names', 'extents',
+        'sizes', 'numbers', ]
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.dirs = {}
+        self.files = {}
+        # Per tree (primary, Joliet) attributes
+        self.names = [ None, None ]
+        self.extents = [ 0, 0 ]
+        self.sizes = [ 0, 0 ]
+        self.numbers = [ 0, 0 ]
+
+    def children(self, tree):
+        ret = self.dirs.values() + self.files.values()
+        ret.sort(key=lambda x: x.names[tree])
+        return ret
+
+class IsoImage(object):
+    PRIMARY, JOLIET = 0, 1
+
+    FILE_MODE = stat.S_IFREG | 0444
+    DIR_MODE = stat.S_IFDIR | 0555
+    # mkisofs pads images, some drives have trouble reading the last
+    # sectors otherwise
+    PAD_SECTORS = 150
+
+    # Longest file name we can fit in a directory record along with the
+    # other Rock Ridge entries (we do not use continuation areas for names)
+    MAX_NAME_LENGTH = 150
+
+    # Sectors 0-15 are the system area, followed by the primary, Joliet
+    # and terminator volume descriptors
+    _FIRST_FREE_SECTOR = 19
+
+    _erIdentifier = "RRIP_1991A"
+    _erDescriptor = ("THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT "
+        "FOR POSIX FILE SYSTEM SEMANTICS")
+    _erSource = ("PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  "
+        "SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR "
+        "CONTACT INFORMATION.")
+
+    def __init__(self, volumeId="CDROM", timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.volumeId = volumeId
+        self.timestamp = timestamp
+        self.root = _Directory('', None)
+
+    def addFile(self, path, data):
+        """
+        Add a file with the specified contents. Missing directories in path
+        are created.
+        """
+        components = [ x for x in path.split('/') if x ]
+        if not components:
+            raise ValueError("Invalid path %r" % path)
+        parent = self.root
+        for name in components[:-1]:
+            if name in parent.files:
+                raise ValueError("%s: not a directory" % path)
+            node = parent.dirs.get(name)
+            if node is None:
+                node = parent.dirs[name] = _Directory(name, parent)
+            parent = node
+        name = components[-1]
+        if name in parent.dirs:
+            raise ValueError("%s: is a directory" % path)
+        if len(name) > self.MAX_NAME_LENGTH:
+            raise ValueError("%s: file name too long" % path)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        parent.files[name] = _File(name, data)
+
+    def getvalue(self):
+        sio = StringIO()
+        self.write(sio)
+        return sio.getvalue()
+
+    def write(self, fobj):
+        """
+        Write the image to fobj. Returns the image size
+        """
+        self._assignNames(self.root)
+        dirs = [ self._listDirectories(x) for x in (self.PRIMARY, self.JOLIET) ]
+        self._layout(dirs)
+
+        size = 0
+        for chunk in self._iterChunks(dirs):
+            fobj.write(chunk)
+            size += len(chunk)
+        return size
+
+    # Names
+
+    _dCharacters = set(string.ascii_uppercase + string.digits + '_')
+
+    @classmethod
+    def _isoName(cls, name, isDir, taken):
+        def clean(s):
+            return ''.join(x in cls._dCharacters and x or '_'
+                for x in s.upper())
+        if isDir:
+            base, ext = name, None
+        else:
+            base, sep, ext = name.rpartition('.')
+            if not sep:
+                base, ext = ext, ''
+        base = prefix = clean(base)[:8] or '_'
+        if ext is not None:
+            ext = clean(ext)[:3]
+        counter = 0
+        while 1:
+            if isDir:
+                ret = base
+            else:
+                ret = "%s.%s;1" % (base, ext)
+            if ret not in taken:
+                taken.add(ret)
+                return ret
+            # Make the name unique, the way mkisofs does
+            counter += 1
+            suffix = str(counter)
+            base = prefix[:8 - len(suffix)] + suffix
+
+    @classmethod
+    def _jolietName(cls, name, isDir):
+        if not isinstance(name, unicode):
+            name = name.decode('utf-8')
+        if len(name) > 64:
+            # Joliet limit; mkisofs truncates too
+            name = name[:64]
+        if not isDir:
+            name += ';1'
+        return name.encode('utf-16-be')
+
+    def _assignNames(self, directory):
+        taken = set()
+        for name, node in sorted(directory.dirs.items()):
+            node.names = [ self._isoName(name, True, taken),
+                self._jolietName(name, True) ]
+            self._assignNames(node)
+        for name, node in sorted(directory.files.items()):
+            node.names = [ self._isoName(name, False, taken),
+                self._jolietName(name, False) ]
+
+    def _listDirectories(self, tree):
+        # Breadth-first, as required by the path table ordering
+        ret = [ self.root ]
+        idx = 0
+        while idx < len(ret):
+            directory = ret[idx]
+            idx += 1
+            directory.numbers[tree] = idx
+            ret.extend(x for x in directory.children(tree)
+                if isinstance(x, _Directory))
+        return ret
+
+    # Layout
+
+    def _layout(self, dirs):
+        sector = self._FIRST_FREE_SECTOR
+        self._ceSector = 0
+        self._pathTables = []
+        for tree in (self.PRIMARY, self.JOLIET):
+            tableSize = len(self._pathTable(dirs[tree], tree, '<'))
+            self._pathTables.append((tableSize, sector,
+                sector + _sectors(tableSize)))
+            sector += 2 * _sectors(tableSize)
+        for tree in (self.PRIMARY, self.JOLIET):
+            for directory in dirs[tree]:
+                # Record sizes do not depend on the extents, so it's safe
+                # to compute them before the extents are known
+                directory.sizes[tree] = len(self._directoryExtent(directory,
+                    tree))
+                directory.extents[tree] = sector
+                sector += _sectors(directory.sizes[tree])
+            if tree == self.PRIMARY:
+                # Continuation area, holding the Rock Ridge extension
+                # reference. Readers expect it after the root directory
+                self._ceSector = sector
+                sector += 1
+        for directory in dirs[self.PRIMARY]:
+            for node in directory.children(self.PRIMARY):
+                if isinstance(node, _File) and node.data:
+                    node.extent = sector
+                    sector += _sectors(len(node.data))
+        self._volumeSize = sector + self.PAD_SECTORS
+
+    def _iterChunks(self, dirs):
+        yield '\0' * (16 * SECTOR_SIZE)
+        yield self._volumeDescriptor(dirs, self.PRIMARY)
+        yield self._volumeDescriptor(dirs, self.JOLIET)
+        yield _pad('\xffCD001\x01')
+        for tree in (self.PRIMARY, self.JOLIET):
+            yield _pad(self._pathTable(dirs[tree], tree, '<'))
+            yield _pad(self._pathTable(dirs[tree], tree, '>'))
+        for tree in (self.PRIMARY, self.JOLIET):
+            for directory in dirs[tree]:
+                yield self._directoryExtent(directory, tree)
+            if tree == self.PRIMARY:
+                yield _pad(self._extensionReference())
+        for directory in dirs[self.PRIMARY]:
+            for node in directory.children(self.PRIMARY):
+                if isinstance(node, _File) and node.data:
+                    yield _pad(node.data)
+        yield '\0' * (self.PAD_SECTORS * SECTOR_SIZE)
+
+    # Structures
+
+    def _recordingDate(self):
+        t = time.gmtime(self.timestamp)
+        return struct.pack("7B", t.tm_year - 1900, t.tm_mon, t.tm_mday,
+            t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+    def _volumeDate(self):
+        t = time.gmtime(self.timestamp)
+        return time.strftime("%Y%m%d%H%M%S00", t) + '\0'
+
+    def _textField(self, text, size, tree):
+        if tree == self.JOLIET:
+            text = text.encode('utf-16-be')[:size]
+            # UCS-2 spaces
+            return text + ('\0 ' * size)[:size - len(text)]
+        return text[:size].ljust(size, ' ')
+
+    def _volumeDescriptor(self, dirs, tree):
+        root = dirs[tree][0]
+        tableSize, lTable, mTable = self._pathTables[tree]
+        if tree == self.JOLIET:
+            descType = 2
+            # UCS-2 level 3
+            escapes = '%/E'
+        else:
+            descType = 1
+            escapes = ''
+        text = lambda x, size: self._textField(x, size, tree)
+        vd = [
+            chr(descType), 'CD001', '\x01', '\0',
+            text('LINUX', 32),
+            text(self.volumeId, 32),
+            '\0' * 8,
+            _both32(self._volumeSize),
+            escapes.ljust(32, '\0'),
+            _both16(1),
+            _both16(1),
+            _both16(SECTOR_SIZE),
+            _both32(tableSize),
+            struct.pack("<I", lTable), struct.pack("<I", 0),
+            struct.pack(">I", mTable), struct.pack(">I", 0),
+            self._record(root, tree, '\0', self._location(root, tree),
+                systemUse=False),
+            text('', 128),
+            text('', 128),
+            text('', 128),
+            text('', 128),
+            text('', 37),
+            text('', 37),
+            text('', 37),
+            self._volumeDate(),
+            self._volumeDate(),
+            '0' * 16 + '\0',
+            self._volumeDate(),
+            '\x01',
+        ]
+        return _pad(''.join(vd))
+
+    @classmethod
+    def _location(cls, directory, tree):
+        return directory.extents[tree], directory.sizes[tree]
+
+    def _pathTable(self, dirs, tree, endian):
+        ret = []
+        for directory in dirs:
+            if directory.parent is None:
+                ident, parentNumber = '\0', 1
+            else:
+                ident = directory.names[tree]
+                parentNumber = directory.parent.numbers[tree]
+            ret.append(struct.pack("<BB", len(ident), 0))
+            ret.append(struct.pack(endian + "IH", directory.extents[tree],
+                parentNumber))
+            ret.append(ident)
+            if len(ident) % 2:
+                ret.append('\0')
+        return ''.join(ret)
+
+    def _directoryExtent(self, directory, tree):
+        parent = directory.parent or directory
+        records = [
+            self._record(directory, tree, '\0',
+                self._location(directory, tree), isSelf=True),
+            self._record(parent, tree, '\1', self._location(parent, tree)),
+        ]
+        for node in directory.children(tree):
+            if isinstance(node, _Directory):
+                location = self._location(node, tree)
+            else:
+                location = (node.extent, len(node.data))
+            records.append(self._record(node, tree, node.names[tree],
+                location, name=node.name))
+        sectors = []
+        current = ''
+        for record in records:
+            # Records may not cross sector boundaries
+            if len(current) + len(record) > SECTOR_SIZE:
+                sectors.append(_pad(current))
+                current = ''
+            current += record
+        sectors.append(_pad(current))
+        return ''.join(sectors)
+
+    def _record(self, node, tree, identifier, location, name=None,
+            isSelf=False, systemUse=True):
+        extent, size = location
+        isDir = isinstance(node, _Directory)
+        if systemUse and tree == self.PRIMARY:
+            systemUse = self._rockRidge(node, name,
+                isRoot=(isSelf and node.parent is None))
+        else:
+            # The root record in volume descriptors has no room for it
+            systemUse = ''
+        padding = len(identifier) % 2 == 0 and '\0' or ''
+        length = 33 + len(identifier) + len(padding) + len(systemUse)
+        if length % 2:
+            systemUse += '\0'
+            length += 1
+        return ''.join([
+            struct.pack("<BB", length, 0),
+            _both32(extent),
+            _both32(size),
+            self._recordingDate(),
+            struct.pack("<BBB", isDir and 2 or 0, 0, 0),
+            _both16(1),
+            chr(len(identifier)),
+            identifier,
+            padding,
+            systemUse,
+        ])
+
+    def _rockRidge(self, node, name, isRoot=False):
+        entries = []
+        if isRoot:
+            # SUSP indicator, has to come first
+            entries.append('SP\x07\x01\xbe\xef\x00')
+        if isinstance(node, _Directory):
+            mode = self.DIR_MODE
+            links = 2 + len(node.dirs)
+        else:
+            mode = self.FILE_MODE
+            links = 1
+        entries.append('PX\x24\x01' + _both32(mode) + _both32(links) +
+            _both32(0) + _both32(0))
+        entries.append('TF\x0c\x01\x02' + self._recordingDate())
+        if name is not None:
+            entries.append('NM' + chr(5 + len(name)) + '\x01\x00' + name)
+        if isRoot:
+            entries.append('CE\x1c\x01' + _both32(self._ceSector) +
+                _both32(0) + _both32(len(self._extensionReference())))
+        return ''.join(entries)
+
+    def _extensionReference(self):
+        return ''.join([
+            'ER',
+            struct.pack("6B", 8 + len(self._erIdentifier) +
+                len(self._erDescriptor) + len(self._erSource), 1,
+                len(self._erIdentifier), len(self._erDescriptor),
+                len(self._erSource), 1),
+            self._erIdentifier, self._erDescriptor, self._erSource,
+        ])
@@ -14,6 +14,8 @@
 # limitations under the License.
 #
 
+import hashlib
+import threading
 import time
 from conary.lib.util import copyfileobj
 
@@ -37,6 +39,60 @@ class PercentageCallback(object):
         self.callback(percent)
 
 
+class CoalescingHistory(object):
+    """
+    Rate-limit the progress entries written to a job's history.
+    Entries for the same series (for instance "Downloading image") are
+    passed on to emit at most once every interval seconds; the first and
+    the final entry of a series always go through. Series are tracked
+    separately, so two of them progressing at the same time (e.g. a
+    download and the decompression reading from it) are both coalesced.
+    The latest entries held back are written by flush(), which is to be
+    called before any other history entry is added and when the job
+    finishes.
+    Updates may come from several threads; emit is only ever called by
+    one of them at a time.
+    """
+
+    interval = 30
+
+    def __init__(self, emit, interval=None):
+        self.emit = emit
+        if interval is not None:
+            self.interval = interval
+        # Series in the order they started, with their pending entry and
+        # the time of their last emitted entry
+        self.series = []
+        self.pending = {}
+        self.when = {}
+        self._lock = threading.RLock()
+
+    def update(self, series, entry, final=False):
+        with self._lock:
+            if series not in self.when:
+                self.series.append(series)
+                self.when[series] = None
+            self.pending[series] = entry
+            now = time.time()
+            when = self.when[series]
+            if final or when is None or now - when >= self.interval:
+                self.when[series] = now
+                self._emit(series)
+            if final:
+                self.series.remove(series)
+                del self.when[series]
+
+    def flush(self):
+        with self._lock:
+            for series in self.series:
+                self._emit(series)
+
+    def _emit(self, series):
+        entry = self.pending.pop(series, None)
+        if entry is not None:
+            self.emit(entry)
+
+
 class Sink(object):
 
     @staticmethod
@@ -73,6 +129,61 @@ class StreamWithProgress(object):
 
         return data
 
+    def close(self):
+        return self.fobj.close()
+
+
+class StreamWithDigest(object):
+    """
+    Wrap a file stream and compute digests of the data as it is read, so
+    that content can be verified without reading it a second time.
+    expected maps algorithm names (as understood by hashlib) to the
+    expected hex digest.
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, fobj, expected=None, algorithms=None):
+        self.fobj = fobj
+        self.expected = dict((k, v.lower())
+            for (k, v) in (expected or {}).items() if v)
+        algorithms = set(algorithms or []).union(self.expected)
+        if not algorithms:
+            algorithms.add('sha1')
+        self.digests = dict((x, hashlib.new(x)) for x in algorithms)
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
+
+    _DEFAULT = object()
+    def read(self, size=_DEFAULT):
+        if size is self._DEFAULT:
+            data = self.fobj.read()
+        else:
+            data = self.fobj.read(size)
+        for digest in self.digests.itervalues():
+            digest.update(data)
+        return data
+
+    def hexdigest(self, algorithm='sha1'):
+        return self.digests[algorithm].hexdigest()
+
+    def drain(self):
+        """
+        Read (and digest) whatever is left in the stream
+        """
+        while self.read(self.BUFFER_SIZE):
+            pass
+
+    def verify(self):
+        """
+        Consume the rest of the stream, and return the sorted list of
+        algorithms for which the digest did not match the expected value
+        """
+        self.drain()
+        return sorted(k for (k, v) in self.expected.items()
+            if self.hexdigest(k) != v)
+
 
 def digestWithProgress(fobj, digest, callback):
     source = StreamWithProgress(fobj, callback)
@@ -18,17 +18,137 @@
 from collections import namedtuple
 import logging
 import math
+import multiprocessing
 import os
+import Queue
 import struct
 import sys
+import threading
+import time
 import zlib
 
 log = logging.getLogger(__name__)
 
+class GrainPipeline(object):
+    """
+    Decompress grains on a pool of worker threads (zlib releases the GIL
+    while inflating), and write them out from a single writer thread, in
+    the order they were submitted.
+    At most maxPending grains are in flight at any time; submit() blocks
+    until the writer catches up.
+    """
+    __slots__ = [ '_fout', '_callback', '_maxPending', '_workQueue',
+        '_results', '_cond', '_submitted', '_written', '_stopped', '_error',
+        '_workers', '_writer', ]
+
+    def __init__(self, fout, threads, maxPending, callback=None):
+        if callback is None:
+            callback = lambda *args, **kwargs: None
+        self._fout = fout
+        self._callback = callback
+        self._maxPending = maxPending
+        self._workQueue = Queue.Queue()
+        self._results = {}
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._written = 0
+        self._stopped = False
+        self._error = None
+        self._workers = [ self._startThread(self._work, "vmdk-inflate-%d" % i)
+            for i in range(threads) ]
+        self._writer = self._startThread(self._write, "vmdk-write")
+
+    @classmethod
+    def _startThread(cls, target, name):
+        thr = threading.Thread(target=target, name=name)
+        thr.setDaemon(True)
+        thr.start()
+        return thr
+
+    def submit(self, offset, data, pos):
+        """
+        Queue compressed grain data to be written at offset. pos is passed
+        to the callback once the grain was written.
+        """
+        with self._cond:
+            while (self._submitted - self._written >= self._maxPending and
+                    self._error is None):
+                self._cond.wait()
+            self._checkError()
+            seq = self._submitted
+            self._submitted += 1
+        self._workQueue.put((seq, offset, data, pos))
+
+    def finish(self, abort=False):
+        """
+        Wait for all submitted grains to be written (unless abort is
+        set), and stop the threads
+        """
+        for thr in self._workers:
+            self._workQueue.put(None)
+        with self._cond:
+            while (not abort and self._written < self._submitted and
+                    self._error is None):
+                self._cond.wait()
+            self._stopped = True
+            self._cond.notifyAll()
+        for thr in self._workers + [ self._writer ]:
+            thr.join()
+        self._checkError()
+
+    def _checkError(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _setError(self):
+        with self._cond:
+            if self._error is None:
+                self._error = sys.exc_info()
+            self._cond.notifyAll()
+
+    def _work(self):
+        while 1:
+            item = self._workQueue.get()
+            if item is None:
+                return
+            seq, offset, data, pos = item
+            try:
+                data = zlib.decompress(data)
+            except Exception:
+                self._setError()
+                return
+            with self._cond:
+                self._results[seq] = (offset, data, pos)
+                self._cond.notifyAll()
+
+    def _write(self):
+        fout = self._fout
+        while 1:
+            with self._cond:
+                while (self._written not in self._results and
+                        not self._stopped and self._error is None):
+                    self._cond.wait()
+                if self._stopped or self._error is not None:
+                    return
+                offset, data, pos = self._results.pop(self._written)
+            try:
+                fout.seek(offset)
+                fout.write(data)
+                self._callback(pos, fout.tell())
+            except Exception:
+                self._setError()
+                return
+            with self._cond:
+                self._written += 1
+                self._cond.notifyAll()
+
 class VMDKReader(object):
     __slots__ = ['_streamIn', '_streamOut', '_pos', 'header', 'descriptor',
-            'callback', '_gdSize', '_numGTs', ]
+            'callback', '_gdSize', '_numGTs', 'threads', ]
     _SECT = 512
+    # Number of grains that may be read ahead of the writer, per
+    # decompression thread. Grains are 64KiB once decompressed.
+    PENDING_GRAINS_PER_THREAD = 16
     _HEADER = namedtuple('Header', 'magicNumber version flags capacity '
         'grainSize descriptorOffset descriptorSize numGTEsPerGT rgdOffset '
         'gdOffset overHead uncleanShutdown singleEndLineChar nonEndLineChar '
@@ -134,7 +254,18 @@ class VMDKReader(object):
                 return []
             return [0] * self._gdSize
 
-    def __init__(self, fobj, outputStream, callback=None):
+    def __init__(self, fobj, outputStream, callback=None, threads=None):
+        """
+        threads is the number of threads used to decompress grains; it
+        defaults to the number of CPUs. With 1, grains are decompressed
+        inline.
+        """
+        if threads is None:
+            try:
+                threads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                threads = 1
+        self.threads = threads
         self._streamIn = fobj
         self._streamOut = outputStream
         self._streamOut.seek(0)
@@ -190,6 +321,39 @@ class VMDKReader(object):
 
         # skip over the overhead
         self._seek(self.header.overHead * self._SECT, 0)
+        if self.threads > 1:
+            pipeline = GrainPipeline(fout, self.threads,
+                self.threads * self.PENDING_GRAINS_PER_THREAD,
+                callback=self.callback)
+        else:
+            pipeline = None
+        try:
+            self._processGrains(fout, pipeline)
+        except:
+            if pipeline is not None:
+                # Do not leave threads behind; the original exception is
+                # more interesting than whatever the pipeline has to say
+                try:
+                    pipeline.finish(abort=True)
+                except Exception:
+                    pass
+            raise
+        if pipeline is not None:
+            pipeline.finish()
+
+        footerMarker = self._readMarker()
+        self.assertEquals(footerMarker.type, self.Marker.FOOTER)
+        footer = self._HEADER(*struct.unpack("<4sIIQQQQIQQQBccccI431s",
+            footerMarker.metadata))
+        self.assertEquals(footer.magicNumber, 'KDMV')
+        eosMarker = self._readMarker()
+        self.assertEquals(eosMarker.type, self.Marker.EOS)
+
+    def _processGrains(self, fout, pipeline):
+        """
+        Read grains and grain tables up to the grain directory. Grains are
+        written to fout, or handed over to pipeline if set.
+        """
         grainTable = self.GrainTable()
         grainDirectory = self.GrainDirectory(self._gdSize)
         while 1:
@@ -207,21 +371,17 @@ class VMDKReader(object):
                     self.assertEquals(marker.metadata, grainDirectory.asTuple())
                     # We're done reading extents, we now need to read
                     # the footer
-                    break
+                    return
                 continue
             log.debug("Data: %08x: %d bytes", marker.lba, marker.size)
-            fout.seek(marker.lba * self._SECT)
-            fout.write(zlib.decompress(marker.data))
+            if pipeline is not None:
+                pipeline.submit(marker.lba * self._SECT, marker.data,
+                    self._pos)
+            else:
+                fout.seek(marker.lba * self._SECT)
+                fout.write(zlib.decompress(marker.data))
+                self.callback(self._pos, fout.tell())
             grainTable.add(marker)
-            self.callback(self._pos, fout.tell())
-
-        footerMarker = self._readMarker()
-        self.assertEquals(footerMarker.type, self.Marker.FOOTER)
-        footer = self._HEADER(*struct.unpack("<4sIIQQQQIQQQBccccI431s",
-            footerMarker.metadata))
-        self.assertEquals(footer.magicNumber, 'KDMV')
-        eosMarker = self._readMarker()
-        self.assertEquals(eosMarker.type, self.Marker.EOS)
 
     def inspectNonStreamOptimized(self):
         fout = self.outputStream
@@ -321,14 +481,23 @@ class VMDKReader(object):
 
 def main():
     logging.basicConfig(level=logging.INFO)
-    if len(sys.argv) < 2:
-        print "Usage: %s <file-in> <file-out>" % sys.argv[0]
+    if len(sys.argv) < 3:
+        print "Usage: %s <file-in> <file-out> [<threads>]" % sys.argv[0]
         return 1
     vmdkFile = file(sys.argv[1])
     fileOut = file(sys.argv[2], "w")
+    threads = None
+    if len(sys.argv) > 3:
+        threads = int(sys.argv[3])
     cb = Callback(os.fstat(vmdkFile.fileno()).st_size or 1)
-    vmdk = VMDKReader(vmdkFile, fileOut, callback=cb.callback)
+    vmdk = VMDKReader(vmdkFile, fileOut, callback=cb.callback,
+        threads=threads)
+    start = time.time()
     vmdk.process()
+    elapsed = max(time.time() - start, 1e-6)
+    size = vmdk.header.capacity * VMDKReader._SECT / Callback.MB
+    log.info("Extracted %.1f MB with %d thread(s) in %.2fs: %.1f MB/s",
+        size, vmdk.threads, elapsed, size / elapsed)
 
 class Callback(namedtuple("Callback", "size")):
     MB = 1024 * 1024.0
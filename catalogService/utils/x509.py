@@ -17,7 +17,13 @@
 
 "Simple module for generating x509 certificates"
 
+import errno
+import fcntl
 import os
+import tempfile
+import threading
+
+from conary.lib import util
 from rmake3.lib import gencert
 
 class X509(object):
@@ -71,3 +77,142 @@ class X509(object):
     def computeHashFromX509(cls, x509):
         certHash = "%08x" % x509.get_issuer().as_hash()
         return certHash
+
+class X509Pool(object):
+    """
+    Directory of pre-generated certificates and keys.
+
+    Generating an RSA key is the most expensive part of setting up a
+    launch. The pool is refilled in the background, and a launch only has
+    to move a ready-made pair into its own directory. Several processes
+    can share the pool: a pair is claimed with an atomic rename, and a
+    lock file makes sure only one process refills the pool at a time.
+    Pairs are generated in a temporary directory and renamed into the
+    pool; whatever a refill cut short by the exit of its process left
+    behind is removed by the next refill.
+    """
+    DEFAULT_DEPTH = 10
+
+    def __init__(self, poolDir, depth=None, log=None):
+        if depth is None:
+            depth = self.DEFAULT_DEPTH
+        self.poolDir = poolDir
+        self.depth = depth
+        if log is None:
+            log = lambda *args, **kwargs: None
+        self.log = log
+        self._tmpDir = os.path.join(poolDir, 'tmp')
+        self._lockPath = os.path.join(poolDir, 'lock')
+
+    def _listCerts(self):
+        try:
+            fileNames = os.listdir(self.poolDir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(x for x in fileNames if x.endswith('.0'))
+
+    def __len__(self):
+        return len(self._listCerts())
+
+    def take(self, certDir):
+        """
+        Move a certificate and its key into certDir.
+        Returns absolute paths to the cert file and key file, or None if
+        the pool is empty
+        """
+        for fileName in self._listCerts():
+            certFile = os.path.join(certDir, fileName)
+            keyFile = certFile + '.key'
+            try:
+                # Whoever renames the certificate first owns the pair
+                os.rename(os.path.join(self.poolDir, fileName), certFile)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                os.rename(os.path.join(self.poolDir, fileName + '.key'),
+                    keyFile)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                util.removeIfExists(certFile)
+                continue
+            return certFile, keyFile
+        return None
+
+    def fill(self, commonNameFactory, generate=None):
+        """
+        Generate certificates until the pool is full. commonNameFactory()
+        returns the common name for a new certificate.
+        Returns the number of certificates generated; if another process
+        is already filling the pool, nothing is done.
+        """
+        if generate is None:
+            generate = X509.new
+        util.mkdirChain(self._tmpDir)
+        os.chmod(self.poolDir, 0700)
+        lockf = file(self._lockPath, "a")
+        try:
+            try:
+                fcntl.flock(lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return 0
+            self._cleanUp()
+            count = 0
+            while len(self) < self.depth:
+                self._generate(commonNameFactory(), generate)
+                count += 1
+            return count
+        finally:
+            lockf.close()
+
+    def _cleanUp(self):
+        """
+        Remove what a refill interrupted by the end of its process left
+        behind. Must be called with the refill lock held: nothing else is
+        generating then.
+        """
+        for fileName in os.listdir(self._tmpDir):
+            util.rmtree(os.path.join(self._tmpDir, fileName),
+                ignore_errors=True)
+        fileNames = set(os.listdir(self.poolDir))
+        for fileName in fileNames:
+            # A key whose certificate never made it into the pool. If a
+            # take is moving the pair right now, it will just move on to
+            # the next pair
+            if fileName.endswith('.0.key') and fileName[:-4] not in fileNames:
+                util.removeIfExists(os.path.join(self.poolDir, fileName))
+
+    def _generate(self, commonName, generate):
+        tmpDir = tempfile.mkdtemp(dir=self._tmpDir)
+        try:
+            certFile, keyFile = generate(commonName, certDir=tmpDir)
+            os.chmod(keyFile, 0600)
+            fileName = os.path.basename(certFile)
+            # The key goes in first, so a visible certificate always has
+            # its key next to it
+            os.rename(keyFile, os.path.join(self.poolDir, fileName + '.key'))
+            os.rename(certFile, os.path.join(self.poolDir, fileName))
+        finally:
+            util.rmtree(tmpDir, ignore_errors=True)
+
+    def fillInBackground(self, commonNameFactory, generate=None):
+        thread = threading.Thread(target=self._fillInBackground,
+            args=(commonNameFactory, generate))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _fillInBackground(self, commonNameFactory, generate):
+        try:
+            count = self.fill(commonNameFactory, generate=generate)
+        except Exception, e:
+            self.log("Error refilling the certificate pool: %s" % (e, ))
+            return
+        if count:
+            self.log("Added %d certificates to the pool" % count)
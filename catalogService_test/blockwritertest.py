@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService.utils import blockwriter
+
+class SparseBlockWriterTest(testcase.TestCaseWithWorkDir):
+    def _chunks(self):
+        block = blockwriter.SparseBlockWriter.BLOCK_SIZE
+        return [
+            # offset, data
+            (0, 'a' * block),
+            (block, '\0' * 3 * block),
+            # Partly zero, not aligned
+            (4 * block + 100, '\0' * block + 'b' * 10 + '\0' * 2000),
+            (10 * block, '\0' * 10 * block),
+            # Contiguous with the previous one
+            (20 * block, 'c' * block + '\0' * block + 'd' * 512),
+        ]
+
+    def _write(self, path, size, **kwargs):
+        writer = blockwriter.SparseBlockWriter(path, bufferSize=8192,
+            **kwargs)
+        with writer:
+            writer.seek(size)
+            writer.truncate()
+            for offset, data in self._chunks():
+                writer.seek(offset)
+                writer.write(data)
+                self.failUnlessEqual(writer.tell(), offset + len(data))
+        return writer
+
+    def _expected(self, size):
+        expected = [ '\0' ] * size
+        for offset, data in self._chunks():
+            expected[offset:offset + len(data)] = list(data)
+        return ''.join(expected)
+
+    def testWrite(self):
+        size = 24 * blockwriter.SparseBlockWriter.BLOCK_SIZE
+        expected = self._expected(size)
+        totalBytes = sum(len(x[1]) for x in self._chunks())
+        for direct in [ True, False ]:
+            path = os.path.join(self.workDir, "full-%s" % direct)
+            writer = self._write(path, size, direct=direct)
+            self.failUnlessEqual(file(path).read(), expected)
+            self.failUnlessEqual(writer.bytesWritten, totalBytes)
+            self.failUnlessEqual(writer.bytesSkipped, 0)
+
+            path = os.path.join(self.workDir, "sparse-%s" % direct)
+            writer = self._write(path, size, direct=direct, skipZeroes=True)
+            self.failUnlessEqual(file(path).read(), expected)
+            # Only the blocks with data in them got written
+            self.failUnlessEqual(writer.bytesWritten, 4096 + 2110 + 4096 + 512)
+            self.failUnlessEqual(writer.bytesSkipped,
+                totalBytes - writer.bytesWritten)
+
+    def testIsZero(self):
+        self.failUnless(blockwriter.isZero(''))
+        self.failUnless(blockwriter.isZero('\0' * 65536))
+        self.failIf(blockwriter.isZero('\0' * 65535 + '\1'))
+        self.failIf(blockwriter.isZero('\1' + '\0' * 10))
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService import clientPool
+
+class ClientPoolTest(testcase.TestCase):
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.created = []
+        self.released = []
+        self.forgotten = []
+
+    def _factory(self, name):
+        def factory():
+            client = "%s-%d" % (name, len(self.created))
+            self.created.append(client)
+            return client
+        return factory
+
+    def _get(self, pool, key, name='client', healthCheck=None, owner=None):
+        client = pool.get(key, self._factory(name), healthCheck=healthCheck,
+            release=self.released.append, forget=self.forgotten.append,
+            owner=owner)
+        if owner is None:
+            pool.checkIn(client)
+        return client
+
+    def testMakeKey(self):
+        key1 = clientPool.ClientPool.makeKey('vmware', 'vc1',
+            dict(username='user', password=u'pass\xe9'), dict(port=443))
+        key2 = clientPool.ClientPool.makeKey('vmware', 'vc1',
+            dict(username='user', password=u'pass\xe9'), dict(port=443))
+        self.failUnlessEqual(key1, key2)
+        self.failUnlessEqual(key1[:2], ('vmware', 'vc1'))
+        # Credentials are not stored in clear
+        self.failIf('pass' in key1[2])
+        key3 = clientPool.ClientPool.makeKey('vmware', 'vc1',
+            dict(username='user', password='other'), dict(port=443))
+        self.failIfEqual(key1, key3)
+        # Changing the target configuration invalidates the client too
+        key4 = clientPool.ClientPool.makeKey('vmware', 'vc1',
+            dict(username='user', password=u'pass\xe9'), dict(port=8443))
+        self.failIfEqual(key1, key4)
+
+    def testReuse(self):
+        pool = clientPool.ClientPool()
+        key = ('ec2', 'aws', 'abc')
+        self.failUnlessEqual(self._get(pool, key), 'client-0')
+        self.failUnlessEqual(self._get(pool, key), 'client-0')
+        self.failUnlessEqual(self.created, ['client-0'])
+
+        other = ('ec2', 'aws', 'def')
+        self.failUnlessEqual(self._get(pool, other), 'client-1')
+        self.failUnlessEqual(len(pool), 2)
+
+    def testCheckOut(self):
+        pool = clientPool.ClientPool()
+        key = ('vmware', 'vc1', 'abc')
+        class Owner(object):
+            pass
+        owner1, owner2 = Owner(), Owner()
+        # Drivers using the target at the same time get their own client
+        self.failUnlessEqual(self._get(pool, key, owner=owner1), 'client-0')
+        client = self._get(pool, key, owner=owner2)
+        self.failUnlessEqual(client, 'client-1')
+        self.failUnlessEqual(len(pool), 2)
+        # Once a driver is gone, its client is handed out again
+        del owner1
+        owner3 = Owner()
+        self.failUnlessEqual(self._get(pool, key, owner=owner3), 'client-0')
+        pool.checkIn(client)
+        self.failUnlessEqual(self._get(pool, key), 'client-1')
+        self.failUnlessEqual(self.created, ['client-0', 'client-1'])
+
+        # Clients dropped while in use are logged out when checked in
+        client = pool.get(key, self._factory('client'),
+            release=self.released.append)
+        self.failUnlessEqual(client, 'client-1')
+        pool.invalidate(key)
+        self.failUnlessEqual(self.released, [])
+        del owner3
+        self.failUnlessEqual(self.released, ['client-0'])
+        self.failUnlessEqual(len(pool), 0)
+        pool.checkIn(client)
+        self.failUnlessEqual(sorted(self.released), ['client-0', 'client-1'])
+
+    def testExpiration(self):
+        pool = clientPool.ClientPool(ttl=0)
+        key = ('ec2', 'aws', 'abc')
+        self.failUnlessEqual(self._get(pool, key), 'client-0')
+        self.failUnlessEqual(self._get(pool, key), 'client-1')
+        self.failUnlessEqual(self.released, ['client-0'])
+
+    def testHealthCheck(self):
+        pool = clientPool.ClientPool(checkInterval=0)
+        key = ('vcloud', 'vc', 'abc')
+        valid = [True]
+        healthCheck = lambda client: valid[0]
+        self.failUnlessEqual(self._get(pool, key, healthCheck=healthCheck),
+            'client-0')
+        self.failUnlessEqual(self._get(pool, key, healthCheck=healthCheck),
+            'client-0')
+        # Session expired, log in again
+        valid[0] = False
+        self.failUnlessEqual(self._get(pool, key, healthCheck=healthCheck),
+            'client-1')
+        self.failUnlessEqual(self.released, ['client-0'])
+
+        # Failing health checks count as invalid sessions
+        def healthCheck(client):
+            raise Exception("boom")
+        self.failUnlessEqual(self._get(pool, key, healthCheck=healthCheck),
+            'client-2')
+
+    def testMaxSize(self):
+        pool = clientPool.ClientPool(maxSize=2)
+        self._get(pool, ('t', 'a', '1'))
+        self._get(pool, ('t', 'b', '1'))
+        # Use a, so b is the least recently used one
+        self._get(pool, ('t', 'a', '1'))
+        self._get(pool, ('t', 'c', '1'))
+        self.failUnlessEqual(len(pool), 2)
+        self.failUnlessEqual(self.released, ['client-1'])
+        self.failUnless(('t', 'a', '1') in pool)
+        self.failIf(('t', 'b', '1') in pool)
+
+        # Clients in use are not evicted
+        class Owner(object):
+            pass
+        owner = Owner()
+        self._get(pool, ('t', 'a', '1'), owner=owner)
+        self._get(pool, ('t', 'c', '1'), owner=owner)
+        self._get(pool, ('t', 'd', '1'), owner=owner)
+        self.failUnlessEqual(len(pool), 3)
+
+    def testInvalidate(self):
+        pool = clientPool.ClientPool()
+        self._get(pool, ('vmware', 'vc1', '1'))
+        self._get(pool, ('vmware', 'vc1', '2'))
+        self._get(pool, ('vmware', 'vc2', '1'))
+        pool.invalidateTarget('vmware', 'vc1')
+        self.failUnlessEqual(sorted(self.released), ['client-0', 'client-1'])
+        self.failUnlessEqual(len(pool), 1)
+        pool.invalidate(('vmware', 'vc2', '1'))
+        self.failUnlessEqual(len(pool), 0)
+
+    def testForgetAll(self):
+        pool = clientPool.ClientPool()
+        self._get(pool, ('vmware', 'vc1', '1'))
+        pool.forgetAll()
+        self.failUnlessEqual(self.forgotten, ['client-0'])
+        self.failUnlessEqual(self.released, [])
+        self.failUnlessEqual(len(pool), 0)
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -20,17 +20,22 @@ import testsuite
 # Bootstrap the testsuite
 testsuite.setup()
 
+import hashlib
 import os
+import sqlite3
 import StringIO
+import threading
 import time
 import tempfile
 
+from catalogService import errors
 from catalogService.rest import baseDriver
 from catalogService.rest.drivers import ec2 as d_ec2
 from catalogService.rest.models import instances
 
 from catalogService_test import testbase
 import mockedData
+import vmdk_extracttest
 
 class EC2Test(testbase.TestCase):
     TARGETS = [
@@ -140,6 +145,23 @@ class EC2Test(testbase.TestCase):
             dict(id=x.getId(), longName=x.getLongName(), state = x.getState(),
                  isPublic = x.getIsPublic()) for x in data], expected)
 
+    def testGetAllImagesMintQueries(self):
+        drv = self._createDriver()
+        self._fakeMakeRequest(drv, DescribeImages = mockedData.xml_getAllImages1)
+        queries = []
+        origGetMintImagesByType = drv._getMintImagesByType
+        def getMintImagesByType(imageType):
+            queries.append(imageType)
+            return origGetMintImagesByType(imageType)
+        self.mock(drv, '_getMintImagesByType', getMintImagesByType)
+
+        data = drv.getAllImages()
+        self.failUnlessEqual([ x.getImageId() for x in data ],
+            [ 'aaaaaabbbbbbbbbcccccccccccddddddddeeeeee', 'ami-0435d06d' ])
+        # The same rBuilder images pick the target images to describe and
+        # complete the listing
+        self.failUnlessEqual(queries, [ drv.RBUILDER_BUILD_TYPE ])
+
     def testGetAllInstances(self):
         drv = self._createDriver()
 
@@ -211,6 +233,37 @@ class EC2Test(testbase.TestCase):
                  cloudAlias = x.getCloudAlias()) for x in data] 
         self.failUnlessEqual(dataList, expected)
 
+    def testGetAllInstancesSingleImageLookup(self):
+        drv = self._createDriver()
+
+        self._fakeMakeRequest(drv,
+            DescribeInstances = mockedData.xml_getAllInstances1,
+            DescribeImages = mockedData.xml_getAllImages3)
+
+        data = drv.getAllInstances()
+        self.failUnlessEqual([ x.getReservationId() for x in data ],
+            [ 'r-698a7500', 'r-0af30c63' ])
+        # Images are looked up once for all reservations
+        self.failUnlessEqual([ x[0] for x in self._invocations ],
+            [ 'DescribeInstances', 'DescribeImages' ])
+
+    def testPublicImageCache(self):
+        cache = d_ec2.ec2client.PublicImageCache(
+            os.path.join(self.workDir, "public-images"), ttl=100)
+        self.failUnlessEqual(cache.get('ami-00000001'), (False, None))
+        imageData = dict(id='ami-00000001', ownerId='123', location=None,
+            state='available', isPublic=True, productCodes=['a'])
+        cache.set('ami-00000001', imageData, now=1000)
+        # Negative entries are cached too
+        cache.set('ami-00000002', None, now=1000)
+        self.failUnlessEqual(cache.get('ami-00000001', now=1050),
+            (True, imageData))
+        self.failUnlessEqual(cache.get('ami-00000002', now=1050),
+            (True, None))
+        # Expired
+        self.failUnlessEqual(cache.get('ami-00000001', now=1100),
+            (False, None))
+
     def testNewInstance(self):
 
         drv = self._createDriver()
@@ -348,6 +401,73 @@ class EC2Test(testbase.TestCase):
 
         return drv
 
+    def _makeDiskImage(self):
+        GRAIN_SIZE = vmdk_extracttest.GRAIN_SIZE
+        capacity = 64 * GRAIN_SIZE
+        # Nothing is allocated at the end of the disk
+        grains = dict((lba * GRAIN_SIZE, data) for lba, data in enumerate(
+            vmdk_extracttest.makeGrains(capacity, 8).values()))
+        vmdk = vmdk_extracttest.makeStreamOptimizedVMDK(capacity, grains)
+        return vmdk, capacity * vmdk_extracttest.SECT
+
+    def testWriteDiskImage(self):
+        drv = self._createDriver()
+        vmdk, diskSize = self._makeDiskImage()
+        progress = []
+        self.mock(drv, '_progress',
+            lambda job, message, percent: progress.append((message, percent)))
+        history = []
+        devFile = tempfile.NamedTemporaryFile()
+        drv._writeDiskImage(self.Job(history), devFile.name,
+            StringIO.StringIO(vmdk), diskSize)
+
+        percents = [ x[1] for x in progress ]
+        self.failUnlessEqual(set(x[0] for x in progress),
+            set([ "Uncompressing image" ]))
+        self.failUnlessEqual(percents[:8], [ 1, 3, 4, 6, 7, 9, 10, 12 ])
+        self.failUnlessEqual(percents[8:], [ 100 ])
+        self.failUnlessEqual(os.path.getsize(devFile.name), diskSize)
+
+    def testWriteDiskImageHistory(self):
+        # Grains are written, and their progress reported, by the reader's
+        # writer thread while the main thread reports the download
+        self.mock(vmdk_extracttest.vmdk_extract.multiprocessing, 'cpu_count',
+            lambda: 4)
+        drv = self._createDriver()
+        vmdk, diskSize = self._makeDiskImage()
+
+        class Job(object):
+            def __init__(slf):
+                slf.entries = []
+                slf.threads = set()
+                slf.active = 0
+                slf.maxActive = 0
+            def addHistoryEntry(slf, entry):
+                slf.active += 1
+                slf.maxActive = max(slf.maxActive, slf.active)
+                time.sleep(0.001)
+                slf.entries.append(entry)
+                slf.threads.add(threading.currentThread())
+                slf.active -= 1
+        job = Job()
+        devFile = tempfile.NamedTemporaryFile()
+        stream = drv.streamProgressWrapper(job, StringIO.StringIO(vmdk),
+            "Downloading compressed disk image")
+        drv._writeDiskImage(job, devFile.name, stream, diskSize)
+
+        self.failUnlessEqual(job.maxActive, 1)
+        self.failUnlessEqual(len(job.threads), 2)
+        downloads = [ x for x in job.entries if x.startswith('Downloading') ]
+        self.failUnlessEqual(downloads[0],
+            'Downloading compressed disk image: 0%')
+        # Both series are coalesced: the download does not force out
+        # every step of the decompression
+        uncompress = [ x for x in job.entries if x.startswith('Uncompress') ]
+        self.failUnlessEqual(uncompress[0], 'Uncompressing image: 1%')
+        self.failUnlessEqual(uncompress[-1], 'Uncompressing image: 100%')
+        self.failIf(len(uncompress) > 3, uncompress)
+        self.failUnless(job.entries[-1].startswith('Disk image written'))
+
     def testDeployImageEBS(self):
         drv = self._setupMocking()
         job = self.Job(list())
@@ -365,8 +485,16 @@ class EC2Test(testbase.TestCase):
   <imageName>ignoreme1</imageName>
 </descriptor_data>
 """
+        invalidated = []
+        def invalidateListings(kinds=None):
+            invalidated.append(kinds)
+            raise sqlite3.OperationalError("database is locked")
+        self.mock(drv, 'invalidateListings', invalidateListings)
         ret = drv.deployImageFromUrl(job, img, descriptorDataXml)
         self.assertEquals(ret.id, "ami-decafbad")
+        # The image was deployed, even if the cached listings could not be
+        # dropped
+        self.failUnlessEqual(invalidated, [ ['images'] ])
         self.assertListsEqual(job._accumulator, [
             ('Creating EBS volume of 1 GiB',),
             ('Created EBS volume vol-decafbad',),
@@ -386,6 +514,42 @@ class EC2Test(testbase.TestCase):
         # Make sure URL remap worked
         self.assertEquals(self._downloadUrls, ['https://localhost:1234/blah'])
 
+    def _deployImageEBSWithChecksum(self, drv, sha1):
+        job = self.Job(list())
+        # The fake download returns the (remapped) URL
+        imageFileInfo = dict(fileId=5145, baseFileName="img-64bit",
+            architecture='x86', name='img-64bit.vmdk', sha1=sha1)
+        imageData = dict(freespace=1234, ebsBacked=True)
+        imageData['attributes.uncompressed_size'] = 14554925
+        img = drv.imageFromFileInfo(imageFileInfo, "http://localhost/blah",
+                                    imageData=imageData)
+        descriptorDataXml = """\
+<descriptor_data>
+  <imageId>5145</imageId>
+  <imageName>ignoreme1</imageName>
+</descriptor_data>
+"""
+        self.mock(drv, 'IMAGE_CACHE_SIZE', 0)
+        return drv.deployImageFromUrl(job, img, descriptorDataXml)
+
+    def testDeployImageEBSChecksum(self):
+        drv = self._setupMocking()
+        ret = self._deployImageEBSWithChecksum(drv,
+            hashlib.sha1('https://localhost:1234/blah').hexdigest())
+        self.assertEquals(ret.id, "ami-decafbad")
+
+    def testDeployImageEBSChecksumMismatch(self):
+        drv = self._setupMocking()
+        registered = []
+        self.mock(drv, '_registerEBSBackedImage',
+            lambda *args: registered.append(args))
+        e = self.failUnlessRaises(errors.ImageChecksumMismatch,
+            self._deployImageEBSWithChecksum, drv,
+            hashlib.sha1('something else').hexdigest())
+        self.failUnlessEqual(str(e),
+            'Downloaded image does not match its sha1 checksum')
+        self.failUnlessEqual(registered, [])
+
     def testDeployImageEBS_non_ec2_endpoint(self):
         drv = self._setupMocking()
         job = self.Job(list())
@@ -444,8 +608,11 @@ class EC2Test(testbase.TestCase):
   <securityGroups-vpc-aaaa0000><item>sg-cccc0000</item></securityGroups-vpc-aaaa0000>
 </descriptor_data>
 """
+        invalidated = []
+        self.mock(drv, 'invalidateListings', invalidated.append)
         ret = drv.launchSystemSynchronously(job, img, descriptorDataXml)
         self.assertEquals(ret, ["i-decafbad0", "i-decafbad1", ])
+        self.failUnlessEqual(invalidated, [ ['images', 'instances'] ])
         self.assertListsEqual(job._accumulator, [
             ('Creating EBS volume of 1 GiB',),
             ('Created EBS volume vol-decafbad',),
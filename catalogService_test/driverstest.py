@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import subprocess
+import sys
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService.rest import drivers
+
+# Loads the cloud types in a fresh interpreter, lists them, then uses a
+# single driver, and reports the driver modules imported and the time spent
+# at each step
+STARTUP_SCRIPT = """
+import sys, time
+def loaded():
+    return sorted(x.split('.')[3] for (x, y) in sys.modules.items()
+        if x.startswith('catalogService.rest.drivers.') and y is not None)
+class DB(object):
+    cfg = None
+class Request(object):
+    baseUrl = 'http://localhost/TOPLEVEL'
+start = time.time()
+from catalogService.rest.api import clouds
+imported = time.time()
+ctrl = clouds.AllCloudController(None, None, None, DB())
+ctrl.loadCloudTypes()
+types = sorted((x, y.driver.cloudType) for (x, y) in ctrl.urls.items())
+started = time.time()
+startupDrivers = loaded()
+ctrl.index(Request())
+indexDrivers = loaded()
+ctrl.urls[%(cloudType)r].driver.isDriverFunctional()
+resolved = time.time()
+print repr(dict(types=types, startupDrivers=startupDrivers,
+    indexDrivers=indexDrivers, drivers=loaded(), importTime=imported - start,
+    loadTime=started - imported, resolveTime=resolved - started))
+"""
+
+class DriversTest(testcase.TestCase):
+    def _startup(self, cloudType):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        p = subprocess.Popen([sys.executable, '-c',
+                STARTUP_SCRIPT % dict(cloudType=cloudType)],
+            stdout=subprocess.PIPE, env=env)
+        out = p.communicate()[0]
+        self.failUnlessEqual(p.returncode, 0)
+        return eval(out.strip().splitlines()[-1])
+
+    def testRegistry(self):
+        self.failUnlessEqual(drivers.SUPPORTED_MODULES,
+            [ x.driverName for x in drivers.DRIVERS ])
+        for info in drivers.DRIVERS:
+            self.failUnlessEqual(drivers.getDriverInfo(info.driverName),
+                info)
+            # Metadata has to be kept in sync with the driver classes
+            driverClass = drivers.getDriverClass(info.driverName)
+            self.failUnlessEqual(driverClass.cloudType, info.cloudType)
+            self.failUnlessEqual(info.isAvailable(),
+                driverClass.isDriverFunctional())
+        self.failUnlessRaises(KeyError, drivers.getDriverInfo, 'ec3')
+
+    def testIsAvailable(self):
+        self.failUnless(drivers.DriverInfo('a', 'a').isAvailable())
+        self.failUnless(drivers.DriverInfo('a', 'a',
+            requires=('os', 'xml.dom.minidom')).isAvailable())
+        self.failIf(drivers.DriverInfo('a', 'a',
+            requires=('os', 'xml.nosuchmodule')).isAvailable())
+        self.failIf(drivers.DriverInfo('a', 'a',
+            requires=('nosuchmodule',)).isAvailable())
+
+    def testLazyDriver(self):
+        info = drivers.getDriverInfo('vmware')
+        drv = drivers.LazyDriver(info, None, 'vmware', db=None)
+        self.failIf(drv.isResolved())
+        self.failUnlessEqual((drv.driverName, drv.cloudType),
+            ('vmware', 'vmware'))
+        self.failUnless(drv.isDriverFunctional())
+        self.failIf(drv.isResolved())
+
+        drv._targetConfig = None
+        self.failUnless(drv.isResolved())
+        real = drv.resolve()
+        self.failUnless(isinstance(real, drivers.getDriverClass('vmware')))
+        self.failUnlessEqual(real.driverName, 'vmware')
+        self.failUnlessEqual(real._targetConfig, None)
+        self.failUnless(drv.resolve() is real)
+        self.failUnlessEqual(drv.isDriverFunctional(),
+            real.isDriverFunctional())
+
+    def testStartup(self):
+        ret = self._startup('vmware')
+        self.failUnlessEqual(ret['types'],
+            sorted((x.cloudType, x.cloudType) for x in drivers.DRIVERS))
+        # Loading and listing the cloud types imports none of the drivers,
+        # using one only imports that one
+        self.failUnlessEqual(ret['startupDrivers'], [])
+        self.failUnlessEqual(ret['indexDrivers'], [])
+        self.failUnlessEqual(sorted(set(ret['drivers'])), ['vmware'])
+        # Building the stand-ins is cheaper than importing a driver
+        self.failUnless(ret['loadTime'] < ret['resolveTime'],
+            "Loading cloud types took %.3fs, importing vmware %.3fs" %
+                (ret['loadTime'], ret['resolveTime']))
+
+if __name__ == "__main__":
+    testsuite.main()
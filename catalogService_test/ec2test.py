@@ -203,7 +203,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('POST')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = images.Handler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -237,6 +237,135 @@ class HandlerTest(testbase.TestCase):
                 ['http://test.rpath.local2/project/foo/build?id=7', None])
         urlTemplate = 'https://aws-portal.amazon.com/gp/aws/user/subscription/index.html?productCode=%s'
 
+    def testConditionalGetImages(self):
+        srv = self.newService()
+        uri = "%s/images" % self._baseCloudUrl
+        client = self.newClient(srv, uri)
+
+        response = client.request('GET')
+        data = response.read()
+        etag = response.msg['ETag']
+        self.failUnless(etag.startswith('"'), etag)
+        response = client.request('GET')
+        self.failUnlessEqual(response.read(), data)
+        self.failUnlessEqual(response.msg['ETag'], etag)
+
+        client = self.newClient(srv, uri,
+            headers = {'If-None-Match' : '"other", %s' % etag})
+        e = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(e.status, 304)
+
+        # The descriptors are tagged too
+        client = self.newClient(srv, "%s/descriptor/launch" %
+            self._baseCloudUrl)
+        etag = client.request('GET').msg['ETag']
+        client = self.newClient(srv, "%s/descriptor/launch" %
+            self._baseCloudUrl, headers = {'If-None-Match' : etag})
+        e = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(e.status, 304)
+
+    def testConditionalGetInstances(self):
+        self._mockRequest(DescribeImages = mockedData.xml_getAllImages3)
+        self.mock(baseDriver.BaseDriver, 'LISTING_CACHE_TTL', 300)
+        calls = []
+        origGetReservations = dec2.ec2client.EC2Client._getInstanceReservations
+        def mockedGetReservations(slf, instanceIds):
+            calls.append(instanceIds)
+            return origGetReservations(slf, instanceIds)
+        self.mock(dec2.ec2client.EC2Client, '_getInstanceReservations',
+            mockedGetReservations)
+
+        srv = self.newService()
+        uri = "%s/instances" % self._baseCloudUrl
+        client = self.newClient(srv, uri)
+        response = client.request('GET')
+        data = response.read()
+        etag = response.msg['ETag']
+        self.failUnless(etag.startswith('"'), etag)
+        self.failUnlessEqual(calls, [ None ])
+
+        # The tag of the cached listing is checked before the target is
+        # contacted
+        client = self.newClient(srv, uri, headers = {'If-None-Match' : etag})
+        e = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(e.status, 304)
+        self.failUnlessEqual(calls, [ None ])
+
+        # Listings served from the target carry the same tag as cached
+        # ones
+        self.mock(baseDriver.BaseDriver, 'LISTING_CACHE_TTL', 0)
+        e = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(e.status, 304)
+        self.failUnlessEqual(calls, [ None, None ])
+        client = self.newClient(srv, uri)
+        response = client.request('GET')
+        self.failUnlessEqual(response.read(), data)
+        self.failUnlessEqual(response.msg['ETag'], etag)
+
+    def testListingCache(self):
+        self._mockRequest(DescribeImages = mockedData.xml_getAllImages3)
+        self.mock(baseDriver.BaseDriver, 'LISTING_CACHE_TTL', 300)
+        calls = []
+        origGetReservations = dec2.ec2client.EC2Client._getInstanceReservations
+        def mockedGetReservations(slf, instanceIds):
+            calls.append(instanceIds)
+            return origGetReservations(slf, instanceIds)
+        self.mock(dec2.ec2client.EC2Client, '_getInstanceReservations',
+            mockedGetReservations)
+
+        srv = self.newService()
+        uri = "%s/instances" % (self._baseCloudUrl, )
+        client = self.newClient(srv, uri)
+        response = client.request('GET')
+        data = response.read()
+        self.failUnlessEqual(response.msg['Age'], None)
+        response = client.request('GET')
+        self.failUnlessEqual(response.read(), data)
+        etag = response.msg['ETag']
+        self.failUnlessEqual(calls, [ None ])
+        # Cached listings say how stale they are
+        self.failIf(response.msg['Age'] is None)
+
+        # The tag of the cached listing is checked without querying the
+        # target
+        client = self.newClient(srv, uri, headers = {'If-None-Match' : etag})
+        e = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(e.status, 304)
+        self.failUnlessEqual(calls, [ None ])
+
+        # Terminating an instance drops the cached listing
+        client = self.newClient(srv, uri + '/i-60f12709')
+        client.request('DELETE')
+        del calls[:]
+        client = self.newClient(srv, uri)
+        client.request('GET')
+        self.failUnlessEqual(calls, [ None ])
+
+    def testListingCacheUsers(self):
+        # Instance names come from the rBuilder data of the user, so users
+        # sharing credentials do not share instance listings
+        self._mockRequest(DescribeImages = mockedData.xml_getAllImages3)
+        self.mock(baseDriver.BaseDriver, 'LISTING_CACHE_TTL', 300)
+        self.restdb.db.users.registerNewUser('Javert', 'secretPassword',
+            'Inspector Javert', 'email@address.com', 'Y', 'blurb', 1)
+        self.restdb.targetMgr.setTargetCredentialsForUser('ec2', 'aws',
+            'Javert', self.USER_TARGETS[0][3])
+        self.restdb.commit()
+        calls = []
+        origGetReservations = dec2.ec2client.EC2Client._getInstanceReservations
+        def mockedGetReservations(slf, instanceIds):
+            calls.append(instanceIds)
+            return origGetReservations(slf, instanceIds)
+        self.mock(dec2.ec2client.EC2Client, '_getInstanceReservations',
+            mockedGetReservations)
+
+        srv = self.newService()
+        uri = "%s/instances" % (self._baseCloudUrl, )
+        for username in [ 'JeanValjean', 'Javert', 'JeanValjean', 'Javert' ]:
+            client = self.newClient(srv, uri, username = username)
+            client.request('GET').read()
+        self.failUnlessEqual(calls, [ None, None ])
+
     def testGetImage1(self):
         srv = self.newService()
         imageId = 'ami-0435d06d'
@@ -263,7 +392,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('GET')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = self.InstancesHandler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -919,6 +1048,8 @@ proxy_pass = pass
         def fakeOpenUrl(slf, url, headers):
             return StringIO.StringIO(url)
         self.mock(dec2.driver, "openUrl", fakeOpenUrl)
+        # The fake download does not match the mocked image's checksum
+        self.mock(dec2.driver, 'VERIFY_IMAGE_CHECKSUMS', False)
 
         def getFilesystemImageFunc(slf, job, image, stream):
             f = tempfile.NamedTemporaryFile(delete=False)
@@ -983,6 +1114,7 @@ proxy_pass = pass
 
         self.failUnlessEqual([ x.get_content() for x in job.history ], [
             'Running',
+            'Image not found in local cache',
             'Bundling image',
             'Uploading bundle',
             'Registering image',
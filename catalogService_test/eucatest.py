@@ -204,7 +204,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('POST')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = images.Handler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -291,7 +291,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('GET')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = self.InstancesHandler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -849,6 +849,8 @@ Extra kwargs:
         def fakeOpenUrl(slf, url, headers):
             return StringIO.StringIO(url)
         self.mock(deuca.driver, "openUrl", fakeOpenUrl)
+        # The fake download does not match the mocked image's checksum
+        self.mock(deuca.driver, 'VERIFY_IMAGE_CHECKSUMS', False)
 
         baseFileName = 'some-file-6-1-x86'
         def fakeExtractImage(slf, path):
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+from StringIO import StringIO
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from conary.lib import digestlib
+
+from catalogService import imageCache
+from catalogService.utils import progress
+
+class ImageCacheTest(testcase.TestCaseWithWorkDir):
+    def _newCache(self, maxSize=None):
+        return imageCache.ImageCache(os.path.join(self.workDir, 'cache'),
+            maxSize=maxSize)
+
+    def _populate(self, cache, data):
+        key = digestlib.sha1(data).hexdigest()
+        stream = cache.store(key, StringIO(data))
+        chunks = []
+        while 1:
+            chunk = stream.read(7)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.failUnlessEqual(''.join(chunks), data)
+        return key
+
+    def testStore(self):
+        cache = self._newCache()
+        data = "some image content" * 10
+        key = digestlib.sha1(data).hexdigest()
+        self.failUnlessEqual(cache.open(key), None)
+        self.failUnlessEqual(self._populate(cache, data), key)
+        self.failUnless(key in cache)
+        self.failUnlessEqual(cache.open(key).read(), data)
+        # No temporary files left behind
+        self.failUnlessEqual(os.listdir(os.path.join(cache.cacheDir, 'tmp')),
+            [])
+
+    def testChecksumMismatch(self):
+        cache = self._newCache()
+        key = digestlib.sha1("expected").hexdigest()
+        stream = cache.store(key, StringIO("something else"))
+        self.failUnlessEqual(stream.read(), "something else")
+        self.failUnlessEqual(stream.read(), "")
+        self.failIf(key in cache)
+        self.failUnlessEqual(os.listdir(os.path.join(cache.cacheDir, 'tmp')),
+            [])
+
+    def testPartialRead(self):
+        cache = self._newCache()
+        data = "0123456789" * 10
+        key = digestlib.sha1(data).hexdigest()
+        stream = cache.store(key, StringIO(data))
+        stream.read(10)
+        stream.close()
+        self.failIf(key in cache)
+
+    def testVerify(self):
+        cache = self._newCache()
+        data = "0123456789" * 10
+        key = digestlib.sha1(data).hexdigest()
+        stream = cache.store(key, progress.StreamWithDigest(StringIO(data),
+            expected=dict(sha1=key)))
+        stream.read(15)
+        # Verifying reads the rest of the stream, which gets cached too
+        self.failUnlessEqual(stream.verify(), [])
+        self.failUnlessEqual(cache.open(key).read(), data)
+
+    def testConcurrentStore(self):
+        cache = self._newCache()
+        data = "abc" * 100
+        key = digestlib.sha1(data).hexdigest()
+        stream1 = cache.store(key, StringIO(data))
+        # The entry is being populated, the second stream is not cached
+        src = StringIO(data)
+        stream2 = cache.store(key, src)
+        self.failUnless(stream2 is src)
+        stream1.read()
+        stream1.read()
+        self.failUnless(key in cache)
+
+    def testInvalidKey(self):
+        cache = self._newCache()
+        src = StringIO("data")
+        self.failUnless(cache.store("../../etc/passwd", src) is src)
+        self.failUnlessEqual(cache.open("../../etc/passwd"), None)
+        self.failUnless(cache.store(None, src) is src)
+
+    def testEviction(self):
+        cache = self._newCache(maxSize=250)
+        keys = []
+        for i in range(3):
+            key = self._populate(cache, str(i) * 100)
+            os.utime(cache._path(key), (1000 + i, 1000 + i))
+            keys.append(key)
+        # Only two entries fit in the budget; the oldest one got evicted
+        self.failUnlessEqual([ x in cache for x in keys ],
+            [ False, True, True ])
+        # Reading an entry makes it the most recently used one
+        cache.open(keys[1]).close()
+        self._populate(cache, "x" * 100)
+        self.failUnlessEqual([ x in cache for x in keys ],
+            [ False, True, False ])
+
+if __name__ == "__main__":
+    testsuite.main()
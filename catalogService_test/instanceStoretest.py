@@ -41,8 +41,9 @@ class InstanceStoreTest(testbase.TestCase):
         prefix = 'some-prefix'
 
         instStore = instanceStore.InstanceStore(store, prefix = prefix)
-        instanceId = "aabbccdd"
+        self._testStore(instStore)
 
+    def _testStore(self, instStore):
         nk = instStore.newKey(realId = 123, imageId = 'image id')
         self.failUnlessEqual(instStore.getId(nk), '123')
         self.failUnlessEqual(instStore.getImageId(nk), 'image id')
@@ -88,5 +89,64 @@ class InstanceStoreTest(testbase.TestCase):
         self.failUnlessEqual(instStore.getSoftwareVersionNextCheck(nk),
             int(timestamp + 86400))
 
+    def _newSqliteStore(self, prefix='some-prefix'):
+        return instanceStore.SqliteInstanceStore(
+            os.path.join(self.workDir, "inststore", "ec2.sqlite"), prefix)
+
+    def testSqliteInstanceStore(self):
+        self._testStore(self._newSqliteStore())
+
+        instStore = self._newSqliteStore('other-prefix')
+        nk1 = instStore.newKey(realId = 'i-1', state = 'Running')
+        nk2 = instStore.newKey(realId = 'i-2')
+        self.failUnlessEqual(instStore.enumerate(),
+            sorted('other-prefix/%s' % x for x in [ nk1, nk2 ]))
+        self.failUnlessEqual(self._newSqliteStore('empty').enumerate(), [])
+
+        instStore.update(nk1, instanceName = 'blah', state = None)
+        fields = instStore.getMany([ nk1, 'other-prefix/' + nk2, 'missing' ])
+        self.failUnlessEqual(sorted(fields), sorted([ nk1, nk2 ]))
+        self.failUnlessEqual(fields[nk1]['instanceName'], 'blah')
+        self.failUnlessEqual(fields[nk1]['id'], 'i-1')
+        self.failIf('state' in fields[nk1])
+        self.failUnlessEqual(fields[nk2]['state'], 'Creating')
+
+        certPath = os.path.join(self.workDir, "cert")
+        file(certPath, "w").write("cert")
+        keyPath = os.path.join(self.workDir, "key")
+        file(keyPath, "w").write("key")
+        paths = instStore.storeX509(nk1, certPath, keyPath)
+        self.failUnlessEqual(paths, instStore.getX509Files(nk1))
+        self.failUnlessEqual([ file(x).read() for x in paths ],
+            [ "cert", "key" ])
+
+        instStore.delete(nk1)
+        self.failUnlessEqual(instStore.getFields(nk1), {})
+        self.failIf(os.path.exists(paths[0]))
+
+    def testMigrate(self):
+        cfg = config.BaseConfig()
+        cfg.storagePath = os.path.join(self.workDir, "oldstore")
+        store = storage.DiskStorage(cfg)
+        oldStore = instanceStore.InstanceStore(store, prefix = 'some-prefix')
+        nk = oldStore.newKey(realId = 'i-1', imageId = 'image id')
+        oldStore.setSoftwareVersion(nk, 'foo=bar@baz:blip/1-2-3')
+        certPath = os.path.join(self.workDir, "cert")
+        file(certPath, "w").write("cert")
+        oldStore.storeX509(nk, certPath, certPath)
+
+        instStore = self._newSqliteStore()
+        self.failUnlessEqual(instStore.migrate(store), [ nk ])
+        self.failUnlessEqual(instStore.getId(nk), 'i-1')
+        self.failUnlessEqual(instStore.getImageId(nk), 'image id')
+        self.failUnlessEqual(instStore.getState(nk), 'Creating')
+        self.failUnlessEqual(instStore.getSoftwareVersion(nk),
+            'foo=bar@baz:blip/1-2-3')
+        self.failUnlessEqual(file(instStore.getX509Files(nk)[0]).read(),
+            "cert")
+        # The old records are gone
+        self.failUnlessEqual(oldStore.enumerate(), [])
+        self.failUnlessEqual(instStore.migrate(store), [])
+
 if __name__ == "__main__":
     testsuite.main()
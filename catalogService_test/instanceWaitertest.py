@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import threading
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService import instanceWaiter
+
+class NotFound(Exception):
+    pass
+
+class FakeBackend(object):
+    """
+    Instances become running after a number of polls
+    """
+    def __init__(self, pollsUntilRunning, events=None, missing=()):
+        self.pollsUntilRunning = pollsUntilRunning
+        self.events = events
+        self.missing = set(missing)
+        self.polls = []
+        self.waits = []
+        self._lock = threading.Lock()
+
+    def drvWaitForInstanceUpdates(self, instanceIds, timeout):
+        with self._lock:
+            self.waits.append((instanceIds, timeout))
+        return self.events
+
+    def drvGetWatchedInstances(self, instanceIds):
+        with self._lock:
+            self.polls.append(instanceIds)
+            count = len(self.polls)
+        missing = self.missing.intersection(instanceIds)
+        if missing:
+            # Like EC2 does right after the instances were created
+            raise NotFound("Instance %s not found" % ', '.join(sorted(missing)))
+        ret = []
+        for instanceId in instanceIds:
+            running = count > self.pollsUntilRunning.get(instanceId, 0)
+            ret.append(instanceWaiter.InstanceState(instanceId,
+                running and 'running' or 'pending',
+                running and '10.0.0.1' or None))
+        return ret
+
+def isRunning(instances):
+    return bool(instances) and all(x.getState() == 'running'
+        for x in instances)
+
+class InstanceWaiterTest(testcase.TestCaseWithWorkDir):
+    def setUp(self):
+        testcase.TestCaseWithWorkDir.setUp(self)
+        self.mock(instanceWaiter.InstanceWaiter, 'FOLLOWER_INTERVAL', 0.01)
+
+    def _newWaiter(self, backend):
+        return instanceWaiter.InstanceWaiter(backend,
+            os.path.join(self.workDir, 'waiters'))
+
+    def testWait(self):
+        backend = FakeBackend(dict(a=2))
+        waiter = self._newWaiter(backend)
+        seen = []
+        ret = waiter.wait(['a'], isRunning, 10, 0.01,
+            callback=lambda x: seen.append([ y.getState() for y in x ]))
+        self.failUnlessEqual([ (x.getInstanceId(), x.getState())
+            for x in ret ], [('a', 'running')])
+        self.failUnlessEqual(seen, [['pending'], ['pending']])
+        self.failUnlessEqual(backend.polls, [['a'], ['a'], ['a']])
+        # Nobody is registered any more
+        self.failUnlessEqual(waiter._getWatchedIds(), set())
+
+    def testTimeout(self):
+        backend = FakeBackend(dict(a=1000000))
+        waiter = self._newWaiter(backend)
+        ret = waiter.wait(['a'], isRunning, 0.1, 0.01)
+        self.failUnlessEqual([ (x.getInstanceId(), x.getState())
+            for x in ret ], [('a', 'pending')])
+
+    def testBackoff(self):
+        backend = FakeBackend(dict(a=6))
+        waiter = self._newWaiter(backend)
+        waiter.wait(['a'], isRunning, 10, 0.01)
+        # Nothing changed between polls, so the interval keeps doubling
+        self.failUnlessEqual([ x[1] for x in backend.waits ],
+            [0.01, 0.02, 0.04, 0.08, 0.16, 0.32])
+
+    def testNoEvents(self):
+        # The backend says nothing changed: no need to poll again
+        backend = FakeBackend(dict(a=1), events=False)
+        waiter = self._newWaiter(backend)
+        ret = waiter.wait(['a'], isRunning, 0.1, 0.01)
+        self.failUnlessEqual(backend.polls, [['a']])
+        self.failUnlessEqual([ x.getState() for x in ret ], ['pending'])
+
+    def testSharedPolling(self):
+        backend = FakeBackend(dict(a=3, b=5))
+        results = {}
+        def run(instanceId):
+            waiter = self._newWaiter(backend)
+            results[instanceId] = waiter.wait([instanceId], isRunning, 10,
+                0.05)
+        threads = [ threading.Thread(target=run, args=(x, ))
+            for x in ['a', 'b'] ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for instanceId in ['a', 'b']:
+            self.failUnlessEqual([ (x.getInstanceId(), x.getState())
+                for x in results[instanceId] ], [(instanceId, 'running')])
+        # One of the waiters polled for both
+        self.failUnless(['a', 'b'] in backend.polls)
+        self.failIf(len(backend.polls) > 7, backend.polls)
+
+    def testStaleWatchers(self):
+        backend = FakeBackend({})
+        waiter = self._newWaiter(backend)
+        os.makedirs(waiter.stateDir)
+        # pid 0x7fffffff is not going to be running
+        path = os.path.join(waiter.stateDir, 'watch-2147483647-0-abc')
+        file(path, "w").write('["z"]')
+        ret = waiter.wait(['a'], isRunning, 10, 0.01)
+        self.failUnlessEqual([ x.getInstanceId() for x in ret ], ['a'])
+        self.failUnlessEqual(backend.polls, [['a']])
+        self.failIf(os.path.exists(path))
+
+    def testMissingInstance(self):
+        # Another job waits on an instance the target does not know about
+        backend = FakeBackend(dict(a=1), missing=['z'])
+        waiter = self._newWaiter(backend)
+        os.makedirs(waiter.stateDir)
+        other = os.path.join(waiter.stateDir, 'watch-%d-0-abc' % os.getpid())
+        file(other, "w").write('["z"]')
+        ret = waiter.wait(['a'], isRunning, 10, 0.01)
+        self.failUnlessEqual([ (x.getInstanceId(), x.getState())
+            for x in ret ], [('a', 'running')])
+        # The batched request failed, then every job was queried on its own
+        self.failUnlessEqual(backend.polls[0], ['a', 'z'])
+        self.failUnlessEqual(sorted(backend.polls[1:3]), [['a'], ['z']])
+        # The error is published for the other job only
+        self.failUnlessEqual(waiter._readState()['errors'],
+            { os.path.basename(other) : 'Instance z not found' })
+
+    def testMissingInstanceShared(self):
+        backend = FakeBackend(dict(a=3), missing=['z'])
+        results = {}
+        def run(instanceId):
+            waiter = self._newWaiter(backend)
+            try:
+                results[instanceId] = waiter.wait([instanceId], isRunning,
+                    10, 0.05)
+            except Exception, e:
+                results[instanceId] = e
+        threads = [ threading.Thread(target=run, args=(x, ))
+            for x in ['a', 'z'] ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.failUnlessEqual([ (x.getInstanceId(), x.getState())
+            for x in results['a'] ], [('a', 'running')])
+        # Raised as is in the leader, as InstanceWaitError otherwise
+        self.failUnless(isinstance(results['z'],
+            (NotFound, instanceWaiter.InstanceWaitError)), results['z'])
+        self.failUnlessEqual(str(results['z']), 'Instance z not found')
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -20,7 +20,11 @@ import testsuite
 # Bootstrap the testsuite
 testsuite.setup()
 
+import rpath_xmllib as xmllib
+
+from catalogService.rest.middleware import response
 from catalogService.rest.models import instances
+from catalogService.rest.models import xmlNode
 
 class InstancesTest(testsuite.TestCase):
     def testFreezeThaw(self):
@@ -106,6 +110,104 @@ class InstancesTest(testsuite.TestCase):
         ret = hndlr.toXml(instance, prettyPrint = False)
         self.failUnlessEqual(ret, """<?xml version='1.0' encoding='UTF-8'?>\n<instance id="blah blah blah" xmlNodeHash="484471a6a17481fcfd7ecf821833928c8679b392"><state>Running</state></instance>""")
 
+        # The next serialization carries the same hash, and a new one once
+        # the node changes
+        self.failUnlessEqual(hndlr.toXml(instance, prettyPrint = False), ret)
+        instance.setState("Pending")
+        ret = hndlr.toXml(instance, prettyPrint = False)
+        self.failUnlessEqual(ret, """<?xml version='1.0' encoding='UTF-8'?>\n<instance id="blah blah blah" xmlNodeHash="5b37fd4919b3c3d1bf6a9295175f33f52a78111b"><state>Pending</state></instance>""")
+
+    def testConditionalXmlResponse(self):
+        class Request(object):
+            headers = {}
+        insts = instances.BaseInstances()
+        insts.extend(instances.BaseInstance(id = "inst-%d" % i,
+                state = "Running") for i in range(5))
+        built = []
+        origGetElementTree = instances.BaseInstance.getElementTree
+        def getElementTree(slf, *args, **kwargs):
+            built.append(slf.getId())
+            return origGetElementTree(slf, *args, **kwargs)
+        self.mock(instances.BaseInstance, 'getElementTree', getElementTree)
+
+        # The hashes are not frozen yet: they are frozen before the body
+        # is serialized
+        self.failUnlessEqual(xmlNode.xmlNodeEtag(insts, compute=False), None)
+        resp = response.conditionalXmlResponse(Request(), insts)
+        self.failUnlessEqual(len(built), 10)
+        etag = resp.headers['ETag']
+        self.failUnlessEqual(etag, xmlNode.xmlNodeEtag(insts, compute=False))
+        self.failUnlessEqual(len(built), 10)
+
+        # Known hashes answer a matching request without serializing
+        del built[:]
+        Request.headers = {'If-None-Match' : etag}
+        resp = response.conditionalXmlResponse(Request(), insts)
+        self.failUnless(isinstance(resp, response.NotModifiedResponse))
+        self.failUnlessEqual(built, [])
+
+        # A changed node is serialized again, under a new tag
+        insts[0].setState("Terminated")
+        resp = response.conditionalXmlResponse(Request(), insts)
+        self.failIf(isinstance(resp, response.NotModifiedResponse))
+        self.failIf(resp.headers['ETag'] == etag)
+        self.failUnlessEqual(len(built), 6)
+
+    def testChecksumNestedChange(self):
+        hndlr = instances.Handler()
+        instance = instances.BaseInstance(id = "inst-1", state = "Running",
+            productCode = [ ("a", "aa") ])
+        ret = hndlr.toXml(instance, prettyPrint = False)
+        nodeHash = instance.getXmlNodeHash()
+
+        # Changing a child node, or assigning a slot, goes around _set:
+        # the hash of the node is not kept, so it still changes
+        instance.productCode[0].code = xmllib.GenericNode().setName(
+            "code").characters("b")
+        self.failIf(instance.getXmlNodeHash() == nodeHash)
+        self.failIf(hndlr.toXml(instance, prettyPrint = False) == ret)
+        fresh = instances.BaseInstance(id = "inst-1", state = "Running",
+            productCode = [ ("b", "aa") ])
+        self.failUnlessEqual(instance.getXmlNodeHash(),
+            fresh.getXmlNodeHash())
+
+        instance.state = None
+        self.failIf(instance.getXmlNodeHash() == fresh.getXmlNodeHash())
+
+        # Frozen hashes are kept, until the node itself changes
+        self.failUnlessEqual(instance.getXmlNodeHash(compute=False), None)
+        nodeHash = instance.freezeXmlNodeHash()
+        self.failUnlessEqual(instance.getXmlNodeHash(compute=False),
+            nodeHash)
+        instance.setState("Running")
+        self.failUnlessEqual(instance.getXmlNodeHash(compute=False), None)
+        self.failUnlessEqual(instance.getXmlNodeHash(),
+            fresh.getXmlNodeHash())
+
+    def testSimpleValues(self):
+        hndlr = instances.Handler()
+        instance = instances.BaseInstance(id = "inst-1", state = "Running",
+            launchIndex = 3, softwareVersionNextCheck = "12",
+            outOfDate = False)
+        self.failUnlessEqual(instance.getState(), "Running")
+        self.failUnlessEqual(instance.getLaunchIndex(), 3)
+        self.failUnlessEqual(instance.getSoftwareVersionNextCheck(), 12)
+        self.failUnlessEqual(instance.getOutOfDate(), False)
+        # Accessors are looked up once, and then found in the class
+        self.failUnless('getState' in instances.BaseInstance.__dict__)
+        self.failUnlessEqual(instance.setState("Stopped"), instance)
+        self.failUnlessEqual(instance.getState(), "Stopped")
+
+        ret = hndlr.toXml(instance, prettyPrint = False)
+        self.failUnless('<launchIndex>3</launchIndex>' in ret, ret)
+        self.failUnless('<outOfDate>false</outOfDate>' in ret, ret)
+        self.failUnless('<state>Stopped</state>' in ret, ret)
+        # Parsed nodes are still handled
+        x = hndlr.parseString(ret)
+        self.failUnlessEqual(x.getState(), "Stopped")
+        self.failUnlessEqual(x.getLaunchIndex(), 3)
+        self.failUnlessEqual(x.getOutOfDate(), False)
+
 
 if __name__ == "__main__":
     testsuite.main()
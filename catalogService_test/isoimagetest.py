@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import struct
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService.utils import isoimage
+
+SECTOR_SIZE = isoimage.SECTOR_SIZE
+
+class IsoReader(object):
+    """
+    Just enough of an ISO9660 reader to walk the trees we write
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def sector(self, idx):
+        return self.data[idx * SECTOR_SIZE:(idx + 1) * SECTOR_SIZE]
+
+    def volumeDescriptors(self):
+        idx = 16
+        while 1:
+            vd = self.sector(idx)
+            yield vd
+            if vd[0] == '\xff':
+                return
+            idx += 1
+
+    def records(self, extent, size):
+        data = self.data[extent * SECTOR_SIZE:extent * SECTOR_SIZE + size]
+        pos = 0
+        while pos < len(data):
+            length = ord(data[pos])
+            if length == 0:
+                # Padding up to the next sector
+                pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            yield data[pos:pos + length]
+            pos += length
+
+    @classmethod
+    def parseRecord(cls, record):
+        extent = struct.unpack("<I", record[2:6])[0]
+        size = struct.unpack("<I", record[10:14])[0]
+        isDir = bool(ord(record[25]) & 2)
+        idLen = ord(record[32])
+        identifier = record[33:33 + idLen]
+        suStart = 33 + idLen + (idLen % 2 == 0 and 1 or 0)
+        entries = {}
+        su = record[suStart:]
+        while len(su) >= 4:
+            sig, length = su[:2], ord(su[2])
+            if length < 4:
+                break
+            entries[sig] = su[:length]
+            su = su[length:]
+        return extent, size, isDir, identifier, entries
+
+    def walk(self, joliet=False):
+        """
+        Return a dictionary of path -> (contents, system use entries)
+        """
+        vds = list(self.volumeDescriptors())
+        vd = [ x for x in vds if x[0] == (joliet and '\x02' or '\x01') ][0]
+        ret = {}
+        self._walk(vd[156:190], '', joliet, ret)
+        return ret
+
+    def _walk(self, rootRecord, prefix, joliet, ret):
+        extent, size, _, _, _ = self.parseRecord(rootRecord)
+        for record in self.records(extent, size):
+            extent, size, isDir, ident, entries = self.parseRecord(record)
+            if ident in ('\0', '\1'):
+                continue
+            if joliet:
+                name = ident.decode('utf-16-be')
+                if not isDir:
+                    name = name.rsplit(';', 1)[0]
+            else:
+                name = entries['NM'][5:]
+            path = prefix + name
+            if isDir:
+                self._walk(record, path + '/', joliet, ret)
+            else:
+                ret[path] = (self.data[extent * SECTOR_SIZE:
+                    extent * SECTOR_SIZE + size], entries)
+
+class IsoImageTest(testcase.TestCase):
+    files = [
+        ("SECURITY-CONTEXT-BOOTSTRAP", ""),
+        ("etc/sfcb/clients/04ffb38d.0", "-----BEGIN CERTIFICATE-----\n" * 100),
+        ("etc/conary/rpath-tools/boot-uuid", "00000000-0000-0000-0000"),
+        ("etc/conary/rpath-tools/config.d/directMethod",
+            "directMethod []\ndirectMethod 1.2.3.4:5678\n"),
+        ("etc/ssh/keys.d/root/key.pub", u"ssh-rsa AAAA root@été\n"),
+    ]
+
+    def _newImage(self, files=None):
+        iso = isoimage.IsoImage(timestamp=1262304000)
+        for path, data in (files or self.files):
+            iso.addFile(path, data)
+        return iso.getvalue()
+
+    def testLayout(self):
+        data = self._newImage()
+        self.failUnlessEqual(len(data) % SECTOR_SIZE, 0)
+        reader = IsoReader(data)
+        vds = list(reader.volumeDescriptors())
+        self.failUnlessEqual([ (x[0], x[1:6]) for x in vds ],
+            [('\x01', 'CD001'), ('\x02', 'CD001'), ('\xff', 'CD001')])
+        # Joliet escape sequence
+        self.failUnlessEqual(vds[1][88:91], '%/E')
+        # Volume size
+        self.failUnlessEqual(struct.unpack("<I", vds[0][80:84])[0],
+            len(data) // SECTOR_SIZE)
+        self.failUnlessEqual(vds[0][40:72].rstrip(), 'CDROM')
+        self.failUnlessEqual(vds[0][813:829], '2010010100000000')
+
+    def testRockRidge(self):
+        reader = IsoReader(self._newImage())
+        # SUSP indicator in the root directory
+        rootExtent = reader.parseRecord(
+            list(reader.volumeDescriptors())[0][156:190])[0]
+        dot = reader.parseRecord(reader.records(rootExtent,
+            SECTOR_SIZE).next())
+        self.failUnlessEqual(dot[4]['SP'], 'SP\x07\x01\xbe\xef\x00')
+        self.failUnless('CE' in dot[4])
+
+        tree = reader.walk()
+        expected = dict((x, isinstance(y, unicode) and y.encode('utf-8') or y)
+            for (x, y) in self.files)
+        self.failUnlessEqual(dict((x, y[0]) for (x, y) in tree.items()),
+            expected)
+        px = tree['etc/sfcb/clients/04ffb38d.0'][1]['PX']
+        self.failUnlessEqual(struct.unpack("<I", px[4:8])[0], 0100444)
+
+    def testJoliet(self):
+        tree = IsoReader(self._newImage()).walk(joliet=True)
+        self.failUnlessEqual(sorted(tree),
+            sorted(unicode(x) for (x, _) in self.files))
+        self.failUnlessEqual(tree['etc/conary/rpath-tools/boot-uuid'][0],
+            "00000000-0000-0000-0000")
+
+    def testManyFiles(self):
+        # Directories spanning several sectors, and name clashes in the
+        # 8.3 names
+        files = [ ("dir/a-rather-long-file-name-%03d.txt" % i, str(i) * i)
+            for i in range(100) ]
+        reader = IsoReader(self._newImage(files))
+        self.failUnlessEqual(dict((x, y[0])
+            for (x, y) in reader.walk().items()), dict(files))
+        self.failUnlessEqual(len(reader.walk(joliet=True)), 100)
+
+    def testIsoNames(self):
+        taken = set()
+        self.failUnlessEqual([ isoimage.IsoImage._isoName(x, isDir, taken)
+            for (x, isDir) in [ ("SECURITY-CONTEXT-BOOTSTRAP", False),
+                ("SECURITY-CONTEXT", False), ("key.pub", False),
+                ("rpath-tools", True), ("04ffb38d.0", False) ] ],
+            ['SECURITY.;1', 'SECURIT1.;1', 'KEY.PUB;1', 'RPATH_TO',
+                '04FFB38D.0;1'])
+
+    def testInvalidPaths(self):
+        iso = isoimage.IsoImage()
+        iso.addFile("a/b", "")
+        self.failUnlessRaises(ValueError, iso.addFile, "a", "")
+        self.failUnlessRaises(ValueError, iso.addFile, "a/b/c", "")
+        self.failUnlessRaises(ValueError, iso.addFile, "/", "")
+        self.failUnlessRaises(ValueError, iso.addFile, "x" * 200, "")
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -227,5 +227,56 @@ class InstanceLaunchJobsTest(testbase.TestCase):
                 client, 'jobs/types/instance-launch/jobs/%s' % job1.jobId)
             ])
 
+    def testPaging(self):
+        now = time.time()
+        jlist = [ self.store.create(created = now + i,
+                cloudName = self.cloudName, cloudType = self.cloudType,
+                status = 'Completed', instanceId = self.targetSystemIds[0])
+            for i in range(5) ]
+        # Filtered out
+        self.store.create(created = now, cloudName = self.TARGETS[1][1],
+            cloudType = self.TARGETS[1][0], status = 'Completed',
+            instanceId = self.targetSystemIds[0])
+        self.restdb.commit()
+
+        srv = self.newService()
+        uri = 'jobs/types/instance-launch/jobs'
+        query = 'cloudName=%s&cloudType=%s' % (self.cloudName, self.cloudType)
+
+        def getPage(start, limit):
+            client = self.newClient(srv, '%s?%s&start=%s&limit=%s' % (
+                uri, query, start, limit))
+            response = client.request('GET')
+            storedJobs = jobmodels.Jobs()
+            storedJobs.parseStream(response.read())
+            ids = [ x.get_id().rsplit('/', 1)[-1] for x in storedJobs ]
+            return ids, response.msg.get('Link')
+
+        ids, link = getPage(0, 2)
+        self.failUnlessEqual(ids, [ str(x.jobId) for x in jlist[:2] ])
+        self.failUnlessEqual(link.split('; ')[-1], 'rel="next"')
+        self.failUnless('start=2' in link)
+
+        ids, link = getPage(2, 2)
+        self.failUnlessEqual(ids, [ str(x.jobId) for x in jlist[2:4] ])
+        self.failUnless('rel="next"' in link)
+        self.failUnless('rel="prev"' in link)
+
+        ids, link = getPage(4, 2)
+        self.failUnlessEqual(ids, [ str(jlist[4].jobId) ])
+        self.failIf('rel="next"' in link)
+
+        # No paging
+        client = self.newClient(srv, '%s?%s' % (uri, query))
+        response = client.request('GET')
+        storedJobs = jobmodels.Jobs()
+        storedJobs.parseStream(response.read())
+        self.failUnlessEqual(len(storedJobs.job), 5)
+        self.failUnlessEqual(response.msg.get('Link'), None)
+
+        client = self.newClient(srv, '%s?limit=foo' % uri)
+        resp = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(resp.status, 400)
+
 if __name__ == "__main__":
     testsuite.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService import listingCache
+
+class ListingCacheTest(testcase.TestCaseWithWorkDir):
+    now = 1000000
+
+    def _newCache(self, **kwargs):
+        return listingCache.ListingCache(
+            os.path.join(self.workDir, "listings.sqlite"), **kwargs)
+
+    def testGetSet(self):
+        cache = self._newCache(ttl=60)
+        key = ('ec2/aws', 'cred1', 'instances')
+        self.failUnlessEqual(cache.get(*key, now=self.now), None)
+        listing = [ dict(instanceId='i-1'), dict(instanceId='i-2') ]
+        self.failUnless(cache.set(*key, listing=listing, etag='"abc"',
+            now=self.now))
+
+        # Entries are shared with other processes through the database
+        other = self._newCache(ttl=60)
+        etag, cached, created = other.get(*key, now=self.now + 10)
+        self.failUnlessEqual(etag, '"abc"')
+        self.failUnlessEqual(created, self.now)
+        self.failUnlessEqual(cached, listing)
+        # Callers get their own copy
+        self.failIf(cached is listing)
+        self.failUnlessEqual(other.getEtag(*key, now=self.now + 10), '"abc"')
+
+        # Other credentials and other kinds are separate entries
+        self.failUnlessEqual(cache.get('ec2/aws', 'cred2', 'instances',
+            now=self.now), None)
+        self.failUnlessEqual(cache.get('ec2/aws', 'cred1', 'images',
+            now=self.now), None)
+
+        # Expiration
+        self.failUnlessEqual(cache.get(*key, now=self.now + 60), None)
+        self.failUnlessEqual(cache.getEtag(*key, now=self.now + 60), None)
+
+    def testUnpicklable(self):
+        cache = self._newCache()
+        self.failIf(cache.set('ec2/aws', 'cred1', 'images', lambda: None))
+        self.failUnlessEqual(cache.get('ec2/aws', 'cred1', 'images'), None)
+
+    def testInvalidate(self):
+        cache = self._newCache(ttl=60)
+        for target in [ 'ec2/aws', 'vmware/vc1' ]:
+            for cred in [ 'cred1', 'cred2' ]:
+                for kind in [ 'images', 'instances' ]:
+                    cache.set(target, cred, kind, [ kind ], now=self.now)
+        cache.invalidate('ec2/aws', [ 'instances' ])
+        self.failUnlessEqual(cache.get('ec2/aws', 'cred2', 'instances',
+            now=self.now), None)
+        self.failUnlessEqual(cache.get('ec2/aws', 'cred2', 'images',
+            now=self.now), (None, [ 'images' ], self.now))
+        cache.invalidate('ec2/aws')
+        self.failUnlessEqual(cache.get('ec2/aws', 'cred1', 'images',
+            now=self.now), None)
+        self.failUnlessEqual(cache.get('vmware/vc1', 'cred1', 'instances',
+            now=self.now), (None, [ 'instances' ], self.now))
+
+    def testEviction(self):
+        cache = self._newCache(ttl=60)
+        listing = 'x' * 1000
+        size = len(listingCache.cPickle.dumps(listing,
+            listingCache.cPickle.HIGHEST_PROTOCOL))
+        cache.maxSize = 2 * size
+        for i in range(3):
+            cache.set('ec2/aws', 'cred%d' % i, 'images', listing,
+                now=self.now + i)
+        self.failUnlessEqual([ cache.get('ec2/aws', 'cred%d' % i, 'images',
+                now=self.now + 2) is not None for i in range(3) ],
+            [ False, True, True ])
+        # Listings larger than the whole cache are not kept
+        self.failIf(cache.set('ec2/aws', 'cred4', 'images', listing * 3))
+
+        # Stale entries are dropped when writing
+        cache.set('ec2/aws', 'cred5', 'images', 'y', now=self.now + 100)
+        cu = cache._getDb().execute("SELECT credentials FROM listings")
+        self.failUnlessEqual([ x[0] for x in cu ], [ 'cred5' ])
+
+if __name__ == "__main__":
+    testsuite.main()
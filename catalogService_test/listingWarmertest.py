@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import threading
+import time
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService import listingWarmer
+
+class ListingWarmerTest(testcase.TestCase):
+    now = 1000000
+
+    def testSchedule(self):
+        warmer = listingWarmer.ListingWarmer(None, interval=100, jitter=0.1,
+            idleTimeout=1000)
+        warmer.add('vc1', 'cred1', 'payload1', now=self.now)
+        warmer.add('vc1', 'cred2', 'payload2', now=self.now + 10)
+        self.failUnlessEqual(warmer.getDue(now=self.now + 50), [])
+        # Jitter only brings refreshes forward
+        due = warmer.getDue(now=self.now + 110)
+        self.failUnlessEqual([ (x.credentialsId, x.payload) for x in due ],
+            [ ('cred1', 'payload1'), ('cred2', 'payload2') ])
+        self.failUnless(self.now + 90 <= due[0].nextRefresh <= self.now + 100)
+
+        # Using a target again updates its payload, not its schedule
+        warmer.add('vc1', 'cred1', 'payload3', now=self.now + 20)
+        due = warmer.getDue(now=self.now + 100)
+        self.failUnlessEqual(due[0].payload, 'payload3')
+
+        # Idle targets are dropped
+        self.failUnlessEqual([ x.credentialsId
+            for x in warmer.getDue(now=self.now + 1015) ], [ 'cred1' ])
+        self.failUnlessEqual(warmer.getDue(now=self.now + 1020), [])
+
+    def testRunOnce(self):
+        calls = []
+        running = {}
+        maxRunning = {}
+        lock = threading.Lock()
+        def refresh(target, payload):
+            with lock:
+                calls.append((target, payload))
+                running[target] = running.get(target, 0) + 1
+                maxRunning[target] = max(maxRunning.get(target, 0),
+                    running[target])
+            try:
+                if payload == 'bad':
+                    raise RuntimeError("target down")
+            finally:
+                with lock:
+                    running[target] -= 1
+
+        warmer = listingWarmer.ListingWarmer(refresh, interval=10,
+            concurrency=3, targetConcurrency=1)
+        for i in range(6):
+            warmer.add('target%d' % (i % 2), 'cred%d' % i, 'payload%d' % i,
+                now=self.now)
+        warmer.add('target2', 'cred', 'bad', now=self.now)
+        self.failUnlessEqual(warmer.runOnce(now=self.now + 10), 1)
+        self.failUnlessEqual(len(calls), 7)
+        self.failUnlessEqual(maxRunning,
+            dict(target0=1, target1=1, target2=1))
+
+        # Everything got rescheduled, failures included
+        self.failUnlessEqual(warmer.runOnce(now=self.now + 10), 0)
+        self.failUnlessEqual(len(calls), 7)
+
+    def testStartStop(self):
+        event = threading.Event()
+        def refresh(target, payload):
+            event.set()
+        warmer = listingWarmer.ListingWarmer(refresh, interval=0.01)
+        warmer.add('target', 'cred', None)
+        warmer.start()
+        try:
+            event.wait(5)
+            self.failUnless(event.isSet())
+        finally:
+            warmer.stop()
+
+class SharedRegistryTest(testcase.TestCaseWithWorkDir):
+    now = 1000000
+
+    def testSync(self):
+        path = os.path.join(self.workDir, "warmer", "registry")
+        registry = listingWarmer.SharedRegistry(path)
+        # No one listens yet
+        self.failIf(registry.add('vc1', 'cred1', 'payload'))
+        self.failUnlessEqual(registry.receive(), [])
+        calls = []
+        warmer = listingWarmer.ListingWarmer(
+            lambda target, payload: calls.append((target, payload)),
+            interval=100, jitter=0, idleTimeout=1000, registry=registry)
+        registry.listen()
+        try:
+            # Registrations carry credentials: only the owner can send them
+            self.failUnlessEqual(
+                os.stat(os.path.dirname(path)).st_mode & 0777, 0700)
+            self.failUnlessEqual(os.stat(path).st_mode & 0777, 0600)
+
+            # Tasks run in processes of their own
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    registry.add('vc1', 'cred1',
+                        dict(kinds=['images'], password='sekrit'),
+                        now=self.now)
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+
+            warmer.sync(timeout=5)
+            self.failUnlessEqual(warmer.runOnce(now=self.now + 50), 0)
+            self.failUnlessEqual(calls, [])
+            self.failUnlessEqual(warmer.runOnce(now=self.now + 100), 0)
+            self.failUnlessEqual(calls,
+                [ ('vc1', dict(kinds=['images'], password='sekrit')) ])
+
+            registry.add('vc1', 'cred1', 'payload2', now=self.now + 150)
+            warmer.sync(timeout=5)
+            self.failUnlessEqual([ (x.payload, x.lastUsed)
+                    for x in warmer.getDue(now=self.now + 200) ],
+                [ ('payload2', self.now + 150) ])
+            self.failIf(registry.add('vc1', 'cred1', lambda: None))
+            # Registrations were handed over, nothing was kept on disk
+            self.failUnlessEqual(os.listdir(os.path.dirname(path)),
+                [ 'registry' ])
+            self.failUnlessEqual(registry.receive(), [])
+        finally:
+            registry.close()
+
+    def testStart(self):
+        registry = listingWarmer.SharedRegistry(
+            os.path.join(self.workDir, "registry"))
+        warmer = listingWarmer.ListingWarmer(lambda *args: None,
+            interval=100, registry=registry)
+        warmer.start()
+        try:
+            self.failUnless(registry.add('vc1', 'cred1', 'payload'))
+            for i in range(100):
+                if warmer._entries:
+                    break
+                time.sleep(0.05)
+            self.failUnlessEqual([ (x.target, x.payload)
+                    for x in warmer._entries.values() ],
+                [ ('vc1', 'payload') ])
+        finally:
+            warmer.stop()
+        self.failIf(registry.add('vc1', 'cred1', 'payload'))
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -160,6 +160,13 @@ def _createJobsSchema(db):
             ) %(TABLEOPTS)s""" % db.keywords)
         db.tables['jobs'] = []
         changed = True
+    # Job listings filter on the type (and optionally state) and sort by
+    # creation time. These indexes mirror the rBuilder migration listed
+    # under "Database requirements" in README.md
+    changed |= db.createIndex('jobs', 'jobs_type_created_idx',
+        'job_type_id, created')
+    changed |= db.createIndex('jobs', 'jobs_type_state_created_idx',
+        'job_type_id, job_state_id, created')
 
     if 'job_history' not in db.tables:
         cu.execute("""
@@ -198,6 +205,8 @@ def _createJobsSchema(db):
             ) %(TABLEOPTS)s""" % db.keywords)
         db.tables['job_target'] = []
         changed = True
+    changed |= db.createIndex('job_target', 'job_target_job_id_idx',
+        'job_id')
 
     if 'job_system' not in db.tables:
         cu.execute("""
@@ -223,5 +232,7 @@ def _createJobsSchema(db):
             ) %(TABLEOPTS)s""" % db.keywords)
         db.tables['job_managed_system'] = []
         changed = True
+    changed |= db.createIndex('job_managed_system',
+        'job_managed_system_job_id_idx', 'job_id')
 
     return changed
@@ -204,7 +204,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('POST')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = images.Handler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -305,7 +305,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('GET')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = self.InstancesHandler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -766,6 +766,8 @@ class HandlerTest(testbase.TestCase):
             sio.seek(0)
             return sio
         self.mock(dopenstack.driver, "openUrl", fakeOpenUrl)
+        # The fake download does not match the mocked image's checksum
+        self.mock(dopenstack.driver, 'VERIFY_IMAGE_CHECKSUMS', False)
 
         baseFileName = 'some-file-6-1-x86'
         def fakeExtractImage(slf, path):
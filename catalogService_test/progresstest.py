@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import time
+from StringIO import StringIO
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService.utils import progress
+
+class StreamWithDigestTest(testcase.TestCase):
+    data = "0123456789abcdef" * 1000
+
+    def testDigest(self):
+        stream = progress.StreamWithDigest(StringIO(self.data),
+            algorithms=['sha1', 'sha256'])
+        self.failUnlessEqual(stream.read(100), self.data[:100])
+        self.failUnlessEqual(stream.read(), self.data[100:])
+        self.failUnlessEqual(stream.hexdigest(),
+            hashlib.sha1(self.data).hexdigest())
+        self.failUnlessEqual(stream.hexdigest('sha256'),
+            hashlib.sha256(self.data).hexdigest())
+        # Attributes come from the wrapped stream
+        self.failUnlessEqual(stream.getvalue(), self.data)
+
+    def testVerify(self):
+        expected = dict(sha1=hashlib.sha1(self.data).hexdigest().upper(),
+            sha256=hashlib.sha256(self.data).hexdigest())
+        stream = progress.StreamWithDigest(StringIO(self.data),
+            expected=expected)
+        # Only part of the stream was read, verify consumes the rest
+        stream.read(10)
+        self.failUnlessEqual(stream.verify(), [])
+
+        stream = progress.StreamWithDigest(StringIO(self.data + "junk"),
+            expected=expected)
+        self.failUnlessEqual(stream.verify(), ['sha1', 'sha256'])
+
+        # No expected value for sha256, only sha1 is checked
+        expected['sha256'] = None
+        stream = progress.StreamWithDigest(StringIO(self.data),
+            expected=expected)
+        self.failUnlessEqual(sorted(stream.digests), ['sha1'])
+        self.failUnlessEqual(stream.verify(), [])
+
+class CoalescingHistoryTest(testcase.TestCase):
+    def testCoalesce(self):
+        now = [ 1000.0 ]
+        self.mock(time, 'time', lambda: now[0])
+        entries = []
+        history = progress.CoalescingHistory(entries.append, interval=30)
+        for percent in range(0, 101, 10):
+            history.update('Downloading', 'Downloading: %d%%' % percent,
+                final=(percent == 100))
+            now[0] += 10
+        # First entry, then one per interval, then the final one
+        self.failUnlessEqual(entries, ['Downloading: 0%', 'Downloading: 30%',
+            'Downloading: 60%', 'Downloading: 90%', 'Downloading: 100%'])
+
+        del entries[:]
+        history.update('Uploading', 'Uploading: 0%')
+        history.update('Uploading', 'Uploading: 5%')
+        history.update('Uploading', 'Uploading: 7%')
+        self.failUnlessEqual(entries, ['Uploading: 0%'])
+        # Series progressing at the same time are coalesced separately
+        history.update('Importing', 'Importing: 0%')
+        history.update('Importing', 'Importing: 1%')
+        history.update('Uploading', 'Uploading: 8%')
+        self.failUnlessEqual(entries, ['Uploading: 0%', 'Importing: 0%'])
+        now[0] += 30
+        history.update('Uploading', 'Uploading: 9%')
+        self.failUnlessEqual(entries[-1], 'Uploading: 9%')
+        history.update('Importing', 'Importing: 2%')
+        self.failUnlessEqual(entries[-1], 'Importing: 2%')
+        history.update('Uploading', 'Uploading: 10%')
+        history.update('Importing', 'Importing: 3%')
+        history.flush()
+        history.flush()
+        self.failUnlessEqual(entries[-2:], ['Uploading: 10%', 'Importing: 3%'])
+        self.failUnlessEqual(len(entries), 6)
+        # A series starts over once it is complete
+        history.update('Uploading', 'Uploading: 100%', final=True)
+        history.update('Uploading', 'Uploading: 0%')
+        self.failUnlessEqual(entries[-2:], ['Uploading: 100%',
+            'Uploading: 0%'])
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import BaseHTTPServer
+import os
+import random
+import SocketServer
+import socket
+import threading
+import time
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+import requests
+
+from catalogService import errors
+from catalogService.rest import baseDriver
+
+class SegmentedRequestTest(testcase.TestCase):
+    class Response(object):
+        def __init__(self, content, status_code=206):
+            self.content = content
+            self.status_code = status_code
+
+    class Session(object):
+        def __init__(self, data, ranges, failures):
+            self.data = data
+            self.ranges = ranges
+            self.failures = failures
+
+        def get(self, url, headers):
+            rng = headers['Range']
+            self.ranges.append(rng)
+            start, end = [ int(x) for x in rng[len('bytes='):].split('-') ]
+            if self.failures.get(start):
+                self.failures[start] -= 1
+                raise requests.exceptions.ConnectionError("reset")
+            return SegmentedRequestTest.Response(self.data[start:end+1])
+
+    def _makeRequest(self, data, connections=3, failures=None):
+        ranges = []
+        if failures is None:
+            failures = {}
+        test = self
+        class Request(baseDriver.SegmentedRequest):
+            SEGMENT_SIZE = 1000
+            RETRY_SLEEP = 0
+            def _newSession(slf):
+                return test.Session(data, ranges, failures)
+        headers = {'Content-Length' : str(len(data)),
+            'Content-Type' : 'application/octet-stream'}
+        return Request('http://host/img', headers,
+            connections=connections), ranges
+
+    def _data(self, size):
+        rnd = random.Random(size)
+        return ''.join(chr(rnd.randint(0, 255)) for x in range(size))
+
+    def testRead(self):
+        data = self._data(10500)
+        req, ranges = self._makeRequest(data)
+        chunks = []
+        while 1:
+            chunk = req.read(777)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.failUnlessEqual(''.join(chunks), data)
+        ranges.sort(key=lambda x: int(x[6:].split('-')[0]))
+        self.failUnlessEqual(ranges,
+            [ 'bytes=%d-%d' % (x, min(x + 999, 10499))
+                for x in range(0, 10500, 1000) ])
+        self.failUnlessEqual(req.headers['Content-Type'],
+            'application/octet-stream')
+
+    def testReadAll(self):
+        data = self._data(4000)
+        req, ranges = self._makeRequest(data, connections=8)
+        self.failUnlessEqual(req.read(), data)
+        self.failUnlessEqual(req.read(), '')
+        self.failUnlessEqual(len(ranges), 4)
+
+    def testRetry(self):
+        data = self._data(5000)
+        req, ranges = self._makeRequest(data, failures={2000 : 2})
+        self.failUnlessEqual(req.read(), data)
+        self.failUnlessEqual(ranges.count('bytes=2000-2999'), 3)
+
+    def testTooManyFailures(self):
+        data = self._data(5000)
+        req, ranges = self._makeRequest(data, failures={2000 : 100})
+        self.failUnlessEqual(req.read(2000), data[:2000])
+        self.failUnlessRaises(requests.exceptions.ConnectionError,
+            req.read, 1000)
+        self.failUnlessEqual(ranges.count('bytes=2000-2999'),
+            req.MAX_RETRIES)
+
+    def testCanSegment(self):
+        class Resp(object):
+            def __init__(self, headers):
+                self.headers = headers
+        size = str(2 * baseDriver.SegmentedRequest.SEGMENT_SIZE)
+        self.failUnless(baseDriver.SegmentedRequest.canSegment(
+            Resp({'Accept-Ranges' : 'bytes', 'Content-Length' : size})))
+        self.failIf(baseDriver.SegmentedRequest.canSegment(
+            Resp({'Accept-Ranges' : 'none', 'Content-Length' : size})))
+        self.failIf(baseDriver.SegmentedRequest.canSegment(
+            Resp({'Accept-Ranges' : 'bytes'})))
+        self.failIf(baseDriver.SegmentedRequest.canSegment(
+            Resp({'Accept-Ranges' : 'bytes', 'Content-Length' : '10'})))
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server serving data, with range support. Range requests
+    take delay seconds; failures maps range starts to the number of times
+    the range fails (with a 500) before succeeding. maxActive is the
+    largest number of range requests served at the same time.
+    """
+    daemon_threads = True
+
+    def __init__(self, data, delay=0, failures=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+            RangeHandler)
+        self.data = data
+        self.delay = delay
+        self.failures = failures or {}
+        self.ranges = []
+        self.active = self.maxActive = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, clientAddress):
+        # Clients drop their connections (the probing request, closed
+        # downloads)
+        pass
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/image.tgz" % self.server_address[1]
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        srv = self.server
+        data = srv.data
+        rng = self.headers.get('Range')
+        if rng is None:
+            self._send(200, data)
+            return
+        start, end = [ int(x) for x in rng[len('bytes='):].split('-') ]
+        with srv.lock:
+            srv.ranges.append(rng)
+            failures = srv.failures.get(start, 0)
+            if failures:
+                srv.failures[start] = failures - 1
+        if failures:
+            self._send(500, 'Internal Server Error')
+            return
+        with srv.lock:
+            srv.active += 1
+            srv.maxActive = max(srv.maxActive, srv.active)
+        try:
+            time.sleep(srv.delay)
+        finally:
+            with srv.lock:
+                srv.active -= 1
+        self._send(206, data[start:end + 1],
+            [ ('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data))) ])
+
+    def _send(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except socket.error:
+            # The probing request only reads the headers
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class SegmentedRequestServerTest(testcase.TestCase):
+    SEGMENT_SIZE = 64 * 1024
+
+    def setUp(self):
+        testcase.TestCase.setUp(self)
+        self.mock(baseDriver.SegmentedRequest, 'SEGMENT_SIZE',
+            self.SEGMENT_SIZE)
+        self.mock(baseDriver.SegmentedRequest, 'RETRY_SLEEP', 0)
+        self.servers = []
+
+    def tearDown(self):
+        for srv in self.servers:
+            srv.shutdown()
+            srv.server_close()
+        testcase.TestCase.tearDown(self)
+
+    def _newServer(self, segments, **kwargs):
+        srv = RangeServer(os.urandom(segments * self.SEGMENT_SIZE), **kwargs)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.servers.append(srv)
+        return srv
+
+    def _download(self, srv, connections):
+        req = baseDriver.openRequest(srv.url, connections=connections)
+        try:
+            return req.read()
+        finally:
+            req.close()
+
+    def _waitForWorkers(self, req, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not [ x for x in req._threads if x.isAlive() ]:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def testConcurrentRanges(self):
+        probe = self._newServer(8)
+        req = baseDriver.openRequest(probe.url, connections=4)
+        self.failUnless(isinstance(req, baseDriver.SegmentedRequest))
+        req.close()
+
+        srv = self._newServer(8, delay=0.2)
+        # One range request at a time, the way a single connection would
+        # fetch the file
+        req = baseDriver.SegmentedRequest(srv.url,
+            {'Content-Length' : str(len(srv.data))}, connections=1)
+        self.failUnlessEqual(req.read(), srv.data)
+        req.close()
+        self.failUnlessEqual(srv.maxActive, 1)
+
+        srv.maxActive = 0
+        self.failUnlessEqual(self._download(srv, 4), srv.data)
+        # The segments are fetched over several connections at once, but
+        # no more than asked for
+        self.failUnless(2 <= srv.maxActive <= 4, srv.maxActive)
+
+    def testFailedRange(self):
+        srv = self._newServer(4,
+            failures={ 2 * self.SEGMENT_SIZE : 2 })
+        self.failUnlessEqual(self._download(srv, 2), srv.data)
+        rng = 'bytes=%d-%d' % (2 * self.SEGMENT_SIZE,
+            3 * self.SEGMENT_SIZE - 1)
+        self.failUnlessEqual(srv.ranges.count(rng), 3)
+        self.failUnlessEqual(len(srv.ranges), 6)
+
+    def testClose(self):
+        srv = self._newServer(16)
+        req = baseDriver.openRequest(srv.url, connections=2)
+        self.failUnlessEqual(req.read(1000), srv.data[:1000])
+        req.close()
+        self.failUnless(self._waitForWorkers(req))
+        self.failUnlessRaises(errors.DownloadError, req.read)
+
+    def testAbandoned(self):
+        # Nobody closes the download: the workers give up once nothing is
+        # read for READ_TIMEOUT seconds
+        self.mock(baseDriver.SegmentedRequest, 'READ_TIMEOUT', 0.2)
+        srv = self._newServer(16)
+        req = baseDriver.openRequest(srv.url, connections=2)
+        self.failUnlessEqual(req.read(1000), srv.data[:1000])
+        self.failUnless(self._waitForWorkers(req))
+        self.failUnlessEqual(req._segments, {})
+        self.failUnless(len(srv.ranges) < 16)
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import threading
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService import instanceStore
+from catalogService import softwareVersionScheduler
+
+class SoftwareVersionSchedulerTest(testcase.TestCaseWithWorkDir):
+    now = 1000000
+
+    def _newStore(self, prefix, cloudType='ec2'):
+        return instanceStore.SqliteInstanceStore(
+            instanceStore.SqliteInstanceStore.getPath(self.workDir,
+                cloudType), prefix)
+
+    def _populate(self):
+        # Instance i-N of target aws/user(N % 2) is due at now + N - 5
+        for i in range(10):
+            store = self._newStore('aws/user%d' % (i % 2))
+            store.update('i-%d' % i,
+                softwareVersionNextCheck=self.now + i - 5)
+        store.update('i-none', state='Running')
+        return store
+
+    def testDueIndex(self):
+        store = self._populate()
+        self.failUnlessEqual(store.getDueSoftwareVersionChecks(now=self.now),
+            [ ('aws/user%d' % (i % 2), 'i-%d' % i) for i in range(6) ])
+        self.failUnlessEqual(store.getDueSoftwareVersionChecks(now=self.now,
+            limit=2), [ ('aws/user0', 'i-0'), ('aws/user1', 'i-1') ])
+        # Removing the field takes the instance out of the index
+        store.withPrefix('aws/user0').update('i-0',
+            softwareVersionNextCheck=None)
+        self.failUnlessEqual(
+            store.getDueSoftwareVersionChecks(now=self.now)[0],
+            ('aws/user1', 'i-1'))
+
+    def testBatches(self):
+        store = self._populate()
+        sched = softwareVersionScheduler.SoftwareVersionScheduler(
+            dict(ec2=store), None, batchSize=2)
+        self.failUnlessEqual(sched.getBatches(now=self.now), [
+            ('ec2', 'aws/user0', ['i-0', 'i-2']),
+            ('ec2', 'aws/user0', ['i-4']),
+            ('ec2', 'aws/user1', ['i-1', 'i-3']),
+            ('ec2', 'aws/user1', ['i-5']),
+        ])
+
+    def testCloudTypes(self):
+        self._populate()
+        store = self._newStore('os1/user0', cloudType='openstack')
+        store.update('i-os', softwareVersionNextCheck=self.now)
+        # Not an instance store
+        file(os.path.join(self.workDir, 'instance-store', 'README'),
+            'w').write('')
+        stores = instanceStore.SqliteInstanceStore.getStores(self.workDir)
+        self.failUnlessEqual(sorted(stores), [ 'ec2', 'openstack' ])
+        self.failUnlessEqual(
+            stores['openstack'].getDueSoftwareVersionChecks(now=self.now),
+            [ ('os1/user0', 'i-os') ])
+
+        calls = []
+        def refresh(cloudType, prefix, instanceIds):
+            calls.append((cloudType, prefix, instanceIds))
+            return {}
+        sched = softwareVersionScheduler.SoftwareVersionScheduler\
+            .fromStoragePath(self.workDir, refresh, batchSize=4,
+                concurrency=1)
+        self.failUnlessEqual(sched.run(now=self.now), 0)
+        self.failUnlessEqual(calls, [
+            ('ec2', 'aws/user0', ['i-0', 'i-2', 'i-4']),
+            ('ec2', 'aws/user1', ['i-1', 'i-3', 'i-5']),
+            ('openstack', 'os1/user0', ['i-os']),
+        ])
+        self.failUnlessEqual(store.getSoftwareVersionNextCheck('i-os'),
+            self.now + sched.CHECK_INTERVAL)
+
+        self.failUnlessEqual(instanceStore.SqliteInstanceStore.getStores(
+            os.path.join(self.workDir, 'missing')), {})
+
+    def testRun(self):
+        store = self._populate()
+        calls = []
+        running = [ 0, 0 ]
+        lock = threading.Lock()
+        def refresh(cloudType, prefix, instanceIds):
+            with lock:
+                calls.append((cloudType, prefix, instanceIds))
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                if instanceIds == ['i-5']:
+                    raise RuntimeError("target down")
+                return dict((x, 'group=foo=/bar@baz:1/%s' % x)
+                    for x in instanceIds + ['i-unknown'])
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        sched = softwareVersionScheduler.SoftwareVersionScheduler(
+            dict(ec2=store), refresh, batchSize=2, concurrency=2)
+        batches = sched.getBatches(now=self.now)
+        self.failUnlessEqual(sched.run(now=self.now), 1)
+        self.failUnlessEqual(sorted(calls), batches)
+        self.failIf(running[1] > 2)
+
+        user0 = store.withPrefix('aws/user0')
+        self.failUnlessEqual(user0.getSoftwareVersion('i-2'),
+            'group=foo=/bar@baz:1/i-2')
+        self.failUnlessEqual(user0.getSoftwareVersionLastChecked('i-2'),
+            self.now)
+        self.failUnlessEqual(user0.getSoftwareVersionNextCheck('i-2'),
+            self.now + sched.CHECK_INTERVAL)
+        self.failUnlessEqual(user0.getFields('i-unknown'), {})
+        # The failed batch is retried later
+        user1 = store.withPrefix('aws/user1')
+        self.failUnlessEqual(user1.getSoftwareVersion('i-5'), None)
+        self.failUnlessEqual(user1.getSoftwareVersionNextCheck('i-5'),
+            self.now + sched.RETRY_INTERVAL)
+        self.failUnlessEqual(sched.getBatches(now=self.now), [])
+
+if __name__ == "__main__":
+    testsuite.main()
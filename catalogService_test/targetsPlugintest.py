@@ -0,0 +1,361 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import sys
+import threading
+import time
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService import errors
+
+# The rmake plugins are installed as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'rmake_plugins'))
+import targets_plugin
+
+class TargetConfig(object):
+    def __init__(self, targetType, targetName, config, alias=None):
+        self.targetType = targetType
+        self.targetName = targetName
+        self.config = config
+        self.alias = alias
+
+class Credentials(object):
+    def __init__(self, credId, credentials, rbUserId=1, isAdmin=False):
+        self.opaqueCredentialsId = credId
+        self.credentials = credentials
+        self.rbUserId = rbUserId
+        self.isAdmin = isAdmin
+
+class Instance(object):
+    def __init__(self, instanceId):
+        self.instanceId = instanceId
+        self.credentials = None
+
+    def getInstanceId(self):
+        return self.instanceId
+
+    def setCredentials(self, credentials):
+        self.credentials = credentials
+
+class FakeDriver(object):
+    """
+    Driver for a project whose users see the same instances. Only the
+    passwords listed in VALID authenticate
+    """
+    LISTING_CACHE_TTL = 0
+    VALID = set()
+    Instances = list
+
+    def __init__(self, userCredentials):
+        self.userCredentials = userCredentials
+
+    def drvGetInventoryKey(self, credentials):
+        return 'project'
+
+    def drvValidateCredentials(self, credentials):
+        if credentials['password'] not in self.VALID:
+            raise errors.PermissionDenied()
+        return True
+
+    def getAllInstances(self):
+        self.drvValidateCredentials(self.userCredentials.credentials)
+        return [ Instance('i-1'), Instance('i-2') ]
+
+    def getListingAge(self, kind):
+        return None
+
+class ClientPool(object):
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate(self, key):
+        self.invalidated.append(key)
+
+    def invalidateTarget(self, cloudType, cloudName):
+        self.invalidated.append((cloudType, cloudName))
+
+class TaskDriver(object):
+    """
+    Stands in for the driver classes built by getDriverClass
+    """
+    cloudType = 'vmware'
+    cloudClientPool = None
+    LISTING_CACHE_TTL = 60
+    refreshed = []
+
+    class NodeFactory(object):
+        baseUrl = None
+
+    def __init__(self, targetConfig, userCredentials, storageConfig,
+            driverName, cloudName=None, db=None, inventoryHandler=None,
+            zoneAddresses=None):
+        self.targetConfig = targetConfig
+        self.userCredentials = userCredentials
+        self.storageConfig = storageConfig
+        self.driverName = driverName
+        self.cloudName = cloudName
+        self.db = db
+        self.inventoryHandler = inventoryHandler
+        self.zoneAddresses = zoneAddresses
+        self._nodeFactory = self.NodeFactory()
+
+    @property
+    def credentials(self):
+        return self.userCredentials.credentials
+
+    def _getCloudClientPoolKey(self, credentials):
+        return (self.cloudType, self.cloudName,
+            tuple(sorted(credentials.items())))
+
+    def refreshListings(self, kinds):
+        self.refreshed.append((self.cloudName,
+            self.userCredentials.opaqueCredentialsId, kinds))
+
+class TargetsPluginTest(testcase.TestCaseWithWorkDir):
+    def setUp(self):
+        testcase.TestCaseWithWorkDir.setUp(self)
+        self.mock(targets_plugin.BaseTaskHandler, 'STORAGE_PATH',
+            self.workDir)
+        self.mock(targets_plugin, 'getDriverClass',
+            lambda driverName: TaskDriver)
+        self.mock(targets_plugin, '_driverFactories', {})
+        self.mock(targets_plugin, '_recordedDrivers', set())
+        self.mock(TaskDriver, 'refreshed', [])
+
+    def _newTask(self, taskClass, allUserCredentials):
+        task = taskClass.__new__(taskClass)
+        task.targetConfig = None
+        task.zoneAddresses = None
+        task.allUserCredentials = allUserCredentials
+        task.userCredentials = allUserCredentials[0]
+        task.driver = FakeDriver(task.userCredentials)
+        task.results = []
+        task.finishCall = lambda node, msg: task.results.append((node, msg))
+        return task
+
+    def testInstanceListCredit(self):
+        self.mock(FakeDriver, 'VALID', set([ 'good', 'better' ]))
+        self.mock(targets_plugin.BaseTaskHandler, 'createDriver',
+            classmethod(lambda cls, targetConfig, creds, zoneAddresses:
+                FakeDriver(creds)))
+        creds = [
+            Credentials('c1', dict(username='u1', password='bad')),
+            Credentials('c2', dict(username='u2', password='good')),
+            Credentials('c3', dict(username='u3', password='expired')),
+            Credentials('c4', dict(username='u4', password='better')),
+        ]
+        task = self._newTask(targets_plugin.TargetsInstanceListTask, creds)
+        task._run()
+        [ (instances, msg) ] = task.results
+        # All four sets share the project, but c1 and c3 do not
+        # authenticate and must not be credited with its instances
+        self.failUnlessEqual([ (x.getInstanceId(), x.credentials)
+                for x in instances ],
+            [ ('i-1', ['c2', 'c4']), ('i-2', ['c2', 'c4']) ])
+        self.failUnlessEqual(msg,
+            "Retrieved list of instances, 2 of 4 credential sets failed")
+
+    def testListingWarmerSingleton(self):
+        started = []
+        class Warmer(object):
+            def __init__(slf, *args, **kwargs):
+                # Give the other threads a chance to get here too
+                time.sleep(0.01)
+            def start(slf):
+                started.append(slf)
+        self.mock(targets_plugin.listingWarmer, 'ListingWarmer', Warmer)
+        self.mock(targets_plugin, '_listingWarmer', None)
+        warmers = []
+        threads = [ threading.Thread(target=lambda:
+                warmers.append(targets_plugin.getListingWarmer()))
+            for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.failUnlessEqual(len(started), 1)
+        self.failUnlessEqual(set(warmers), set(started))
+
+    def testCreateDriver(self):
+        # Drivers are created outside of tasks for the listing warmer
+        targetConfig = TargetConfig('vmware', 'vc1', dict(name='vc1'))
+        creds = Credentials('c1', dict(username='u1'), rbUserId=7)
+        drv = targets_plugin.BaseTaskHandler.createDriver(targetConfig,
+            creds, [ '1.2.3.4' ])
+        self.failUnless(isinstance(drv, TaskDriver))
+        self.failUnlessEqual((drv.driverName, drv.cloudName,
+            drv.zoneAddresses), ('vmware', 'vc1', [ '1.2.3.4' ]))
+        self.failUnlessEqual(drv.db.taskHandler, None)
+        self.failUnlessEqual(drv.db.auth.auth.userId, 7)
+        self.failUnlessEqual(drv.inventoryHandler.parent(), None)
+        self.failUnlessEqual(drv.storageConfig.storagePath, self.workDir)
+        self.failUnlessEqual(drv._nodeFactory.baseUrl, '/')
+
+    def testWarmListings(self):
+        targetConfig = TargetConfig('vmware', 'vc1', dict(name='vc1'))
+        creds = Credentials('c1', dict(username='u1'))
+        task = self._newTask(targets_plugin.TargetsImageListTask, [ creds ])
+        task.targetConfig = targetConfig
+        task.driver = TaskDriver(targetConfig, creds, None, 'vmware')
+        registry = targets_plugin.getListingRegistry()
+        registry.listen()
+        try:
+            task._warmListings(creds, [ 'images' ])
+            [ (target, credId, payload, _) ] = registry.receive(timeout=5)
+        finally:
+            registry.close()
+        self.failUnlessEqual((target, credId), ('vmware/vc1', 'c1'))
+        targetConfig, userCredentials, zoneAddresses, kinds = payload
+        self.failUnlessEqual(userCredentials.opaqueCredentialsId, 'c1')
+        self.failUnlessEqual(kinds, [ 'images' ])
+
+        # The worker's warmer refreshes what the task registered
+        targets_plugin._refreshListings(target, payload)
+        self.failUnlessEqual(TaskDriver.refreshed,
+            [ ('vc1', 'c1', [ 'images' ]) ])
+
+    def testWorkerSetup(self):
+        started = []
+        class Warmer(object):
+            def __init__(slf, refresh, **kwargs):
+                slf.refresh = refresh
+                slf.registry = kwargs['registry']
+            def start(slf):
+                started.append(slf)
+        self.mock(targets_plugin.listingWarmer, 'ListingWarmer', Warmer)
+        self.mock(targets_plugin, '_listingWarmer', None)
+        self.mock(targets_plugin, 'preloadDrivers', lambda names: None)
+        plugin = targets_plugin.TargetsPlugin.__new__(
+            targets_plugin.TargetsPlugin)
+        # The warmer runs in the worker, not in the tasks
+        plugin.worker_pre_setup(None)
+        [ warmer ] = started
+        self.failUnless(warmer.refresh is targets_plugin._refreshListings)
+        self.failUnlessEqual(warmer.registry.path,
+            os.path.join(self.workDir, 'listing-warmer', 'registry'))
+        self.failUnless(targets_plugin.getListingWarmer() is warmer)
+
+        self.mock(targets_plugin, '_listingWarmer', None)
+        self.mock(targets_plugin.baseDriver.BaseDriver, 'LISTING_CACHE_TTL',
+            0)
+        plugin.worker_pre_setup(None)
+        self.failUnlessEqual(len(started), 1)
+
+    def testAgeMessage(self):
+        ageMessage = targets_plugin.BaseTaskHandler._ageMessage
+        self.failUnlessEqual(ageMessage("Retrieved", [ None ]), "Retrieved")
+        self.failUnlessEqual(ageMessage("Retrieved", [ None, 5, 12 ]),
+            "Retrieved (cached, 12 seconds old)")
+
+    def testPreloadDrivers(self):
+        self.mock(targets_plugin.baseDriver.BaseDriver, 'LISTING_CACHE_TTL',
+            0)
+        plugin = targets_plugin.TargetsPlugin.__new__(
+            targets_plugin.TargetsPlugin)
+        loaded = []
+        getDriverClass = targets_plugin.getDriverClass
+        self.mock(targets_plugin, 'getDriverClass', loaded.append)
+        # No driver stack is imported before a task used it
+        plugin.worker_pre_setup(None)
+        self.failUnlessEqual(loaded, [])
+
+        self.mock(targets_plugin, 'getDriverClass', getDriverClass)
+        targets_plugin.getDriverFactory(TargetConfig('vmware', 'vc1', {}))
+        targets_plugin.getDriverFactory(TargetConfig('xen-enterprise', 'x1',
+            {}))
+        targets_plugin.getDriverFactory(TargetConfig('vmware', 'vc2', {}))
+        # Tasks in another process used ec2 and vmware
+        self.mock(targets_plugin, '_recordedDrivers', set())
+        targets_plugin.recordDriver('ec2')
+        targets_plugin.recordDriver('vmware')
+        path = os.path.join(self.workDir, 'preload-drivers')
+        file(path, "a").write("bogus\n")
+        self.failUnlessEqual(file(path).read(),
+            "vmware\nxenent\nec2\nbogus\n")
+
+        self.mock(targets_plugin, 'getDriverClass', loaded.append)
+        plugin.worker_pre_setup(None)
+        self.failUnlessEqual(loaded, [ 'vmware', 'xenent', 'ec2' ])
+
+    def testDriverFactoryMatches(self):
+        targetConfig = TargetConfig('vmware', 'vc1', dict(name='vc1'),
+            alias='vc')
+        factory = targets_plugin.DriverFactory(targetConfig)
+        self.failUnlessEqual(factory.driverName, 'vmware')
+        self.failUnless(factory.matches(TargetConfig('vmware', 'vc1',
+            dict(name='vc1'), alias='vc')))
+        self.failIf(factory.matches(TargetConfig('vmware', 'vc1',
+            dict(name='vc1', port=443), alias='vc')))
+        self.failIf(factory.matches(TargetConfig('vmware', 'vc1',
+            dict(name='vc1'), alias='vc2')))
+        # Reading the configuration does not change it
+        self.failUnlessEqual(targetConfig.config, dict(name='vc1'))
+
+    def testDriverFactoryTrackClient(self):
+        pool = ClientPool()
+        self.mock(TaskDriver, 'cloudClientPool', pool)
+        factory = targets_plugin.DriverFactory(
+            TargetConfig('vmware', 'vc1', dict(name='vc1')))
+        def newDriver(creds):
+            return factory.newDriver(creds, None, None, None, None)
+
+        c1 = Credentials('c1', dict(username='u1', password='p1'))
+        drv = newDriver(c1)
+        self.failUnlessEqual(drv.cloudName, 'vc1')
+        self.failUnlessEqual(drv._nodeFactory.baseUrl, '/')
+        newDriver(c1)
+        newDriver(Credentials('c2', dict(username='u2', password='p2')))
+        newDriver(None)
+        newDriver(Credentials('c3', {}))
+        self.failUnlessEqual(pool.invalidated, [])
+
+        # The password of c1 changed: its old client is dropped
+        newDriver(Credentials('c1', dict(username='u1', password='p3')))
+        self.failUnlessEqual(pool.invalidated, [
+            drv._getCloudClientPoolKey(c1.credentials) ])
+
+    def testGetDriverFactory(self):
+        pool = ClientPool()
+        self.mock(TaskDriver, 'cloudClientPool', pool)
+        factory = targets_plugin.getDriverFactory(
+            TargetConfig('vmware', 'vc1', dict(name='vc1')))
+        self.failUnless(targets_plugin.getDriverFactory(
+            TargetConfig('vmware', 'vc1', dict(name='vc1'))) is factory)
+        other = targets_plugin.getDriverFactory(
+            TargetConfig('vmware', 'vc2', dict(name='vc2')))
+        self.failIf(other is factory)
+        self.failUnlessEqual(pool.invalidated, [])
+
+        # The configuration of vc1 changed: the factory is replaced and
+        # the clients logged in with the old configuration dropped
+        newConfig = TargetConfig('vmware', 'vc1', dict(name='vc1', port=443))
+        newFactory = targets_plugin.getDriverFactory(newConfig)
+        self.failIf(newFactory is factory)
+        self.failUnless(newFactory.targetConfig is newConfig)
+        self.failUnless(targets_plugin.getDriverFactory(newConfig)
+            is newFactory)
+        self.failUnlessEqual(pool.invalidated, [ ('vmware', 'vc1') ])
+
+if __name__ == "__main__":
+    testsuite.main()
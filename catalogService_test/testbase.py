@@ -28,6 +28,7 @@ from conary_test import rephelp
 
 from testrunner import testcase
 
+from catalogService import clientPool
 from catalogService import handler
 from catalogService.rest import baseDriver
 from catalogService.restClient import Client
@@ -462,6 +463,13 @@ class TestCase(testcase.TestCaseWithWorkDir):
         def mockPostFork(slf):
             slf.zoneAddresses = [ '1.2.3.4:5678', '2.3.4.5:6789' ]
         self.mock(baseDriver.BaseDriver, 'postFork', mockPostFork)
+        # Don't let mocked clients leak from one test into the next one
+        self.mock(baseDriver.BaseDriver, 'cloudClientPool',
+            clientPool.ClientPool())
+        # Don't leave certificate generating threads behind
+        self.mock(baseDriver.BaseDriver, 'X509_POOL_DEPTH', 0)
+        # Mocked target responses change within a test
+        self.mock(baseDriver.BaseDriver, 'LISTING_CACHE_TTL', 0)
 
         self.setUpSystemManager()
         self.setUpSchemaDir()
@@ -159,6 +159,43 @@ class UsersTest(testbase.TestCase):
         response = client.request('GET')
         self.failUnlessEqual(response.read(), data)
 
+    def testConditionalGet(self):
+        srv = self.newService()
+        uri = 'users/%(username)s/library'
+
+        client = self.newClient(srv, uri)
+        for i in range(3):
+            client.request('POST', body = 'Request data %s' % i)
+
+        client = self.newClient(srv, uri + '/')
+        response = client.request('GET')
+        data = response.read()
+        etag = response.msg['ETag']
+        self.failUnless(etag.startswith('"'), etag)
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
+
+        # The packed collection is used for the second read
+        packPath = os.path.join(self.storagePath, 'catalog', 'userData-packed',
+            'JeanValjean', 'packed')
+        self.failUnlessEqual(len(os.listdir(packPath)), 1)
+        response = client.request('GET')
+        self.failUnlessEqual(response.read(), data)
+        self.failUnlessEqual(response.msg['ETag'], etag)
+
+        client = self.newClient(srv, uri + '/',
+            headers = {'If-None-Match' : etag})
+        e = self.failUnlessRaises(ResponseError, client.request, 'GET')
+        self.failUnlessEqual(e.status, 304)
+
+        # Changing a value changes the tag
+        client = self.newClient(srv, uri + '/some-data')
+        client.request('PUT', body = 'Other data')
+        client = self.newClient(srv, uri + '/',
+            headers = {'If-None-Match' : etag})
+        response = client.request('GET')
+        self.failUnless('Other data' in response.read())
+        self.failIf(response.msg['ETag'] == etag)
+
     def testDELETEwithPOST(self):
         srv = self.newService()
         uri = 'users/%(username)s/library'
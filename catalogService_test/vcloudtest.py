@@ -229,7 +229,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('POST')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = images.Handler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -318,7 +318,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('GET')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = self.InstancesHandler()
         response = util.BoundedStringIO(response.read())
         node = hndlr.parseFile(response)
@@ -638,6 +638,7 @@ class HandlerTest(testbase.TestCase):
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             [
                 'Running',
+                'Image not found in local cache',
                 'Downloading image: 0%',
                 'Exploding archive',
                 'Uploading image to VMware vCloud',
@@ -684,6 +685,7 @@ class HandlerTest(testbase.TestCase):
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             [
                 'Launching instance from image sha1ForOvf101111111111111111111111111111 (type VMWARE_ESX_IMAGE)',
+                'Image not found in local cache',
                 'Downloading image: 0%',
                 'Exploding archive',
                 'Uploading image to VMware vCloud',
@@ -752,6 +754,8 @@ class HandlerTest(testbase.TestCase):
         def fakeOpenUrl(slf, url, headers):
             return StringIO.StringIO(url)
         self.mock(dvcloud.driver, "openUrl", fakeOpenUrl)
+        # The fake download does not match the mocked image's checksum
+        self.mock(dvcloud.driver, 'VERIFY_IMAGE_CHECKSUMS', False)
 
         class ModifiedArchive(baseDriver.Archive):
             def identify(slf):
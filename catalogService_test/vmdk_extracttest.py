@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import os
+import random
+import struct
+import time
+import zlib
+from StringIO import StringIO
+
+import testsuite
+# Bootstrap the testsuite
+testsuite.setup()
+
+from testrunner import testcase
+
+from catalogService.utils import vmdk_extract
+
+SECT = 512
+GRAIN_SIZE = 128
+GT_ENTRIES = 512
+HEADER_FORMAT = "<4sIIQQQQIQQQBccccI431s"
+
+def makeStreamOptimizedVMDK(capacity, grains):
+    """
+    Build a stream-optimized VMDK of capacity sectors. grains maps the
+    LBA of each allocated grain to its (uncompressed) content.
+    """
+    GD_AT_END = vmdk_extract.VMDKReader.GrainDirectory.GD_AT_END
+    header = struct.pack(HEADER_FORMAT, 'KDMV', 3, 0x30001, capacity,
+        GRAIN_SIZE, 0, 0, GT_ENTRIES, 0, GD_AT_END, 1, 0,
+        '\n', ' ', '\r', '\n', 1, '')
+    out = StringIO()
+    out.write(header)
+
+    def align():
+        out.write('\0' * ((SECT - out.tell() % SECT) % SECT))
+
+    def writeMetadata(markerType, metadata):
+        out.write(struct.pack("<QII", len(metadata) / SECT, 0, markerType))
+        align()
+        out.write(metadata)
+
+    numGrains = (capacity + GRAIN_SIZE - 1) / GRAIN_SIZE
+    gdSize = (numGrains + GT_ENTRIES - 1) / GT_ENTRIES
+    gdSize += (-gdSize) % (SECT / 4)
+    grainDirectory = [ 0 ] * gdSize
+    sectorsPerGT = GRAIN_SIZE * GT_ENTRIES
+    byTable = {}
+    for lba in sorted(grains):
+        byTable.setdefault(lba / sectorsPerGT, []).append(lba)
+    for gtNum in sorted(byTable):
+        grainTable = [ 0 ] * GT_ENTRIES
+        for lba in byTable[gtNum]:
+            grainTable[(lba % sectorsPerGT) / GRAIN_SIZE] = out.tell() / SECT
+            data = zlib.compress(grains[lba])
+            out.write(struct.pack("<QI", lba, len(data)))
+            out.write(data)
+            align()
+        grainDirectory[gtNum] = out.tell() / SECT + 1
+        writeMetadata(1, struct.pack("<%dI" % GT_ENTRIES, *grainTable))
+    writeMetadata(2, struct.pack("<%dI" % gdSize, *grainDirectory))
+    writeMetadata(3, header)
+    writeMetadata(0, '')
+    return out.getvalue()
+
+def makeGrains(capacity, count, seed=0):
+    rnd = random.Random(seed)
+    numGrains = capacity / GRAIN_SIZE
+    # Compressible, but not trivially so
+    base = ''.join(chr(rnd.randint(0, 15)) for x in range(GRAIN_SIZE * SECT))
+    grains = {}
+    for idx in sorted(rnd.sample(xrange(numGrains), count)):
+        rot = rnd.randint(0, len(base) - 1)
+        grains[idx * GRAIN_SIZE] = base[rot:] + base[:rot]
+    return grains
+
+class VMDKReaderTest(testcase.TestCaseWithWorkDir):
+    def _extract(self, vmdk, threads):
+        # StringIO does not handle truncating past its end
+        outPath = os.path.join(self.workDir, "disk.img")
+        callbacks = []
+        with open(outPath, "w+b") as out:
+            reader = vmdk_extract.VMDKReader(StringIO(vmdk), out,
+                callback=lambda *args: callbacks.append(args),
+                threads=threads)
+            reader.process()
+            out.seek(0)
+            digest = hashlib.sha1(out.read()).hexdigest()
+        return digest, callbacks
+
+    def _expected(self, capacity, grains):
+        expected = [ '\0' * SECT * GRAIN_SIZE ] * (capacity / GRAIN_SIZE)
+        for lba, data in grains.items():
+            expected[lba / GRAIN_SIZE] = data
+        return hashlib.sha1(''.join(expected)).hexdigest()
+
+    def testExtract(self):
+        # Last grain table only partially used
+        capacity = (2 * GT_ENTRIES + 100) * GRAIN_SIZE
+        grains = makeGrains(capacity, 60)
+        vmdk = makeStreamOptimizedVMDK(capacity, grains)
+        expected = self._expected(capacity, grains)
+
+        output, callbacks = self._extract(vmdk, threads=1)
+        self.failUnlessEqual(output, expected)
+        self.failUnlessEqual(len(callbacks), len(grains))
+        for threads in [ 2, 4 ]:
+            out, cbs = self._extract(vmdk, threads=threads)
+            self.failUnlessEqual(out, output)
+            # Grains are written in order
+            self.failUnlessEqual(cbs, callbacks)
+
+    def testCorruptGrain(self):
+        capacity = GRAIN_SIZE * GT_ENTRIES
+        grains = makeGrains(capacity, 20)
+        vmdk = makeStreamOptimizedVMDK(capacity, grains)
+        # Corrupt the compressed data of the first grain
+        vmdk = vmdk[:SECT + 12] + 'garbage!' + vmdk[SECT + 20:]
+        for threads in [ 1, 4 ]:
+            self.failUnlessRaises(zlib.error, self._extract, vmdk, threads)
+
+    def testBenchmark(self):
+        # Not a pass/fail test; reports throughput for various numbers of
+        # threads (run with -v to see it)
+        capacity = 2 * GRAIN_SIZE * GT_ENTRIES
+        vmdk = makeStreamOptimizedVMDK(capacity, makeGrains(capacity, 200))
+        results = []
+        for threads in [ 1, 2, 4, 8 ]:
+            start = time.time()
+            self._extract(vmdk, threads)
+            elapsed = max(time.time() - start, 1e-6)
+            results.append("%d: %.1f MB/s" % (threads,
+                capacity * SECT / elapsed / 1024 / 1024))
+        vmdk_extract.log.info("VMDK extraction throughput by threads: %s",
+            ', '.join(results))
+
+if __name__ == "__main__":
+    testsuite.main()
@@ -43,6 +43,7 @@ from catalogService.rest.models import descriptor
 from catalogService.rest.models import images
 from catalogService.rest.models import instances
 from catalogService.utils.progress import StreamWithProgress
+from catalogService.utils.progress import CoalescingHistory
 
 from catalogService_test import mockedData
 
@@ -140,6 +141,7 @@ class VMwareTest(testbase.TestCase):
             if isinstance(v, mockedData.HTTPResponse):
                 v.reset()
         self.mock(StreamWithProgress, 'interval', 0)
+        self.mock(CoalescingHistory, 'interval', 0)
 
     def  _replaceVmwareData(self, dataDict):
         vmwareSoapData = mockedData.vmwareSoapData.copy()
@@ -201,7 +203,7 @@ class VMwareTest(testbase.TestCase):
 
         response = client.request('GET')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = instances.Handler()
         response = util.BoundedStringIO(response.read())
         nodes = hndlr.parseFile(response)
@@ -1033,6 +1035,8 @@ class VMwareTest(testbase.TestCase):
         def fakeOpenUrl(slf, url, headers):
             return self._makeOva(mockedData.vmwareOvfDescriptor1)
         self.mock(vmware.driver, "openUrl", fakeOpenUrl)
+        # The fake download does not match the mocked image's checksum
+        self.mock(vmware.driver, 'VERIFY_IMAGE_CHECKSUMS', False)
         self.mock(vmware.driver, "getCredentialsIsoFile", fakeGetCredentialsIsoFile)
         def fakeDaemonize(slf, *args, **kwargs):
             slf.postFork()
@@ -1132,6 +1136,7 @@ class VMwareTest(testbase.TestCase):
         job = self.getJobFromResponse(response)
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             ['Launching instance from image aaaaaabb-bbbb-bbbc-cccc-ccccccdddddd (type VMWARE_OVF_IMAGE)',
+            'Image not found in local cache',
             ] + _progress + [
             'Importing OVF descriptor',
             'Reconfiguring VM', 'Converting VM to template',
@@ -1172,6 +1177,7 @@ class VMwareTest(testbase.TestCase):
         job = self.getJobFromResponse(response)
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             ['Launching instance from image aaaaaabb-bbbb-bbbc-cccc-ccccccdddddd (type VMWARE_OVF_IMAGE)',
+            'Image not found in local cache',
             ] + _progress + [
             'Importing OVF descriptor',
             'Reconfiguring VM',
@@ -1212,6 +1218,7 @@ class VMwareTest(testbase.TestCase):
         job = self.getJobFromResponse(response)
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             ['Running',
+            'Image not found in local cache',
             ] + _progress + [
             'Importing OVF descriptor',
             'Reconfiguring VM', 'Converting VM to template',
@@ -1271,6 +1278,7 @@ class VMwareTest(testbase.TestCase):
         job = self.getJobFromResponse(response)
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             ['Running',
+            'Image not found in local cache',
             ] + _progress + [
             'Importing OVF descriptor',
             'Reconfiguring VM', 'Converting VM to template',
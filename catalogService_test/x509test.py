@@ -56,5 +56,65 @@ OHmp+SUZVmL3DMFYJT4zyIJCTLq1hYVQZFU=
 """)
         self.failUnlessEqual(x509.X509.computeHash(fname), '04ffb38d')
 
+    def _fakeGenerate(self, commonName, certDir):
+        certFile = os.path.join(certDir, "%08x.0" % abs(hash(commonName)))
+        file(certFile, "w").write(commonName)
+        file(certFile + '.key', "w").write("key for " + commonName)
+        return certFile, certFile + '.key'
+
+    def testPool(self):
+        poolDir = os.path.join(self.workDir, "pool")
+        certDir = os.path.join(self.workDir, "certs")
+        os.makedirs(certDir)
+        pool = x509.X509Pool(poolDir, depth=3)
+        self.failUnlessEqual(len(pool), 0)
+        self.failUnlessEqual(pool.take(certDir), None)
+
+        names = iter("cn%d" % i for i in range(100))
+        self.failUnlessEqual(pool.fill(names.next,
+            generate=self._fakeGenerate), 3)
+        self.failUnlessEqual(len(pool), 3)
+        self.failUnlessEqual(os.stat(poolDir).st_mode & 0777, 0700)
+        # Already full
+        self.failUnlessEqual(pool.fill(names.next,
+            generate=self._fakeGenerate), 0)
+
+        taken = []
+        for i in range(3):
+            certFile, keyFile = pool.take(certDir)
+            self.failUnlessEqual(os.path.dirname(certFile), certDir)
+            self.failUnlessEqual(file(keyFile).read(),
+                "key for " + file(certFile).read())
+            self.failUnlessEqual(os.stat(keyFile).st_mode & 0777, 0600)
+            taken.append(file(certFile).read())
+        self.failUnlessEqual(sorted(taken), ['cn0', 'cn1', 'cn2'])
+        self.failUnlessEqual(pool.take(certDir), None)
+
+        # Refill in the background
+        pool.fillInBackground(names.next, generate=self._fakeGenerate).join()
+        self.failUnlessEqual(len(pool), 3)
+        # No leftovers from generating
+        self.failUnlessEqual(os.listdir(os.path.join(poolDir, "tmp")), [])
+
+    def testPoolCleanUp(self):
+        poolDir = os.path.join(self.workDir, "pool")
+        pool = x509.X509Pool(poolDir, depth=2)
+        names = iter("cn%d" % i for i in range(100))
+        pool.fill(names.next, generate=self._fakeGenerate)
+        pairs = sorted(os.listdir(poolDir))
+
+        # A refill interrupted while generating, then while moving a pair
+        # into the pool
+        stale = os.path.join(poolDir, "tmp", "tmpXYZ")
+        os.makedirs(stale)
+        self._fakeGenerate("stale", stale)
+        file(os.path.join(poolDir, "0badcafe.0.key"), "w").write("orphan")
+        self.failUnlessEqual(len(pool), 2)
+
+        self.failUnlessEqual(pool.fill(names.next,
+            generate=self._fakeGenerate), 0)
+        self.failUnlessEqual(os.listdir(os.path.join(poolDir, "tmp")), [])
+        self.failUnlessEqual(sorted(os.listdir(poolDir)), pairs)
+
 if __name__ == "__main__":
     testsuite.main()
@@ -289,7 +289,7 @@ class HandlerTest(testbase.TestCase):
 
         response = client.request('GET')
         self.failUnlessEqual(response.msg['Content-Type'], 'application/xml')
-        self.failUnlessEqual(response.msg['Cache-Control'], 'no-store')
+        self.failUnlessEqual(response.msg['Cache-Control'], 'private, no-cache')
         hndlr = instances.Handler()
         nodes = hndlr.parseString(response.read())
         self.failUnless(
@@ -704,6 +704,8 @@ class HandlerTest(testbase.TestCase):
             openUrlFunc = fakeOpenUrl
 
         self.mock(xenent.driver, "openUrl", openUrlFunc)
+        # The fake download does not match the mocked image's checksum
+        self.mock(xenent.driver, 'VERIFY_IMAGE_CHECKSUMS', False)
 
         srv = self.newService()
         uri = 'clouds/%s/instances/%s/instances' % (cloudType, cloudName)
@@ -763,6 +765,7 @@ class HandlerTest(testbase.TestCase):
         job = self.getJobFromResponse(response)
         self.failUnlessEqual([ x.get_content() for x in job.history ],
             ['Launching instance from image 0903de41206786d4407ff24ab6e972c0d6b801f3 (type XEN_OVA)',
+                'Image not found in local cache',
                 'Downloading image: 0%', 'Importing image',
              'Cloning template', 'Attaching credentials', 'Launching',
              'Instance(s) running: VmUuid1', 'Instance VmUuid1: 10.0.0.1',
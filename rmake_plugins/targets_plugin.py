@@ -18,17 +18,25 @@
 from xobj import xobj2
 from lxml import etree
 import base64
+import os
+import Queue
 import sys
 import StringIO
+import threading
+import time
 import weakref
 
 from rmake3.core import handler
 
 from conary import conarycfg
+from conary.lib import util
 from conary.lib.formattrace import formatTrace
 
 from catalogService import errors
+from catalogService import listingWarmer
 from catalogService import storage
+from catalogService.rest import baseDriver
+from catalogService.rest import drivers
 
 from catalogService.rest.models import xmlNode
 
@@ -56,6 +64,18 @@ class TargetsPlugin(bfp.BaseForwardingPlugin):
         handler.registerHandler(TargetsImageDeployDescriptorHandler)
         handler.registerHandler(TargetsSystemLaunchDescriptorHandler)
 
+    def worker_pre_setup(self, worker):
+        # Only the drivers of the target types tasks used on this rUS are
+        # loaded ahead of time: loading all of them would import the client
+        # libraries of every cloud type, whether there are such targets or
+        # not. The others are loaded by the first task for one of their
+        # targets
+        preloadDrivers(getRecordedDrivers())
+        # Tasks may run in processes of their own, which go away with the
+        # task: the warmer has to run in the worker itself
+        if baseDriver.BaseDriver.LISTING_CACHE_TTL:
+            getListingWarmer()
+
     def worker_get_task_types(self):
         return {
             NS.TARGET_TEST_CREATE: TargetsTestCreate,
@@ -179,7 +199,9 @@ class RestDatabase(object):
     cfg = conarycfg.ConaryConfiguration(readConfigFiles=True)
 
     def __init__(self, taskHandler):
-        self.taskHandler = weakref.proxy(taskHandler)
+        if taskHandler is not None:
+            taskHandler = weakref.proxy(taskHandler)
+        self.taskHandler = taskHandler
         self.auth = self.Auth()
         self.targetMgr = self.TargetManager(self.taskHandler)
 
@@ -188,6 +210,7 @@ class BaseTaskHandler(bfp.BaseTaskHandler):
     Task that runs on the rUS to query the target systems.
     """
     RestDatabaseClass = RestDatabase
+    STORAGE_PATH = "/srv/rbuilder/catalog"
 
     def run(self):
         self._initConfig()
@@ -218,39 +241,23 @@ class BaseTaskHandler(bfp.BaseTaskHandler):
         self.zoneAddresses = params.zoneAddresses
 
     def _initTarget(self):
-        driverName = self.targetConfig.targetType
-        # xen enterprise is a one-off
-        if driverName == 'xen-enterprise':
-            driverName = 'xenent'
-
-        moduleName = "catalogService.rest.drivers.%s" % driverName
-        BaseDriverClass = __import__(moduleName, {}, {}, '.driver').driver
-
-        class Driver(BaseDriverClass):
-            def __init__(slf, userCredentials, *args, **kwargs):
-                super(Driver, slf).__init__(*args, **kwargs)
-                slf.setUserCredentials(userCredentials)
-            def setUserCredentials(slf, userCredentials):
-                slf._userCredentials = userCredentials
-                slf.reset()
-            def _getCloudCredentialsForUser(slf):
-                return slf._userCredentials.credentials
-            def _getStoredTargetConfiguration(slf):
-                config = self.targetConfig.config.copy()
-                config.update(alias=self.targetConfig.alias)
-                return config
-            def _checkAuth(slf):
-                return True
-            def _getMintImagesByType(slf, imageType):
-                "Overridden, no access to mint"
-                return []
-
-        restDb = self._createRestDatabase()
-        scfg = storage.StorageConfig(storagePath="/srv/rbuilder/catalog")
-        self.driver = Driver(self.userCredentials, scfg, driverName, cloudName=self.targetConfig.targetName,
-            db=restDb, inventoryHandler=InventoryHandler(weakref.ref(self)),
-            zoneAddresses=self.zoneAddresses)
-        self.driver._nodeFactory.baseUrl = '/'
+        self.driver = self.createDriver(self.targetConfig,
+            self.userCredentials, self.zoneAddresses,
+            restDb=self._createRestDatabase(),
+            inventoryHandler=InventoryHandler(weakref.ref(self)))
+
+    @classmethod
+    def createDriver(cls, targetConfig, userCredentials, zoneAddresses,
+            restDb=None, inventoryHandler=None):
+        if restDb is None:
+            restDb = cls._newRestDatabase(None, userCredentials)
+        if inventoryHandler is None:
+            # Not running as part of a task, there is no one to report
+            # systems to
+            inventoryHandler = InventoryHandler(lambda: None)
+        scfg = storage.StorageConfig(storagePath=cls.STORAGE_PATH)
+        return getDriverFactory(targetConfig).newDriver(userCredentials,
+            scfg, restDb, inventoryHandler, zoneAddresses)
 
     def finishCall(self, node, msg, code=C.OK):
         if node is not None:
@@ -267,13 +274,37 @@ class BaseTaskHandler(bfp.BaseTaskHandler):
         return hndlr.toXml(node)
 
     def _createRestDatabase(self):
-        db = self.RestDatabaseClass(self)
-        if self.userCredentials is not None:
+        return self._newRestDatabase(self, self.userCredentials)
+
+    @classmethod
+    def _newRestDatabase(cls, taskHandler, userCredentials):
+        db = cls.RestDatabaseClass(taskHandler)
+        if userCredentials is not None:
             db.auth.auth = Authorization(authorized=True,
-                userId=self.userCredentials.rbUserId,
-                admin=bool(self.userCredentials.isAdmin))
+                userId=userCredentials.rbUserId,
+                admin=bool(userCredentials.isAdmin))
         return db
 
+    def _warmListings(self, userCredentials, kinds):
+        """
+        Keep refreshing the listings of this target in the background,
+        with these credentials, while they keep being requested
+        """
+        if userCredentials is None or not self.driver.LISTING_CACHE_TTL:
+            return
+        target = "%s/%s" % (self.targetConfig.targetType,
+            self.targetConfig.targetName)
+        getListingRegistry().add(target,
+            str(userCredentials.opaqueCredentialsId),
+            (self.targetConfig, userCredentials, self.zoneAddresses, kinds))
+
+    @classmethod
+    def _ageMessage(cls, msg, ages):
+        ages = [ x for x in ages if x is not None ]
+        if not ages:
+            return msg
+        return "%s (cached, %d seconds old)" % (msg, max(ages))
+
 class TargetsTestCreate(BaseTaskHandler):
     def _run(self):
         """
@@ -305,28 +336,337 @@ class TargetsImageListTask(BaseTaskHandler):
         """
         List target images
         """
-        images = self.driver.getImagesFromTarget(None)
-        self.finishCall(images, "Retrieved list of images")
+        images = self.driver.getTargetImages()
+        self._warmListings(self.userCredentials, [ 'images' ])
+        self.finishCall(images, self._ageMessage("Retrieved list of images",
+            [ self.driver.getListingAge('images') ]))
 
 class TargetsInstanceListTask(BaseTaskHandler):
+    # Maximum number of credential sets listed at the same time
+    CONCURRENCY = 8
+    # Seconds to wait for the listing of one credential set
+    TIMEOUT = 300
+
     def _run(self):
         """
         List target instances
         """
+        groups = self._groupCredentials()
+        results, failures = self._listGroups(groups)
+        if not results and failures:
+            # Nothing to show, report the first error
+            raise failures[0][0], failures[0][1], failures[0][2]
         instancesMap = {}
-        for creds in self.allUserCredentials:
-            self.driver.setUserCredentials(creds)
-            credId = creds.opaqueCredentialsId
-            instances = self.driver.getAllInstances()
+        ages = []
+        credited = 0
+        for idx, (instances, age, credIds) in sorted(results.items()):
+            ages.append(age)
+            credited += len(credIds)
             for inst in instances:
                 instId = inst.getInstanceId()
-                # Append current credentials to this instance
-                instancesMap.setdefault(instId, (inst, []))[1].append(credId)
+                # Append the credentials sharing this inventory
+                instancesMap.setdefault(instId, (inst, []))[1].extend(credIds)
         instances = self.driver.Instances()
         for _, (inst, credIds) in sorted(instancesMap.items()):
             inst.setCredentials(credIds)
             instances.append(inst)
-        self.finishCall(instances, "Retrieved list of instances")
+        msg = self._ageMessage("Retrieved list of instances", ages)
+        total = sum(len(x) for x in groups)
+        if credited < total:
+            msg = "%s, %d of %d credential sets failed" % (msg,
+                total - credited, total)
+        self.finishCall(instances, msg)
+
+    def _groupCredentials(self):
+        """
+        Group the credentials by the inventory they give access to, so
+        each inventory is only listed once
+        """
+        groups = {}
+        order = []
+        for creds in self.allUserCredentials:
+            key = self.driver.drvGetInventoryKey(creds.credentials)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(creds)
+        return [ groups[x] for x in order ]
+
+    def _listGroups(self, groups):
+        """
+        List the inventory of each group on a bounded number of threads.
+        Returns a dictionary mapping group indexes to (instances, age,
+        credentialIds) tuples, and the exc_info of the groups that failed.
+        Listings still running after TIMEOUT seconds are abandoned.
+        """
+        resultQueue = Queue.Queue()
+        pending = range(len(groups))
+        running = {}
+        results = {}
+        failures = []
+        while pending or running:
+            while pending and len(running) < self.CONCURRENCY:
+                idx = pending.pop(0)
+                running[idx] = time.time() + self.TIMEOUT
+                thread = threading.Thread(target=self._listGroup,
+                    args=(idx, groups[idx], resultQueue))
+                thread.setDaemon(True)
+                thread.start()
+            timeout = max(0, min(running.values()) - time.time())
+            try:
+                idx, result, excInfo = resultQueue.get(timeout=timeout)
+            except Queue.Empty:
+                now = time.time()
+                for idx, deadline in running.items():
+                    if deadline <= now:
+                        del running[idx]
+                        failures.append(self._timeoutExcInfo(groups[idx]))
+                continue
+            if running.pop(idx, None) is None:
+                # Abandoned already
+                continue
+            if result is not None:
+                results[idx] = result
+            else:
+                failures.append(excInfo)
+        return results, failures
+
+    def _listGroup(self, idx, group, resultQueue):
+        # Any credential set of the group will do, try them in turn
+        excInfo = None
+        for i, creds in enumerate(group):
+            try:
+                driver = self.createDriver(self.targetConfig, creds,
+                    self.zoneAddresses)
+                instances = driver.getAllInstances()
+            except Exception:
+                if excInfo is None:
+                    excInfo = sys.exc_info()
+                continue
+            self._warmListings(creds, [ 'instances' ])
+            # Sharing the inventory key does not mean the other sets are
+            # valid: only credit the ones that authenticate
+            credIds = [ creds.opaqueCredentialsId ] + [
+                x.opaqueCredentialsId for x in group[i + 1:]
+                if self._authenticates(x, creds) ]
+            resultQueue.put((idx,
+                (instances, driver.getListingAge('instances'), credIds),
+                None))
+            return
+        resultQueue.put((idx, None, excInfo))
+
+    def _authenticates(self, creds, validCreds):
+        if creds.credentials == validCreds.credentials:
+            return True
+        try:
+            driver = self.createDriver(self.targetConfig, creds,
+                self.zoneAddresses)
+            return bool(driver.drvValidateCredentials(creds.credentials))
+        except Exception:
+            return False
+
+    def _timeoutExcInfo(self, group):
+        try:
+            raise errors.TargetTimeout("Timed out listing instances for "
+                "credentials %s" % ', '.join(
+                    str(x.opaqueCredentialsId) for x in group))
+        except errors.TargetTimeout:
+            return sys.exc_info()
+
+def _refreshListings(target, payload):
+    targetConfig, userCredentials, zoneAddresses, kinds = payload
+    driver = BaseTaskHandler.createDriver(targetConfig, userCredentials,
+        zoneAddresses)
+    driver.refreshListings(kinds)
+
+def getListingRegistry():
+    """
+    Return the registry through which tasks, whatever process they run
+    in, hand the targets they list over to the worker's listing warmer
+    """
+    return listingWarmer.SharedRegistry(os.path.join(
+        BaseTaskHandler.STORAGE_PATH, 'listing-warmer', 'registry'))
+
+_listingWarmer = None
+_listingWarmerLock = threading.Lock()
+
+def getListingWarmer():
+    """
+    Return the warmer refreshing the listings of recently listed targets,
+    starting it if needed. It is started by the worker when it sets up,
+    and refreshes listings before they expire from the listing cache.
+    """
+    global _listingWarmer
+    with _listingWarmerLock:
+        if _listingWarmer is None:
+            _listingWarmer = listingWarmer.ListingWarmer(_refreshListings,
+                interval=0.75 * baseDriver.BaseDriver.LISTING_CACHE_TTL,
+                registry=getListingRegistry())
+            _listingWarmer.start()
+        return _listingWarmer
+
+def getDriverName(targetType):
+    # xen enterprise is a one-off
+    if targetType == 'xen-enterprise':
+        return 'xenent'
+    return targetType
+
+_driverClasses = {}
+
+def getDriverClass(driverName):
+    """
+    Return the class of the drivers used by tasks for a driver module.
+    Classes are built once per worker.
+    """
+    driverClass = _driverClasses.get(driverName)
+    if driverClass is not None:
+        return driverClass
+    BaseDriverClass = drivers.getDriverClass(driverName)
+
+    class Driver(BaseDriverClass):
+        def __init__(slf, targetConfig, userCredentials, *args, **kwargs):
+            slf._storedTargetConfig = targetConfig
+            super(Driver, slf).__init__(*args, **kwargs)
+            slf.setUserCredentials(userCredentials)
+        def setUserCredentials(slf, userCredentials):
+            slf._userCredentials = userCredentials
+            slf.reset()
+        def _getCloudCredentialsForUser(slf):
+            return slf._userCredentials.credentials
+        def _getStoredTargetConfiguration(slf):
+            return DriverFactory.getConfiguration(slf._storedTargetConfig)
+        def _checkAuth(slf):
+            return True
+        def _getMintImagesByType(slf, imageType):
+            "Overridden, no access to mint"
+            return []
+
+    _driverClasses[driverName] = Driver
+    return Driver
+
+class DriverFactory(object):
+    """
+    Builds the drivers for one target. Factories are kept for the life of
+    the worker (see getDriverFactory), and so are the authenticated clients
+    of the drivers, in the driver's client pool. Clients logged in with
+    credentials that changed since are dropped from the pool.
+    """
+    def __init__(self, targetConfig):
+        self.targetConfig = targetConfig
+        self.driverName = getDriverName(targetConfig.targetType)
+        self.driverClass = getDriverClass(self.driverName)
+        self._clientKeys = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def getConfiguration(cls, targetConfig):
+        config = targetConfig.config.copy()
+        config.update(alias=targetConfig.alias)
+        return config
+
+    def matches(self, targetConfig):
+        return (self.getConfiguration(targetConfig) ==
+            self.getConfiguration(self.targetConfig))
+
+    def newDriver(self, userCredentials, storageConfig, restDb,
+            inventoryHandler, zoneAddresses):
+        driver = self.driverClass(self.targetConfig, userCredentials,
+            storageConfig, self.driverName,
+            cloudName=self.targetConfig.targetName, db=restDb,
+            inventoryHandler=inventoryHandler, zoneAddresses=zoneAddresses)
+        driver._nodeFactory.baseUrl = '/'
+        self._trackClient(driver, userCredentials)
+        return driver
+
+    def _trackClient(self, driver, userCredentials):
+        pool = driver.cloudClientPool
+        if pool is None or userCredentials is None:
+            return
+        credentials = driver.credentials
+        if not credentials:
+            return
+        key = driver._getCloudClientPoolKey(credentials)
+        credId = userCredentials.opaqueCredentialsId
+        with self._lock:
+            oldKey = self._clientKeys.get(credId)
+            self._clientKeys[credId] = key
+        if oldKey is not None and oldKey != key:
+            pool.invalidate(oldKey)
+
+_driverFactories = {}
+_driverFactoriesLock = threading.Lock()
+
+def getDriverFactory(targetConfig):
+    """
+    Return the driver factory for a target, replacing it if the target
+    configuration changed
+    """
+    key = (targetConfig.targetType, targetConfig.targetName)
+    with _driverFactoriesLock:
+        old = _driverFactories.get(key)
+        if old is not None and old.matches(targetConfig):
+            return old
+        factory = _driverFactories[key] = DriverFactory(targetConfig)
+    recordDriver(factory.driverName)
+    pool = factory.driverClass.cloudClientPool
+    if old is not None and pool is not None:
+        # The pool keys cover the configuration, but clients logged in
+        # with the old one would only linger until they expire
+        pool.invalidateTarget(factory.driverClass.cloudType,
+            targetConfig.targetName)
+    return factory
+
+def getRecordedDriversPath():
+    return os.path.join(BaseTaskHandler.STORAGE_PATH, 'preload-drivers')
+
+def getRecordedDrivers():
+    """
+    Return the names of the driver modules tasks used on this rUS, in the
+    order they were first used
+    """
+    try:
+        lines = file(getRecordedDriversPath()).readlines()
+    except IOError:
+        return []
+    ret = []
+    for line in lines:
+        driverName = line.strip()
+        if driverName in drivers.SUPPORTED_MODULES and driverName not in ret:
+            ret.append(driverName)
+    return ret
+
+_recordedDrivers = set()
+
+def recordDriver(driverName):
+    """
+    Remember that a task used a driver module, so that the next worker
+    loads it when it starts. Tasks may run in processes of their own, the
+    names are appended to a file shared by all of them.
+    """
+    if driverName in _recordedDrivers:
+        return
+    _recordedDrivers.add(driverName)
+    if driverName in getRecordedDrivers():
+        return
+    path = getRecordedDriversPath()
+    try:
+        util.mkdirChain(os.path.dirname(path))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, driverName + '\n')
+        finally:
+            os.close(fd)
+    except (IOError, OSError):
+        # Preloading is only an optimization
+        pass
+
+def preloadDrivers(driverNames):
+    """
+    Import the driver modules (and build the task driver classes) ahead
+    of the first task
+    """
+    for driverName in driverNames:
+        getDriverClass(driverName)
 
 class JobProgressTaskHandler(BaseTaskHandler):
     class Job(object):